@@ -219,174 +219,239 @@
 # if __name__ == '__main__':
 #     app.run(host='0.0.0.0', port=5000, debug=True)
 
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify
 from flask_cors import CORS
-import pandas as pd
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import os
-import re
-from joblib import dump, load
+import hmac
+import json
+import hashlib
+import math
+import time
+import base64
+import random
 import logging
-from chat import chat_bp
+from functools import lru_cache, partial
+from sessions import SessionStore, stream_events
+from compression import compress_response
+from favorites import ProfileCache, default_store
+from history import EmotionHistory, authenticate, history_bp, verify_firebase_token, default_store as default_history_store
+from thumbnails import PREFETCH_TOP_N, ThumbnailCache, thumbnails_bp
+from fanout import ENGINE_DEADLINE, engine_pool
+from metrics import REQUEST_SECONDS, render as render_metrics
 
-app = Flask(__name__)
-CORS(app)
-# Configure logging to see detailed console output
-logging.basicConfig(level=logging.DEBUG)
+# LOG_LEVEL=DEBUG plus REQUEST_LOG_SAMPLE (a 0-1 fraction) logs a sample of requests
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
+REQUEST_LOG_SAMPLE = float(os.getenv('REQUEST_LOG_SAMPLE', 0))
 
-# Load and preprocess datasets
-def load_data():
-    # Load datasets
-    anime_df = pd.read_excel('anime_with_emotions.xlsx').dropna()
-    book_df = pd.read_excel('book_dataset.xlsx').dropna()
-    
-    # Clean and standardize data
-    anime_df['emotion'] = anime_df['emotion'].str.lower().str.strip()
-    book_df['emotion'] = book_df['emotion'].str.lower().str.strip()
-    
-    emotion_map = {
-        'surprised': 'surprise',
-        'fearful': 'fear',
-        'angry': 'anger',
-        'disgust': 'disgust'
-        # Add other mappings as needed
-    }
-    
-    anime_df['emotion'] = anime_df['emotion'].str.lower().str.strip().map(emotion_map).fillna(anime_df['emotion'])
-    book_df['emotion'] = book_df['emotion'].str.lower().str.strip().map(emotion_map).fillna(book_df['emotion'])
-    
-    # Create combined features for better recommendations
-    anime_df['features'] = (
-        anime_df['title'].astype(str) + " " +
-        anime_df['description'].astype(str) + " " +
-        anime_df['genre'].astype(str)
-    )
-    
-    book_df['features'] = (
-        book_df['title'].astype(str) + " " +
-        book_df['description'].astype(str) + " " +
-        book_df['emotion_based_genre'].astype(str)
-    )
-    
-    return anime_df, book_df
+# How create_app loads the catalog (pandas, scikit-learn and the models are only imported then):
+#   eager:      before returning; with gunicorn --preload the workers share the loaded pages
+#   background: in a thread, /readyz answers 503 until it is done
+#   lazy:       on the first request that needs it
+WARMUP = os.getenv('WARMUP', 'background')
+WARMUP_MODES = ('eager', 'background', 'lazy')
 
-anime_df, book_df = load_data()
+def log_request_sample(message, *args):
+    """Debug-log a sampled fraction of requests; the arguments are only formatted if the line is emitted"""
+    if REQUEST_LOG_SAMPLE and random.random() < REQUEST_LOG_SAMPLE:
+        logger.debug(message, *args)
 
-# Initialize and train TF-IDF vectorizers
-def initialize_models():
-    # Create model directory if not exists
-    os.makedirs('models', exist_ok=True)
-    
+def start_timer():
+    g.request_start = time.perf_counter()
+
+def record_request_time(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, response.status_code)
+    return response
+
+# Recommendation, catalog and session endpoints; they need the loaded catalog
+api = Blueprint('api', __name__)
+
+def get_engines():
+    """Engine and response formatter per catalog kind of the current app"""
+    return current_app.extensions['catalog'].engines
+
+@api.before_request
+def require_catalog():
+    catalog = current_app.extensions['catalog']
+    if catalog.ready:
+        catalog.check_for_updates()
+        return None
+    if current_app.config['WARMUP'] == 'lazy' and catalog.error is None:
+        try:
+            catalog.warm()
+            return None
+        except Exception:
+            pass  # reported from catalog.error below
+    if catalog.error is not None:
+        return jsonify({'status': 'error', 'message': f'Catalog failed to load: {catalog.error}'}), 503
+    response = jsonify({'status': 'error', 'message': 'Catalog is still loading, try again shortly'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+# API Endpoints
+# Serialized /api/emotion payloads kept for seeded requests
+PAYLOAD_CACHE_SIZE = 1024
+# Items per recommendation list: default and largest accepted ``limit``
+DEFAULT_PAGE_SIZE = 15
+MAX_PAGE_SIZE = 100
+
+def read_fields(data):
+    """Response fields asked for (``fields`` query argument or body key), in response order; None for all.
+
+    Raises ``ValueError`` if malformed or unknown.
+    """
+    from engine import RESPONSE_FIELDS
+    fields = request.args.get('fields', data.get('fields'))
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not isinstance(fields, list) or not fields or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated list of field names")
+    unknown = sorted(set(fields) - set(RESPONSE_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, expected some of {list(RESPONSE_FIELDS)}")
+    return tuple(field for field in RESPONSE_FIELDS if field in fields)
+
+def read_limit(data, default=DEFAULT_PAGE_SIZE):
+    """Items per list asked for (``limit`` query argument or body key); raises ``ValueError`` if out of range"""
+    limit = request.args.get('limit', data.get('limit', default))
     try:
-        # Try loading pre-trained models
-        anime_vectorizer = load('models/anime_vectorizer.joblib')
-        book_vectorizer = load('models/book_vectorizer.joblib')
-        anime_tfidf = load('models/anime_tfidf.joblib')
-        book_tfidf = load('models/book_tfidf.joblib')
-    except:
-        # Train new models if loading fails
-        anime_vectorizer = TfidfVectorizer(stop_words='english', max_features=5000)
-        book_vectorizer = TfidfVectorizer(stop_words='english', max_features=5000)
-        
-        anime_tfidf = anime_vectorizer.fit_transform(anime_df['features'])
-        book_tfidf = book_vectorizer.fit_transform(book_df['features'])
-        
-        # Save models
-        dump(anime_vectorizer, 'models/anime_vectorizer.joblib')
-        dump(book_vectorizer, 'models/book_vectorizer.joblib')
-        dump(anime_tfidf, 'models/anime_tfidf.joblib')
-        dump(book_tfidf, 'models/book_tfidf.joblib')
-    
-    return anime_vectorizer, book_vectorizer, anime_tfidf, book_tfidf
-
-anime_vectorizer, book_vectorizer, anime_tfidf, book_tfidf = initialize_models()
-
-# Recommendation Engine
-class RecommendationEngine:
-    def __init__(self, df, vectorizer, tfidf_matrix):
-        self.df = df
-        self.vectorizer = vectorizer
-        self.tfidf_matrix = tfidf_matrix
-        self.emotion_indices = {
-            emotion: df[df['emotion'] == emotion].index 
-            for emotion in df['emotion'].unique()
-        }
-        self.emotion_map = {
-            'surprised': 'surprise',
-            'fearful': 'fear',
-            'angry': 'anger'
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+def read_seed(seed):
+    """A client-supplied sample seed (None if absent); raises ``ValueError`` unless a non-negative integer"""
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        raise ValueError("seed must be a non-negative integer")
+    return seed
+
+def load_profiles(catalog, user):
+    """The UserProfile of ``user`` per kind (None where they saved nothing).
+
+    None if they saved nothing at all or the favorites store failed.
+    """
+    cache = current_app.extensions['profiles']
+    try:
+        profiles = {
+            kind: cache.get(user, kind, engine, catalog.version)
+            for kind, (engine, _) in catalog.engines.items()
         }
-    
-    def get_recommendations(self, emotion, top_n=15, min_similarity=0.2):
-        try:
-            # Standardize emotion input
-            emotion = emotion.lower().strip()
-            emotion = self.emotion_map.get(emotion, emotion)
-            
-            # Get items that actually match the requested emotion
-            emotion_items = self.df[self.df['emotion'] == emotion]
-            if len(emotion_items) == 0:
-                print(f"No items found for emotion: {emotion}")
-                return []
-
-            # Calculate average vector for emotion-matched items
-            emotion_indices = emotion_items.index
-            emotion_vectors = self.tfidf_matrix[emotion_indices]
-            avg_vector = np.mean(emotion_vectors, axis=0)
-            
-            # Convert to numpy array and reshape
-            avg_vector_array = np.asarray(avg_vector).reshape(1, -1)
-            tfidf_matrix_array = np.asarray(self.tfidf_matrix.todense())
-            
-            # Calculate similarities with all items
-            similarities = cosine_similarity(avg_vector_array, tfidf_matrix_array)
-            similarities = similarities.flatten()
-            
-            # Create DataFrame for filtering and sorting
-            rec_df = self.df.copy()
-            rec_df['similarity_score'] = similarities
-            
-            # Filter and sort recommendations
-            recommendations = (
-                rec_df
-                # Exclude items that already have this emotion
-                .loc[~rec_df.index.isin(emotion_indices)]
-                # Filter by minimum similarity threshold
-                .query(f"similarity_score >= {min_similarity}")
-                # Sort by similarity score descending
-                .sort_values('similarity_score', ascending=False)
-            )
-            recommendations = recommendations.sample(n=min(top_n, len(recommendations)), random_state=np.random.randint(0, 10000)).to_dict('records')
+    except Exception:
+        logger.warning("Could not load favorites of %s, not personalizing", user, exc_info=True)
+        return None
+    return profiles if any(profile is not None for profile in profiles.values()) else None
 
-            
-            return recommendations
+def project(record, fields):
+    """The record with only ``fields`` (all of them if None)"""
+    return record if fields is None else {field: record[field] for field in fields}
+
+def cursor_scope(emotion, limit, user=None):
+    """The requests a cursor is valid for: its emotion, page size and the user whose favorites steer
+    the pages (a digest of their email; None when not personalized)"""
+    return [emotion, limit, user and hashlib.sha256(user.encode()).hexdigest()[:16]]
 
-        except Exception as e:
-            print(f"Recommendation error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return []
+def encode_cursor(seed, offset, version, scope):
+    """Opaque cursor of the next page of a seeded sample"""
+    return base64.urlsafe_b64encode(json.dumps([seed, offset, version, scope]).encode()).decode().rstrip('=')
 
-# Initialize recommendation engines
-anime_engine = RecommendationEngine(anime_df, anime_vectorizer, anime_tfidf)
-book_engine = RecommendationEngine(book_df, book_vectorizer, book_tfidf)
+def decode_cursor(cursor):
+    """(seed, offset, catalog version, scope) of a cursor; raises ``ValueError`` if it is malformed"""
+    try:
+        seed, offset, version, scope = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if not all(isinstance(value, int) and value >= 0 for value in (seed, offset, version)):
+        raise ValueError("Malformed cursor")
+    if not isinstance(scope, list) or len(scope) != 3:
+        raise ValueError("Malformed cursor")
+    return seed, offset, version, scope
 
-@app.route('/')
-def index():
-    return {"message": "Mood Conexus API is running."}
+def build_emotion_payload(catalog, emotion, label, seed=None, version=None, limit=DEFAULT_PAGE_SIZE, offset=0,
+                          fields=None, profiles=None, deadline=None, debug=False, user=None):
+    """JSON body of an /api/emotion response, joined from the engines' pre-encoded records.
 
-app.register_blueprint(chat_bp)
+    ``version`` is the catalog version; with a seed it keys the payload cache
+    and goes into ``next_cursor``, which is set while a list still fills a page.
+    ``profiles`` maps kinds to the UserProfile of ``user``, the requesting user.
+    The engines run concurrently on the shared pool; a list not ready within
+    ``deadline`` seconds is sent empty, with ``"partial":true`` and the kinds
+    ``missing``, and no ``next_cursor`` (paging on would skip that list's
+    items of this page). ``debug`` adds the per-engine timings.
+    Returns ``(payload, complete)``.
+    """
+    engines = {kind: engine for kind, (engine, _) in catalog.engines.items()}
+    if profiles is None:
+        calls = {kind: partial(engine.select, emotion, top_n=limit, seed=seed, offset=offset)
+                 for kind, engine in engines.items()}
+    else:
+        calls = {kind: partial(engine.select_personalized, emotion, profiles.get(kind), top_n=limit, seed=seed,
+                               offset=offset)
+                 for kind, engine in engines.items()}
+    selections, timings = engine_pool.run(calls, deadline)
+    missing = [kind for kind in engines if kind not in selections]
 
-# API Endpoints
-@app.route('/api/emotion', methods=['POST'])
+    next_cursor = None
+    if (seed is not None and version is not None and not missing
+            and any(len(positions) == limit for positions, _ in selections.values())):
+        next_cursor = encode_cursor(seed, offset + limit, version,
+                                    cursor_scope(emotion, limit, user if profiles else None))
+    payload = (
+        '{"status":"success","emotion":' + json.dumps(label)
+        + ''.join(
+            f',"{kind}_recommendations":'
+            + (engine.to_json(*selections[kind], fields=fields) if kind in selections else '[]')
+            for kind, engine in engines.items()
+        )
+        + ',"next_cursor":' + json.dumps(next_cursor)
+        + (',"personalized":true' if profiles else '')
+        + (',"partial":true,"missing":' + json.dumps(missing) if missing else '')
+        + (',"debug":' + json.dumps({'deadline_ms': deadline and deadline * 1000, 'engines': timings}) if debug else '')
+        + '}'
+    )
+    return payload, not missing
+
+class IncompletePayload(Exception):
+    """Raised out of the payload cache with a payload missing a list, so that it is not cached"""
+
+    def __init__(self, payload):
+        super().__init__("payload is missing an engine's recommendations")
+        self.payload = payload
+
+@lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+def cached_emotion_payload(catalog, emotion, label, seed, version, limit, offset, fields, deadline):
+    """build_emotion_payload for an unpersonalized seeded request, kept once complete"""
+    payload, complete = build_emotion_payload(catalog, emotion, label, seed, version, limit, offset, fields,
+                                              deadline=deadline)
+    if not complete:
+        raise IncompletePayload(payload)
+    return payload
+
+@api.route('/api/emotion', methods=['GET', 'POST'])
 def handle_emotion():
-    # Log that we received a request
-    logger.debug("\n=== Received Emotion Detection Request ===")
-    data = request.get_json()
-    logger.debug(f"Raw emotion data received: {data}")
+    """Recommendations for one emotion. Optional: seed, limit, fields (e.g. "title,thumbnail"),
+    cursor (the previous page's next_cursor, only valid with the same emotion, limit and
+    sign-in as that page), in the body or the query string. A signed-in
+    caller (``Authorization: Bearer <Firebase ID token>``) gets their favorites steering the
+    ranking and left out.
+
+    Seeded responses carry an ETag; a GET with a matching If-None-Match gets a 304.
+    A list whose engine misses the ENGINE_DEADLINE_MS budget is sent empty and the
+    response flagged ``partial``; debug=true adds the per-engine timings.
+    """
+    if request.method == 'GET':
+        data = request.args.to_dict()
+        if data.get('seed', '').isdigit():
+            data['seed'] = int(data['seed'])
+    else:
+        data = request.get_json()
     emotion = data.get('emotion', '').lower().strip()
     
     if not emotion:
@@ -400,80 +465,480 @@ def handle_emotion():
         }
     raw_emotion = data['emotion'].lower().strip()
     processed_emotion = emotion_map.get(raw_emotion, raw_emotion)
-        
-    logger.debug(f"Processing: {raw_emotion} -> {processed_emotion}")
-    
-    # Get recommendations
-    anime_recs = anime_engine.get_recommendations(processed_emotion)
-    book_recs = book_engine.get_recommendations(processed_emotion)
-    # Log the results before sending back
-    logger.debug(f"Generated {len(anime_recs)} anime recommendations")
-    logger.debug(f"Generated {len(book_recs)} book recommendations")
-    def truncate_description(desc, max_lines=3, max_length=300):
-        """Clean and truncate description to specified number of lines and characters"""
-        if not desc:
-            return ""
-            
-        # Clean the description first
-        clean_desc = desc.replace('_x000D_\n', '\n').strip()
-        
-        # Truncate by lines
-        lines = [line.strip() for line in clean_desc.split('\n') if line.strip()]
-        truncated = '\n'.join(lines[:max_lines])
-        
-        # Further truncate by character length if needed
-        if len(truncated) > max_length:
-            truncated = truncated[:max_length].rsplit(' ', 1)[0] + "..."
-        elif len(lines) > max_lines:
-            truncated += "..."
-            
-        return truncated
-    
-    # Format responses
-    def format_anime(anime):
-        return {
-            'title': anime.get('title', ''),
-            'rating': float(anime.get('rating', 0)),
-            'description': truncate_description(anime.get('description', '')),
-            'thumbnail': anime.get('thumbnail', ''),
-            'previewlink': anime.get('previewlink', ''),
-            'emotion': anime.get('emotion', ''),
-            'genre': anime.get('genre', ''),
-            'similarity_score': float(anime.get('similarity_score', 0))
-        }
-    
-    def format_book(book):
-        return {
-            'title': book.get('title', ''),
-            'rating': float(book.get('rating', 0)),
-            'description': truncate_description(book.get('description', '')),
-            'thumbnail': book.get('thumbnail', ''),
-            'previewlink': book.get('previewLink', ''),
-            'emotion': book.get('emotion', ''),
-            'genre': book.get('emotion_based_genre', book.get('genre', '')),
-            'similarity_score': float(book.get('similarity_score', 0))
-        }
+    log_request_sample("Emotion request %s: %s -> %s", data, raw_emotion, processed_emotion)
 
-    return jsonify({
+    catalog = current_app.extensions['catalog']
+    # Optional seed so clients can reproduce a sample
+    offset, version, scope = 0, catalog.version, None
+    try:
+        seed = read_seed(data.get('seed'))
+        fields = read_fields(data)
+        cursor = request.args.get('cursor', data.get('cursor'))
+        if cursor:
+            seed, offset, version, scope = decode_cursor(str(cursor))
+        # Later pages may leave out the limit of the first
+        limit = read_limit(data, default=scope[1] if scope else DEFAULT_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if version != catalog.version:
+        return jsonify({'status': 'error', 'message': 'Cursor expired: the catalog has changed since the first page'}), 410
+    debug = str(request.args.get('debug', data.get('debug', ''))).lower() in ('1', 'true')
+
+    # Personalized only for the verified caller: an email in the body would expose anyone's favorites
+    user = None
+    if 'Authorization' in request.headers:
+        user, error = authenticate()
+        if error:
+            return error
+    profiles = load_profiles(catalog, user) if user else None
+    if scope is not None and scope != cursor_scope(processed_emotion, limit, user if profiles else None):
+        # Paging on would return a page of another list
+        return jsonify({'status': 'error',
+                        'message': 'Cursor belongs to another request: send the emotion, limit and sign-in of its first page'}), 400
+    if seed is None:
+        # A fresh sample; its seed goes into the cursor so the next pages continue it
+        payload, _ = build_emotion_payload(catalog, processed_emotion, emotion, random.getrandbits(32), version,
+                                           limit, 0, fields, profiles, ENGINE_DEADLINE, debug, user)
+        return Response(payload, mimetype='application/json')
+
+    # Seeded samples are deterministic, so their complete serialized payloads can be revalidated
+    # (and, when not personalized, reused)
+    if profiles is None and not debug:
+        try:
+            payload, complete = cached_emotion_payload(catalog, processed_emotion, emotion, seed, version, limit,
+                                                       offset, fields, ENGINE_DEADLINE), True
+        except IncompletePayload as e:
+            payload, complete = e.payload, False
+    else:
+        payload, complete = build_emotion_payload(catalog, processed_emotion, emotion, seed, version, limit, offset,
+                                                  fields, profiles, ENGINE_DEADLINE, debug, user)
+    response = Response(payload, mimetype='application/json')
+    if not complete:
+        return response
+    response.add_etag()
+    response.cache_control.no_cache = True
+    if profiles is not None:
+        # Holds the caller's favorites: not for shared caches
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+# Largest number of requests accepted in one /api/emotion/batch call
+MAX_BATCH_SIZE = 256
+
+def is_confidence(value):
+    """Whether ``value`` is a finite number (JSON bodies may carry NaN, Infinity or huge integers)"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+def read_emotion_mix(item):
+    """The {emotion: confidence} mix of a request ({"emotion": ...} or {"emotions": {...}}), None if malformed"""
+    mix = item.get('emotions')
+    if mix is None:
+        mix = {item['emotion']: 1.0} if item.get('emotion') else {}
+    if not isinstance(mix, dict) or not all(is_confidence(v) for v in mix.values()):
+        return None
+    return mix
+
+@api.route('/api/emotion/batch', methods=['POST'])
+def handle_emotion_batch():
+    """Recommendations for many users or mixed moods in one call.
+
+    Body: {"requests": [{"id": ..., "emotion": "sad"} or
+    {"id": ..., "emotions": {"sad": 0.6, "neutral": 0.4}}, ...], "limit": 15, "fields": [...]}
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('requests')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': 'A non-empty requests list is required'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'status': 'error', 'message': f'At most {MAX_BATCH_SIZE} requests per batch'}), 400
+
+    mixes, seeds = [], []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            return jsonify({'status': 'error', 'message': f'Request {i} must be an object'}), 400
+        mix = read_emotion_mix(item)
+        if mix is None:
+            return jsonify({'status': 'error', 'message': f'Request {i} emotions must map emotion to confidence'}), 400
+        try:
+            seeds.append(read_seed(item.get('seed')))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': f'Request {i} {e}'}), 400
+        mixes.append(mix)
+
+    try:
+        limit = read_limit(data)
+        fields = read_fields(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    engines = get_engines()
+    anime, book = engines['anime'][0], engines['book'][0]
+    # Both catalogs side by side; a batch is waited for in full
+    results, _ = engine_pool.run({
+        kind: partial(engine.select_batch, mixes, top_n=limit, seeds=seeds)
+        for kind, engine in (('anime', anime), ('book', book))
+    })
+    anime_results, book_results = results['anime'], results['book']
+
+    results = ','.join(
+        '{"id":' + json.dumps(item.get('id', i)) + ',"emotions":' + json.dumps(mix)
+        + ',"anime_recommendations":' + anime.to_json(*anime_recs, fields=fields)
+        + ',"book_recommendations":' + book.to_json(*book_recs, fields=fields) + '}'
+        for i, (item, mix, anime_recs, book_recs) in enumerate(zip(items, mixes, anime_results, book_results))
+    )
+    return Response('{"status":"success","results":[' + results + ']}', mimetype='application/json')
+
+# Longest accepted search query, in characters
+MAX_QUERY_LENGTH = 200
+# Title completions per kind: default and largest accepted ``limit``
+DEFAULT_SUGGESTIONS = 8
+MAX_SUGGESTIONS = 20
+# Seconds clients may reuse a completion list
+SUGGEST_MAX_AGE = 60
+
+def read_search(args):
+    """(query, kinds to search) of a search request; raises ``ValueError`` if malformed"""
+    query = args.get('q', '').strip()
+    if not query:
+        raise ValueError("q is required")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f"q must be at most {MAX_QUERY_LENGTH} characters")
+    engines = get_engines()
+    kind = args.get('kind')
+    if kind is not None and kind not in engines:
+        raise ValueError(f"Unknown kind '{kind}', expected one of {sorted(engines)}")
+    return query, [k for k in engines if kind in (None, k)]
+
+@api.route('/api/search', methods=['GET'])
+def search_catalog():
+    """Items whose title or description matches ``q``, best first. Optional: kind (anime or book),
+    emotion (only items tagged with it), limit and fields, as for /api/emotion.
+    """
+    try:
+        query, kinds = read_search(request.args)
+        limit = read_limit({})
+        fields = read_fields({})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    emotion = request.args.get('emotion')
+    engines = get_engines()
+    if emotion is not None:
+        names = sorted({name for kind in kinds for name in engines[kind][0].emotion_names})
+        key = emotion.lower().strip()
+        if engines[kinds[0]][0].emotion_map.get(key, key) not in names:
+            return jsonify({'status': 'error', 'message': f"Unknown emotion '{emotion}', expected one of {names}"}), 400
+    results = ''.join(
+        f',"{kind}_results":' + engines[kind][0].to_json(*engines[kind][0].search(query, emotion, limit), fields=fields)
+        for kind in kinds
+    )
+    return Response('{"status":"success","query":' + json.dumps(query) + results + '}', mimetype='application/json')
+
+@api.route('/api/search/suggest', methods=['GET'])
+def suggest_titles():
+    """Title autocomplete: titles starting with ``q`` (or with a word sequence starting with it), best rated
+    first. Optional: kind and limit (at most MAX_SUGGESTIONS).
+    """
+    try:
+        query, kinds = read_search(request.args)
+        limit = request.args.get('limit', DEFAULT_SUGGESTIONS, type=int)
+        if not 1 <= limit <= MAX_SUGGESTIONS:
+            raise ValueError(f"limit must be between 1 and {MAX_SUGGESTIONS}")
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    engines = get_engines()
+    response = jsonify({
         'status': 'success',
-        'emotion': emotion,
-        'anime_recommendations': [format_anime(a) for a in anime_recs],
-        'book_recommendations': [format_book(b) for b in book_recs]
+        'query': query,
+        **{f'{kind}_suggestions': engines[kind][0].complete_title(query, limit) for kind in kinds}
+    })
+    response.cache_control.public = True
+    response.cache_control.max_age = SUGGEST_MAX_AGE
+    return response
+
+@api.route('/api/favorites/invalidate', methods=['POST'])
+def invalidate_favorites():
+    """Drop the caller's cached profile after their favorites change: {"kind": optional}.
+
+    The user is the one of the Firebase ID token (``Authorization: Bearer``).
+    """
+    user, error = authenticate()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    if kind is not None and kind not in get_engines():
+        return jsonify({'status': 'error', 'message': f"Unknown kind '{kind}', expected one of {sorted(get_engines())}"}), 400
+    dropped = current_app.extensions['profiles'].invalidate(user, kind)
+    return jsonify({'status': 'success', 'dropped': dropped})
+
+# Seconds clients and proxies may reuse /api/available_emotions before revalidating
+EMOTIONS_MAX_AGE = 300
+
+@lru_cache(maxsize=4)
+def available_emotions_payload(catalog, version):
+    """Serialized /api/available_emotions body for one catalog version"""
+    return json.dumps({
+        'anime_emotions': sorted(catalog.engines['anime'][0].df['emotion'].unique()),
+        'book_emotions': sorted(catalog.engines['book'][0].df['emotion'].unique())
     })
 
-@app.route('/api/available_emotions', methods=['GET'])
+@api.route('/api/available_emotions', methods=['GET'])
 def get_available_emotions():
+    """Emotions of each catalog, computed once per catalog version; answers 304 to a matching If-None-Match"""
+    catalog = current_app.extensions['catalog']
+    response = Response(available_emotions_payload(catalog, catalog.version), mimetype='application/json')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = EMOTIONS_MAX_AGE
+    return response.make_conditional(request)
+
+@api.route('/api/similar/<kind>', methods=['POST'])
+@api.route('/api/similar/<kind>/<path:title>', methods=['GET'])
+def handle_similar(kind, title=None):
+    """More like this: items similar to one title (GET) or a blend of several (POST {"titles": [...]})"""
+    engines = get_engines()
+    if kind not in engines:
+        return jsonify({'status': 'error', 'message': f"Unknown kind '{kind}', expected one of {sorted(engines)}"}), 404
+    engine, format_item = engines[kind]
+
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    if title is not None:
+        titles = [title]
+    else:
+        titles = data.get('titles') or []
+        if isinstance(titles, str):
+            titles = [titles]
+        if not isinstance(titles, list) or not all(isinstance(t, str) for t in titles):
+            return jsonify({'status': 'error', 'message': 'titles must be a title or a list of titles'}), 400
+    if not titles:
+        return jsonify({'status': 'error', 'message': 'At least one title is required'}), 400
+
+    try:
+        limit = read_limit({})
+        fields = read_fields(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    positions, missing = engine.lookup_titles(titles)
+    if not positions:
+        return jsonify({'status': 'error', 'message': 'None of the titles are in the catalog', 'unknown_titles': missing}), 404
+
     return jsonify({
-        'anime_emotions': sorted(anime_df['emotion'].unique()),
-        'book_emotions': sorted(book_df['emotion'].unique())
+        'status': 'success',
+        'kind': kind,
+        'seeds': [engine.df['title'].iat[p] for p in positions],
+        'unknown_titles': missing,
+        'recommendations': [project(format_item(r), fields) for r in engine.get_similar(positions, top_n=limit)]
     })
 
+# Bearer token required for catalog updates; while it is unset the endpoint refuses every request
+CATALOG_TOKEN = os.getenv('CATALOG_TOKEN')
+
+@api.route('/api/catalog/<kind>', methods=['POST'])
+def handle_ingest(kind):
+    """Add or update catalog items without a restart: {"items": [{"title": ..., ...}, ...]}"""
+    if not CATALOG_TOKEN:
+        return jsonify({'status': 'error', 'message': 'Catalog updates are disabled (CATALOG_TOKEN is not set)'}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {CATALOG_TOKEN}'):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    catalog = current_app.extensions['catalog']
+    if kind not in catalog.engines:
+        return jsonify({'status': 'error', 'message': f"Unknown kind '{kind}', expected one of {sorted(catalog.engines)}"}), 404
+    try:
+        result = catalog.ingest(kind, (request.get_json(silent=True) or {}).get('items'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    # Older versions can no longer be requested
+    cached_emotion_payload.cache_clear()
+    return jsonify(result)
+
+# Live emotion-stream sessions (one per always-on camera client), in app.extensions['sessions']
+def get_sessions():
+    return current_app.extensions['sessions']
+
+def session_not_found(session_id):
+    return jsonify({'status': 'error', 'message': f"Unknown or expired session '{session_id}'"}), 404
+
+@api.route('/api/session', methods=['POST'])
+def create_session():
+    """Start a streaming session; post readings to /emotion and listen on /stream.
+
+    A signed-in caller (``Authorization: Bearer <Firebase ID token>``) gets
+    recommendations personalized with their favorites, as on /api/emotion.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        seed = read_seed(data.get('seed'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    user = None
+    if 'Authorization' in request.headers:
+        user, error = authenticate()
+        if error:
+            return error
+    session = get_sessions().create(seed=seed, user=user)
+    return jsonify({
+        'status': 'success',
+        'session_id': session.id,
+        'stream': f'/api/session/{session.id}/stream'
+    }), 201
+
+@api.route('/api/session/<session_id>/emotion', methods=['POST'])
+def session_emotion(session_id):
+    """Feed one detection into the session; recommendations are only rebuilt when the smoothed emotion changes"""
+    mix = read_emotion_mix(request.get_json(silent=True) or {})
+    reading = {}
+    for emotion, confidence in (mix or {}).items():
+        emotion = str(emotion).lower().strip()
+        emotion = get_engines()['anime'][0].emotion_map.get(emotion, emotion)
+        reading[emotion] = reading.get(emotion, 0) + confidence
+
+    # Held locked until saved: readings of one session may reach several worker processes at once
+    with get_sessions().update(session_id) as session:
+        if session is None:
+            return session_not_found(session_id)
+        if mix is None:
+            return jsonify({'status': 'error', 'message': 'emotions must map emotion to confidence'}), 400
+        changed = session.filter.update(reading)
+        if changed:
+            emotion = session.filter.emotion
+            catalog = current_app.extensions['catalog']
+            profiles = load_profiles(catalog, session.user) if session.user else None
+            payload, _ = build_emotion_payload(catalog, emotion, emotion, session.seed, profiles=profiles,
+                                               deadline=ENGINE_DEADLINE)
+            session.publish(payload)
+
+    return jsonify({
+        'status': 'success',
+        'emotion': session.filter.emotion,
+        'changed': changed,
+        'version': session.version
+    })
+
+@api.route('/api/session/<session_id>', methods=['GET'])
+def session_recommendations(session_id):
+    """Latest recommendations of a session, for clients that poll instead of streaming"""
+    session = get_sessions().get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    version, payload = session.version, session.payload
+    if payload is None:
+        return jsonify({'status': 'pending', 'version': 0})
+    return Response(f'{{"version":{version},' + payload[1:], mimetype='application/json')
+
+@api.route('/api/session/<session_id>/stream', methods=['GET'])
+def session_stream(session_id):
+    """Server-sent events: a 'recommendations' event each time the session's emotion changes.
+
+    The stream holds its request thread until the client leaves: run a
+    threaded worker class (see the README), not sync workers.
+    """
+    sessions = get_sessions()
+    if sessions.get(session_id) is None:
+        return session_not_found(session_id)
+    return Response(stream_events(sessions, session_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api.route('/api/session/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    if not get_sessions().remove(session_id):
+        return session_not_found(session_id)
+    return jsonify({'status': 'success'})
+
+def create_app(warmup=None, favorites=None, history=None, thumbnails=None, verify_token=None):
+    """Build the Flask app; the catalog is loaded according to ``warmup`` (see WARMUP).
+
+    ``favorites`` is the store of users' favorite titles (see favorites.py)
+    and ``history`` the store of captured emotions (see history.py), by
+    default the ones named by FAVORITES_STORE and HISTORY_STORE.
+    ``thumbnails`` is the ThumbnailCache of item images (see thumbnails.py).
+    ``verify_token`` maps an ID token to the user's email (raising
+    ``ValueError`` if invalid); by default Firebase Auth checks it.
+    """
+    # Imported here so importing this module stays cheap
+    from catalog import ENGINE_MODE, Catalog
+    from chat import chat_bp
+
+    warmup = warmup or WARMUP
+    if warmup not in WARMUP_MODES:
+        raise ValueError(f"Unknown warm-up mode '{warmup}', expected one of {WARMUP_MODES}")
+
+    app = Flask(__name__)
+    CORS(app)
+    app.config['WARMUP'] = warmup
+    app.before_request(start_timer)
+    app.after_request(record_request_time)
+    # Registered last so it runs first: the timing includes compression
+    app.after_request(compress_response)
+
+    catalog = Catalog()
+    app.extensions['catalog'] = catalog
+    app.extensions['sessions'] = SessionStore()
+    app.extensions['profiles'] = ProfileCache(favorites or default_store())
+    app.extensions['history'] = EmotionHistory(history or default_history_store())
+    app.extensions['verify_token'] = verify_token or verify_firebase_token
+    app.extensions['thumbnails'] = thumbnails or ThumbnailCache()
+    if PREFETCH_TOP_N:
+        app.extensions['thumbnails'].prefetch_when_ready(catalog)
+    # The chat blueprint answers recommendation requests from the engines (once loaded)
+    app.extensions['engines'] = catalog.engines
+
+    @app.route('/')
+    def index():
+        return {"message": "Mood Conexus API is running."}
+
+    @app.route('/healthz')
+    def healthz():
+        """Liveness: the process answers requests, whether or not the catalog is loaded"""
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        """Readiness: 200 once the catalog is loaded, 503 while it loads or if loading failed"""
+        if catalog.ready:
+            return jsonify({
+                'status': 'ready',
+                'catalog_version': catalog.version,
+                'engine_mode': ENGINE_MODE,
+                'items': {kind: len(engine.df) for kind, (engine, _) in catalog.engines.items()},
+                'load_seconds': round(catalog.load_seconds, 3)
+            })
+        if catalog.error is not None:
+            return jsonify({'status': 'error', 'message': catalog.error}), 503
+        if warmup == 'lazy' and not catalog.warming:
+            # The first probe starts loading
+            catalog.warm_in_background()
+        return jsonify({'status': 'loading'}), 503
+
+    @app.route('/metrics')
+    def metrics():
+        """Stage and request latency histograms in the Prometheus text format"""
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    app.register_blueprint(api)
+    app.register_blueprint(chat_bp)
+    app.register_blueprint(history_bp)
+    app.register_blueprint(thumbnails_bp)
+
+    if warmup == 'eager':
+        # Freeze the loaded objects so workers forked from a preloading master share their pages
+        catalog.warm(freeze=True)
+    elif warmup == 'background':
+        catalog.warm_in_background()
+    return app
+
 if __name__ == '__main__':
-   
+    # WARMUP=lazy|background|eager python app.py; in production run e.g.
+    #   WARMUP=eager gunicorn --preload -w 4 -k gthread --threads 32 -b 0.0.0.0:5000 'app:create_app()'
+    app = create_app()
     print("\n=== MoodConexus Backend Starting ===")
-    print("Available emotions:")
-    print(f"Anime: {sorted(anime_df['emotion'].unique())}")
-    print(f"Books: {sorted(book_df['emotion'].unique())}")
+    print(f"Catalog warm-up: {app.config['WARMUP']} (see /readyz)")
     print("Server running on http://localhost:5000")
     print("Waiting for emotion data from frontend...\n")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=True)
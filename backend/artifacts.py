@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+from scipy.sparse import csr_matrix, issparse
+
+# Raw arrays that make up a stored CSR matrix, one .npy file each
+CSR_PARTS = ('data', 'indices', 'indptr', 'shape')
+
+# Bump when the bundle layout changes so old bundles are rebuilt
+BUNDLE_VERSION = 2
+# Extra arrays that belong to a fitted model rather than having one row per item
+MODEL_ARRAYS = ('lsa_projection',)
+# Extra sparse matrices stored term-major (one row per vocabulary term, one column per item)
+TERM_MAJOR_MATRICES = ('postings',)
+
+
+def save_csr(matrix, directory):
+    """Write a sparse matrix as float32/int32 .npy arrays (data/indices/indptr/shape)"""
+    matrix = csr_matrix(matrix)
+    matrix.sort_indices()
+    os.makedirs(directory, exist_ok=True)
+
+    # int32 indices are enough until the matrix holds 2**31 non-zeros
+    index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+    arrays = {
+        'data': matrix.data.astype(np.float32),
+        'indices': matrix.indices.astype(index_dtype),
+        'indptr': matrix.indptr.astype(index_dtype),
+        'shape': np.asarray(matrix.shape, dtype=np.int64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+
+
+def load_csr(directory, mmap=True):
+    """Open a matrix written by save_csr.
+
+    With ``mmap=True`` the arrays stay backed by the files (``mmap_mode='r'``),
+    so every worker process on the node shares one page-cache copy instead of
+    holding a private one on its heap.
+    """
+    mmap_mode = 'r' if mmap else None
+    arrays = {
+        name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+        for name in CSR_PARTS
+    }
+    shape = tuple(int(n) for n in arrays['shape'])
+    return csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+
+def dataset_hash(features):
+    """Hash of the text a vectorizer is fitted on"""
+    hashes = pd.util.hash_pandas_object(features, index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def write_bundle(directory, vectorizer, tfidf_matrix, data_hash, params, arrays=None):
+    """Atomically write a model bundle: vectorizer, CSR matrix, extra arrays and manifest.
+
+    Everything is written to a temp dir next to ``directory`` and renamed into
+    place, so readers see either the old bundle or the complete new one.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.bundle-', dir=parent)
+    try:
+        dump(vectorizer, os.path.join(tmp_dir, 'vectorizer.joblib'))
+        save_csr(tfidf_matrix, os.path.join(tmp_dir, 'tfidf'))
+        # Per-item arrays derived from the matrix (e.g. the neighbour index), MODEL_ARRAYS and
+        # TERM_MAJOR_MATRICES (sparse, stored like the TF-IDF matrix)
+        arrays = arrays or {}
+        for name, array in arrays.items():
+            if issparse(array):
+                save_csr(array, os.path.join(tmp_dir, name))
+            else:
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        manifest = {
+            'version': BUNDLE_VERSION,
+            'dataset_hash': data_hash,
+            'vectorizer_params': params,
+            'vocabulary_size': len(vectorizer.vocabulary_),
+            'shape': list(tfidf_matrix.shape),
+            'nnz': int(tfidf_matrix.nnz),
+            'arrays': {name: list(array.shape) for name, array in arrays.items() if not issparse(array)},
+            'matrices': {name: list(array.shape) for name, array in arrays.items() if issparse(array)},
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        # A non-empty directory can't be replaced in one rename: move the old one aside first
+        old_dir = None
+        if os.path.exists(directory):
+            old_dir = tempfile.mkdtemp(prefix='.bundle-old-', dir=parent)
+            os.replace(directory, os.path.join(old_dir, 'bundle'))
+        os.replace(tmp_dir, directory)
+        if old_dir:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def load_bundle(directory, data_hash, params):
+    """Load and validate a bundle written by write_bundle.
+
+    Returns ``(vectorizer, tfidf_matrix, arrays)``, with any stored sparse
+    matrices memory-mapped in ``arrays`` like the TF-IDF matrix. Raises
+    ``FileNotFoundError`` if there is no bundle and ``ValueError`` if it is
+    stale (other dataset, params or layout version) or inconsistent.
+    """
+    manifest = read_manifest(directory)
+    if manifest.get('version') != BUNDLE_VERSION:
+        raise ValueError(f"bundle version {manifest.get('version')} != {BUNDLE_VERSION}")
+    if manifest.get('dataset_hash') != data_hash:
+        raise ValueError("dataset changed since the bundle was built")
+    if manifest.get('vectorizer_params') != params:
+        raise ValueError(f"vectorizer params changed: {manifest.get('vectorizer_params')} != {params}")
+
+    vectorizer = load(os.path.join(directory, 'vectorizer.joblib'))
+    tfidf_matrix = load_csr(os.path.join(directory, 'tfidf'))
+
+    # Cross-check the artifacts against each other and the manifest
+    if list(tfidf_matrix.shape) != manifest['shape'] or tfidf_matrix.nnz != manifest['nnz']:
+        raise ValueError(f"matrix shape {tfidf_matrix.shape} does not match manifest {manifest['shape']}")
+    if len(vectorizer.vocabulary_) != manifest['vocabulary_size'] or tfidf_matrix.shape[1] != manifest['vocabulary_size']:
+        raise ValueError("vocabulary size does not match the matrix")
+
+    arrays = {}
+    for name, shape in manifest.get('arrays', {}).items():
+        arrays[name] = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        # Per-item arrays have one row per item; a model array's last axis is the vocabulary
+        axis, size = (-1, tfidf_matrix.shape[1]) if name in MODEL_ARRAYS else (0, tfidf_matrix.shape[0])
+        if list(arrays[name].shape) != shape or shape[axis] != size:
+            raise ValueError(f"array {name} has shape {arrays[name].shape}, expected {shape}")
+    for name, shape in manifest.get('matrices', {}).items():
+        arrays[name] = load_csr(os.path.join(directory, name))
+        expected = tfidf_matrix.shape[::-1] if name in TERM_MAJOR_MATRICES else tfidf_matrix.shape
+        if list(arrays[name].shape) != shape or arrays[name].shape != expected:
+            raise ValueError(f"matrix {name} has shape {arrays[name].shape}, expected {shape}")
+
+    return vectorizer, tfidf_matrix, arrays
+
+
+def memory_usage():
+    """Resident memory of this process in MB, split into private (anon) and file-backed pages, plus the peak (VmHWM)"""
+    usage = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM', 'RssAnon', 'RssFile'):
+                    usage[key] = int(value.split()[0]) / 1024
+    except OSError:
+        # Not Linux: fall back to the peak RSS reported by getrusage
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['VmRSS'] = usage['VmHWM'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return usage
+
+
+def _measure(mode, path):
+    """Child process: load one matrix with the given method, touch it, and print memory usage"""
+    before = memory_usage()
+    if mode == 'joblib':
+        matrix = load(path)
+    else:
+        matrix = load_csr(path)
+    # Touch every page, as the engines do when they score the catalog
+    float(matrix.data.sum()), int(matrix.indices.sum())
+    after = memory_usage()
+    print(' '.join(
+        f"{key}={after.get(key, 0) - before.get(key, 0):.1f}"
+        for key in ('VmRSS', 'RssAnon', 'RssFile')
+    ))
+
+
+def compare_rss(csr_dir):
+    """Print the per-process memory cost of a stored matrix loaded from a joblib pickle vs memory-mapped.
+
+    The pickle is a temporary copy of the matrix, written for the comparison.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        joblib_path = os.path.join(tmp_dir, 'matrix.joblib')
+        dump(load_csr(csr_dir, mmap=False), joblib_path)
+        print(f"{'format':<10} {'RSS MB':>8} {'private MB':>11} {'shared MB':>10}")
+        for mode, path in (('joblib', joblib_path), ('mmap', csr_dir)):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--measure', mode, path],
+                capture_output=True, text=True, check=True
+            ).stdout.strip().splitlines()[-1]
+            values = dict(item.split('=') for item in out.split())
+            print(f"{mode:<10} {float(values['VmRSS']):>8.1f} {float(values['RssAnon']):>11.1f} "
+                  f"{float(values['RssFile']):>10.1f}")
+
+
+if __name__ == '__main__':
+    # python artifacts.py convert matrix.joblib /tmp/matrix
+    # python artifacts.py compare models/anime/tfidf
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        _measure(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        save_csr(load(sys.argv[2]), sys.argv[3])
+        print(f"Wrote {sys.argv[3]}")
+    elif len(sys.argv) == 3 and sys.argv[1] == 'compare':
+        compare_rss(sys.argv[2])
+    else:
+        print("usage: python artifacts.py convert <matrix.joblib> <csr dir> | compare <csr dir>")
+        sys.exit(1)
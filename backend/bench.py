@@ -0,0 +1,288 @@
+"""Startup and request benchmarks on synthetic catalogs.
+
+    python bench.py run --sizes 10000,100000,1000000 --out bench_results.json
+    python bench.py compare old.json new.json
+
+Each catalog size gets its own working directory holding a Parquet snapshot
+of a synthetic catalog (see synthetic.py), and every phase runs in a fresh
+subprocess so start-up time and peak RSS are not skewed by earlier runs:
+
+- ``first_boot``: creating the app with no model bundles (fit + neighbour index)
+- ``warm``: creating the app again with the bundles on disk, then timing each
+  start-up stage on its own and the request path through the Flask test client
+
+Phases inherit the environment, so ``ENGINE_MODE=lsa python bench.py run``
+benchmarks the low-rank scoring mode (see lsa.py for a recall comparison).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+from artifacts import memory_usage
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+EMOTIONS = ('happy', 'sad', 'anger', 'fear', 'surprise', 'disgust', 'neutral')
+# Prefix of the result line a phase subprocess prints
+RESULT_MARKER = 'BENCH '
+
+
+@contextmanager
+def stage(results, name, trace=False):
+    """Record wall time, RSS after and peak RSS (plus peak traced allocations) of a block"""
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    usage = memory_usage()
+    results[name] = {
+        'seconds': round(elapsed, 4),
+        'rss_mb': round(usage.get('VmRSS', 0), 1),
+        'peak_rss_mb': round(usage.get('VmHWM', 0), 1),
+    }
+    if trace:
+        results[name]['alloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+
+
+def time_calls(call, n_requests, warmup=10, alloc_samples=50):
+    """Latency percentiles of ``call(emotion)`` over the emotions, and allocations per call"""
+    for i in range(warmup):
+        call(EMOTIONS[i % len(EMOTIONS)])
+
+    latencies = []
+    for i in range(n_requests):
+        start = time.perf_counter()
+        call(EMOTIONS[i % len(EMOTIONS)])
+        latencies.append(time.perf_counter() - start)
+    latencies = np.asarray(latencies) * 1000
+
+    # Peak memory allocated while serving one call, traced separately from the timings
+    tracemalloc.start()
+    peaks = []
+    for i in range(alloc_samples):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        call(EMOTIONS[i % len(EMOTIONS)])
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return {
+        'requests': n_requests,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'alloc_kb_per_call': round(float(np.mean(peaks)) / 1024, 1),
+        'peak_rss_mb': round(memory_usage().get('VmHWM', 0), 1),
+    }
+
+
+def setup_workdir(workdir, size, seed):
+    """Write a synthetic catalog of ``size`` rows per kind as the dataset snapshot of ``workdir``"""
+    from dataset import ANIME_SOURCE, BOOK_SOURCE, SNAPSHOT_DIR, source_hash, build_snapshot
+    from synthetic import make_catalog
+
+    os.chdir(workdir)
+    # The snapshot is keyed by the source files; these stand in for the XLSX
+    for path in (ANIME_SOURCE, BOOK_SOURCE):
+        with open(path, 'w') as f:
+            f.write(f"synthetic {path} rows={size} seed={seed}\n")
+    start = time.perf_counter()
+    anime_df, book_df = make_catalog(size, seed=seed)
+    generated = time.perf_counter() - start
+    build_snapshot(anime_df, book_df, source_hash(ANIME_SOURCE, BOOK_SOURCE), SNAPSHOT_DIR)
+    return {'rows': {'anime': len(anime_df), 'book': len(book_df)}, 'generate_seconds': round(generated, 2)}
+
+
+def run_phase(phase, workdir, n_requests, trace):
+    """Body of one phase subprocess; returns its results"""
+    os.chdir(workdir)
+    results = {}
+    with stage(results, 'cold_start', trace):
+        import app
+        application = app.create_app('eager')
+    logging.disable(logging.CRITICAL)
+    if phase == 'first_boot':
+        return results
+
+    # Each start-up stage again, on its own, against the files the first start-up left behind
+    from catalog import ENGINE_MODE, load_or_build_model
+    from lsa import LSA_COMPONENTS
+    from dataset import load_data
+    from engine import FORMATTERS, RecommendationEngine
+    with stage(results, 'load_data', trace):
+        frames = dict(zip(('anime', 'book'), load_data()))
+    with stage(results, 'initialize_models', trace):
+        lsa_components = LSA_COMPONENTS if ENGINE_MODE == 'lsa' else None
+        models = {kind: load_or_build_model(kind, df, lsa_components) for kind, df in frames.items()}
+    with stage(results, 'build_engines', trace):
+        for kind, (vectorizer, tfidf, neighbors, lsa, postings) in models.items():
+            RecommendationEngine(frames[kind], vectorizer, tfidf, neighbors=neighbors, format_item=FORMATTERS[kind],
+                                 lsa=lsa, postings=postings)
+    if trace:
+        return results
+
+    engines = application.extensions['catalog'].engines
+    anime_engine, book_engine = engines['anime'][0], engines['book'][0]
+    results['get_recommendations'] = time_calls(
+        lambda emotion: (anime_engine.get_recommendations(emotion), book_engine.get_recommendations(emotion)),
+        n_requests
+    )
+    client = application.test_client()
+
+    def post_emotion(emotion):
+        response = client.post('/api/emotion', json={'emotion': emotion})
+        assert response.status_code == 200, response.status_code
+    results['api_emotion'] = time_calls(post_emotion, n_requests)
+    return results
+
+
+def spawn(args, timeout):
+    """Run this script as a subprocess and return the results it reports"""
+    try:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)] + args,
+            capture_output=True, text=True, timeout=timeout, cwd=BACKEND_DIR,
+            # Synthetic thumbnail URLs point nowhere; don't fetch them in the background even if enabled
+            env=dict(os.environ, THUMBNAIL_PREFETCH='0')
+        )
+    except subprocess.TimeoutExpired:
+        return {'error': f'timed out after {timeout}s'}
+    for line in reversed(out.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    return {'error': (out.stderr.strip().splitlines() or ['no output'])[-1]}
+
+
+def merge_allocations(results, traced):
+    for name, values in traced.items():
+        if name in results and 'alloc_peak_mb' in values:
+            results[name]['alloc_peak_mb'] = values['alloc_peak_mb']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=BACKEND_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes, out_path, n_requests, seed, timeout, allocations, keep):
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'requests': n_requests,
+            'seed': seed,
+            'engine_mode': os.getenv('ENGINE_MODE', 'tfidf'),
+        },
+        'results': {},
+    }
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix=f'bench-{size}-')
+        print(f"== {size} rows ({workdir})", flush=True)
+        try:
+            result = {'setup': spawn(['_setup', workdir, str(size), str(seed)], timeout)}
+            for phase in ('first_boot', 'warm'):
+                if phase == 'first_boot':
+                    shutil.rmtree(os.path.join(workdir, 'models', 'anime'), ignore_errors=True)
+                    shutil.rmtree(os.path.join(workdir, 'models', 'book'), ignore_errors=True)
+                result[phase] = spawn(['_phase', phase, workdir, str(n_requests)], timeout)
+                print(f"   {phase}: {json.dumps(result[phase])}", flush=True)
+            if allocations and 'error' not in result['warm']:
+                for phase in ('first_boot', 'warm'):
+                    if phase == 'first_boot':
+                        shutil.rmtree(os.path.join(workdir, 'models', 'anime'), ignore_errors=True)
+                        shutil.rmtree(os.path.join(workdir, 'models', 'book'), ignore_errors=True)
+                    merge_allocations(result[phase], spawn(['_phase', phase, workdir, '0', '--trace'], timeout))
+        finally:
+            if keep:
+                print(f"   kept {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+        report['results'][str(size)] = result
+
+        # Written after every size so a long run can be inspected while it goes
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Wrote {out_path}")
+
+
+def _leaves(tree, path=()):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from _leaves(value, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield '.'.join(path + (key,)), value
+
+
+def compare(old_path, new_path):
+    """Print every metric of two reports side by side with the new/old ratio"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_values = dict(_leaves(old['results']))
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    print(f"{'metric':<52} {'old':>10} {'new':>10} {'ratio':>7}")
+    for key, value in _leaves(new['results']):
+        if key not in old_values:
+            continue
+        before = old_values[key]
+        ratio = f"{value / before:.2f}" if before else '-'
+        print(f"{key:<52} {before:>10} {value:>10} {ratio:>7}")
+
+
+def main(argv):
+    # Internal entry points of the per-phase subprocesses
+    if argv[:1] == ['_setup']:
+        print(RESULT_MARKER + json.dumps(setup_workdir(argv[1], int(argv[2]), int(argv[3]))))
+        return
+    if argv[:1] == ['_phase']:
+        sys.path.insert(0, BACKEND_DIR)
+        results = run_phase(argv[1], argv[2], int(argv[3]), '--trace' in argv)
+        print(RESULT_MARKER + json.dumps(results))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='benchmark synthetic catalogs of the given sizes')
+    run_parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='comma-separated rows per catalog (default: %(default)s)')
+    run_parser.add_argument('--out', default='bench_results.json')
+    run_parser.add_argument('--requests', type=int, default=200, help='timed calls per request stage')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--timeout', type=int, default=3600, help='seconds allowed per phase')
+    run_parser.add_argument('--no-allocations', action='store_true',
+                            help='skip the traced pass that measures start-up allocations')
+    run_parser.add_argument('--keep', action='store_true', help='keep the working directories')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        compare(args.old, args.new)
+    else:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        run(sizes, args.out, args.requests, args.seed, args.timeout, not args.no_allocations, args.keep)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
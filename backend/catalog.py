@@ -0,0 +1,261 @@
+import gc
+import os
+import time
+import logging
+import threading
+from sklearn.feature_extraction.text import TfidfVectorizer
+from artifacts import dataset_hash, load_bundle, write_bundle
+from dataset import load_data
+from neighbors import build_neighbors, patch_neighbors
+from ingest import (apply_overlay, catalog_lock, merge_items, prepare_items, read_generation, save_overlay,
+                    transform_rows, write_generation)
+from engine import FORMATTERS, RecommendationEngine
+from lsa import LSA_COMPONENTS, fit_lsa
+from search import build_postings
+
+logger = logging.getLogger(__name__)
+
+# TF-IDF settings; a change here triggers a rebuild of both model bundles
+VECTORIZER_PARAMS = {'stop_words': 'english', 'max_features': 5000}
+# Neighbours kept per item for the "more like this" endpoint
+NEIGHBOR_K = 20
+# Where the versioned model bundles live, one directory per kind
+MODEL_DIR = 'models'
+# How engines score items: 'tfidf' (exact) or 'lsa' (dense low-rank embedding, see lsa.py)
+ENGINE_MODE = os.getenv('ENGINE_MODE', 'tfidf')
+ENGINE_MODES = ('tfidf', 'lsa')
+# Seconds between checks for catalog updates persisted by other worker processes
+RELOAD_CHECK_SECONDS = float(os.getenv('CATALOG_RELOAD_CHECK_SECONDS', 2))
+
+
+def load_or_build_model(name, df, lsa_components=None):
+    """Load the model bundle for one corpus, refitting it only if it is missing or stale.
+
+    With ``lsa_components`` the bundle also holds an LSA projection of that
+    size, fitted (and saved) if missing; it is returned as ``(projection,
+    embedding)``, else None. The search postings (the term-major matrix) are
+    built and saved the same way when a bundle lacks them.
+    """
+    start = time.perf_counter()
+    directory = os.path.join(MODEL_DIR, name)
+    data_hash = dataset_hash(df['features'])
+
+    try:
+        vectorizer, tfidf, arrays = load_bundle(directory, data_hash, VECTORIZER_PARAMS)
+        if 'neighbor_indices' not in arrays or arrays['neighbor_indices'].shape[1] != min(NEIGHBOR_K, len(df) - 1):
+            raise ValueError(f"neighbour index missing or not built with k={NEIGHBOR_K}")
+        action = 'Loaded'
+    except FileNotFoundError:
+        logger.info("No %s model bundle in %s, building it", name, directory)
+        action = 'Built'
+    except Exception as e:
+        logger.warning("Rebuilding %s model bundle: %s", name, e)
+        action = 'Rebuilt'
+
+    if action != 'Loaded':
+        vectorizer = TfidfVectorizer(**VECTORIZER_PARAMS)
+        tfidf = vectorizer.fit_transform(df['features'])
+        neighbor_indices, neighbor_scores = build_neighbors(tfidf, k=NEIGHBOR_K)
+        arrays = {'neighbor_indices': neighbor_indices, 'neighbor_scores': neighbor_scores}
+
+    lsa_components = lsa_components and min(lsa_components, min(tfidf.shape) - 1)
+    refit_lsa = bool(lsa_components) and (
+        'lsa_projection' not in arrays or arrays['lsa_projection'].shape[0] != lsa_components)
+    if refit_lsa:
+        arrays = dict(arrays)
+        arrays['lsa_projection'], arrays['lsa_embedding'] = fit_lsa(tfidf, lsa_components)
+
+    missing_postings = 'postings' not in arrays
+    if missing_postings:
+        arrays = dict(arrays)
+        arrays['postings'] = build_postings(tfidf)
+
+    if action != 'Loaded' or refit_lsa or missing_postings:
+        write_bundle(directory, vectorizer, tfidf, data_hash, VECTORIZER_PARAMS, arrays)
+        # Reopen so the arrays are memory-mapped like loaded ones
+        vectorizer, tfidf, arrays = load_bundle(directory, data_hash, VECTORIZER_PARAMS)
+
+    logger.info("%s %s model (%d items) in %.3fs", action, name, tfidf.shape[0], time.perf_counter() - start)
+    lsa = (arrays['lsa_projection'], arrays['lsa_embedding']) if lsa_components else None
+    return vectorizer, tfidf, (arrays['neighbor_indices'], arrays['neighbor_scores']), lsa, arrays['postings']
+
+
+def load_engines(mode=ENGINE_MODE):
+    """Engine and response formatter per catalog kind, from the dataset snapshot, ingested items and model bundles"""
+    if mode not in ENGINE_MODES:
+        raise ValueError(f"ENGINE_MODE must be one of {', '.join(ENGINE_MODES)}, not {mode!r}")
+    frames = dict(zip(('anime', 'book'), load_data()))
+    engines = {}
+    for kind, df in frames.items():
+        # Items added through the ingestion API since the XLSX was last edited
+        df = apply_overlay(kind, df)
+        vectorizer, tfidf, neighbors, lsa, postings = load_or_build_model(
+            kind, df, LSA_COMPONENTS if mode == 'lsa' else None)
+        engines[kind] = (RecommendationEngine(df, vectorizer, tfidf, neighbors=neighbors, format_item=FORMATTERS[kind],
+                                              lsa=lsa, postings=postings), FORMATTERS[kind])
+    return engines
+
+
+class Catalog:
+    """The live engines of both catalogs: loaded once, then replaced entry by entry on updates.
+
+    ``engines`` is filled in place when loading finishes, so it can be
+    handed out (e.g. to the chat blueprint) before the catalog is ready.
+    Catalog updates replace an entry with a new engine, so request code
+    looks engines up there on each call.
+
+    ``version`` is the generation of the persisted catalog, shared by all
+    worker processes: an update made through one worker bumps it on disk,
+    and the others reload (``check_for_updates``) so their versions, and
+    the cursors and ETags built from them, agree again.
+    """
+
+    def __init__(self):
+        self.engines = {}
+        # Generation of the loaded catalog; part of the payload cache key
+        self.version = 0
+        self.error = None
+        self.load_seconds = None
+        self.loaded = threading.Event()
+        self.warming = False
+        self.reloading = False
+        self.checked_at = 0.0
+        # Serializes loading and catalog updates (requests never take it)
+        self.lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def ready(self):
+        return self.loaded.is_set()
+
+    def warm(self, freeze=False):
+        """Load the engines unless already loaded; blocks until they are (or loading failed).
+
+        ``freeze`` moves everything loaded so far out of the garbage collector's
+        reach, so forked workers don't touch (and copy) the shared pages.
+        """
+        with self.lock:
+            if self.ready:
+                return
+            start = time.perf_counter()
+            try:
+                with catalog_lock(shared=True):
+                    generation = read_generation()
+                    self.engines.update(load_engines())
+                self.version = generation
+            except Exception as e:
+                logger.exception("Catalog warm-up failed")
+                self.error = f"{type(e).__name__}: {e}"
+                raise
+            self.error = None
+            self.load_seconds = time.perf_counter() - start
+            self.loaded.set()
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        logger.info("Catalog ready in %.2fs", self.load_seconds)
+
+    def warm_in_background(self):
+        """Start loading in a daemon thread and return at once"""
+        self.warming = True
+        threading.Thread(target=self._warm_quietly, name='catalog-warmup', daemon=True).start()
+
+    def _warm_quietly(self):
+        try:
+            self.warm()
+        except Exception:
+            pass  # kept in self.error for the readiness probe
+        finally:
+            self.warming = False
+
+    def _after_fork(self):
+        # Threads don't survive fork: a worker forked mid warm-up starts its own
+        self.lock = threading.Lock()
+        self.reloading = False
+        if self.warming and not self.ready:
+            self.warm_in_background()
+
+    def check_for_updates(self):
+        """Reload in the background if another process persisted a newer catalog.
+
+        Cheap enough to call on every request: the generation file is read at
+        most every RELOAD_CHECK_SECONDS, and requests keep the loaded engines
+        until the reloaded ones are swapped in.
+        """
+        now = time.monotonic()
+        if not self.ready or self.reloading or now - self.checked_at < RELOAD_CHECK_SECONDS:
+            return
+        self.checked_at = now
+        if read_generation() == self.version:
+            return
+        self.reloading = True
+        threading.Thread(target=self._reload, name='catalog-reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            # The file lock is released before self.lock is taken, the order ingest takes them in
+            with catalog_lock(shared=True):
+                generation = read_generation()
+                engines = load_engines()
+            with self.lock:
+                if generation > self.version:
+                    self.engines.update(engines)
+                    self.version = generation
+                    logger.info("Reloaded catalog version %d persisted by another process", generation)
+        except Exception:
+            logger.exception("Catalog reload failed, still serving version %d", self.version)
+        finally:
+            self.reloading = False
+
+    def ingest(self, kind, records):
+        """Upsert items into one catalog and atomically swap in the updated engine.
+
+        New rows are projected onto the fitted vocabulary (no refit), the
+        neighbour index and engine are patched, and the result replaces the
+        live engine in one dict assignment; requests already running finish on
+        the old engine. The bundle and ingested items are then persisted so a
+        restart loads the same catalog without refitting, and the generation
+        bumped so other worker processes reload it. Updates from all processes
+        are serialized by the catalog file lock.
+        """
+        start = time.perf_counter()
+        items = prepare_items(kind, records)
+        with self.lock, catalog_lock():
+            generation = read_generation()
+            if generation != self.version:
+                # Another process updated the catalog since this one loaded it: apply on top of that
+                self.engines.update(load_engines())
+                self.version = generation
+            engine, format_item = self.engines[kind]
+            df, positions = merge_items(engine.df, items, kind)
+            tfidf = transform_rows(engine.tfidf_matrix, engine.vectorizer, df['features'].iloc[positions], positions)
+            neighbors = engine.neighbors or build_neighbors(engine.tfidf_matrix, k=NEIGHBOR_K)
+            neighbors = patch_neighbors(tfidf, *neighbors, positions)
+            updated_engine = engine.apply_changes(df, tfidf, neighbors, positions)
+
+            self.engines[kind] = (updated_engine, format_item)
+            self.version = generation + 1
+            swapped = time.perf_counter()
+
+            save_overlay(kind, items)
+            arrays = {'neighbor_indices': neighbors[0], 'neighbor_scores': neighbors[1],
+                      'postings': updated_engine.search_index.full_postings(tfidf)}
+            if updated_engine.embedding is not None:
+                arrays.update(lsa_projection=updated_engine.projection, lsa_embedding=updated_engine.embedding)
+            write_bundle(os.path.join(MODEL_DIR, kind), engine.vectorizer, tfidf, dataset_hash(df['features']),
+                         VECTORIZER_PARAMS, arrays)
+            write_generation(self.version)
+
+        added = int((positions >= len(engine.df)).sum())
+        logger.info("Ingested %d %s items (%d new, %d rows updated) in %.1fms", len(items), kind, added,
+                    len(positions) - added, (swapped - start) * 1000)
+        return {
+            'status': 'success',
+            'kind': kind,
+            'added': added,
+            'updated': len(positions) - added,
+            'items': len(df),
+            'swap_ms': round((swapped - start) * 1000, 2),
+            'total_ms': round((time.perf_counter() - start) * 1000, 2)
+        }
@@ -1,16 +1,84 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import os
-from dotenv import load_dotenv  
+import json
+import logging
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from sessions import sse_event
+from intents import detect_intent
+from metrics import register_collector, timed
 
 #  Load environment variables from .env file
 load_dotenv()
 
 #  Securely get the API key from environment
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Any OpenAI-compatible chat completions endpoint (e.g. a local fake server in tests)
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+
+# Seconds to open the connection / to wait between bytes of the response
+CONNECT_TIMEOUT = float(os.getenv("CHAT_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("CHAT_READ_TIMEOUT", 20))
+# Retries of failed connections and 429/5xx answers, with exponential backoff.
+# Read timeouts are not retried: a slow upstream would only hold the worker longer.
+MAX_RETRIES = int(os.getenv("CHAT_MAX_RETRIES", 2))
+
+# Cached replies kept (LRU) and how long one stays valid, in seconds
+CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", 1024))
+CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", 3600))
+
+MODEL = "llama3-8b-8192"
+SYSTEM_PROMPT = (
+    "You are a helpful and friendly assistant for an emotion-based recommendation website called MoodConexus.\n"
+    "- If a user expresses feeling sad, give a short 💡 motivational quote 🧠💪.\n"
+    "- If the user asks for a suggestion, give either an anime 🎥 or book 📚 (or both) based on the emotion in their message.\n"
+    "- Keep your replies short, clear, and kind.\n"
+    "- Be emotion-aware: respond differently for sadness 😢, happiness 😄, or excitement😊✨.\n"
+    "- Always respond naturally to what the user says without asking unnecessary questions.\n"
+    "- Format your reply cleanly using line breaks.\n"
+    "- When recommending anime, suggest they can watch it on https://9animetv.to/ 🎬.\n"
+    "- When recommending books, suggest they can download from https://oceanofpdf.com/ 📖.\n"
+)
+MAX_TOKENS = 200
+TEMPERATURE = 0.7
+
+# Catalog picks per kind in a locally answered recommendation chat
+LOCAL_PICKS = 3
+
+GREETING = "Hi! How can I help with anime or book suggestions today?"
+UNAVAILABLE = "MoodConexus Bot is temporarily unavailable. Please try again."
+FAILED = "Something went wrong while generating response."
 
 chat_bp = Blueprint('chat', __name__)
+logger = logging.getLogger(__name__)
+
+
+def create_session(max_retries=MAX_RETRIES, pool_size=10):
+    """Keep-alive HTTP session for the upstream API, shared by all requests of the process"""
+    retry = Retry(
+        total=max_retries,
+        read=False,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size))
+    session.mount('http://', HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+
+http = create_session()
 
 
 def format_reply(text):
@@ -23,56 +91,343 @@ def format_reply(text):
     return clean_text.strip()
 
 
-@chat_bp.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
-    user_input = data.get('message', '').strip()
+class ReplyFormatter:
+    """Applies format_reply to a reply that arrives in pieces.
 
-    if not user_input:
-        return jsonify({"reply": "Hi! How can I help with anime or book suggestions today?"})
+    Each ``feed`` returns the newly formatted text that can be shown. Text is
+    only released up to the last whitespace and outside an open ``**`` pair,
+    and only while the formatted output still extends what was already sent;
+    anything held back is settled by ``reply()`` once the stream ends.
+    """
 
-    try:
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
+    def __init__(self):
+        self.raw = ''
+        self.sent = ''
+
+    def feed(self, chunk):
+        self.raw += chunk
+        cut = max(self.raw.rfind(' '), self.raw.rfind('\n'))
+        stable = self.raw[:cut + 1]
+        if cut < 0 or stable.count('**') % 2:
+            return ''
+        formatted = format_reply(stable)
+        if not formatted.startswith(self.sent) or len(formatted) == len(self.sent):
+            return ''
+        delta = formatted[len(self.sent):]
+        self.sent = formatted
+        return delta
+
+    def reply(self):
+        return format_reply(self.raw)
+
+
+def completion_request(user_input, stream=False):
+    """Body of a chat completions call for one user message"""
+    return {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": user_input
+            }
+        ],
+        "max_tokens": MAX_TOKENS,
+        "temperature": TEMPERATURE,
+        "stop": None,
+        "stream": stream
+    }
+
+
+def post_completion(user_input, stream=False):
+    """Call the completions API; a streamed call is timed up to the response headers"""
+    with timed('chat_upstream'):
+        return http.post(
+            GROQ_API_URL,
             headers={
                 "Authorization": f"Bearer {GROQ_API_KEY}",
                 "Content-Type": "application/json"
             },
-            json={
-                "model": "llama3-8b-8192",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a helpful and friendly assistant for an emotion-based recommendation website called MoodConexus.\n"
-                            "- If a user expresses feeling sad, give a short 💡 motivational quote 🧠💪.\n"
-                            "- If the user asks for a suggestion, give either an anime 🎥 or book 📚 (or both) based on the emotion in their message.\n"
-                            "- Keep your replies short, clear, and kind.\n"
-                            "- Be emotion-aware: respond differently for sadness 😢, happiness 😄, or excitement😊✨.\n"
-                            "- Always respond naturally to what the user says without asking unnecessary questions.\n"
-                            "- Format your reply cleanly using line breaks.\n"
-                            "- When recommending anime, suggest they can watch it on https://9animetv.to/ 🎬.\n"
-                            "- When recommending books, suggest they can download from https://oceanofpdf.com/ 📖.\n"
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": user_input
-                    }
-                ],
-                "max_tokens": 200,
-                "temperature": 0.7,
-                "stop": None
-            }
+            json=completion_request(user_input, stream),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            stream=stream
         )
 
-        if response.status_code == 200:
-            raw_reply = response.json()["choices"][0]["message"]["content"]
-            reply = format_reply(raw_reply)
-            return jsonify({"reply": reply})
+
+def iter_tokens(response):
+    """Content pieces of a streamed (OpenAI-style server-sent events) completion"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        choices = json.loads(data).get('choices') or [{}]
+        content = (choices[0].get('delta') or {}).get('content')
+        if content:
+            yield content
+
+
+# How a catalog emotion reads in "Feeling ...?"
+MOOD_LABELS = {'anger': 'angry', 'fear': 'scared', 'surprise': 'surprised', 'disgust': 'disgusted'}
+KIND_LABELS = {
+    'anime': "🎥 Anime (watch on https://9animetv.to/ 🎬)",
+    'book': "📚 Books (download from https://oceanofpdf.com/ 📖)",
+}
+
+
+def local_reply(user_input):
+    """Answer a "recommend X for emotion Y" message from the catalog engines.
+
+    Returns the response body, or None if the message is open-ended chat
+    (or no engines are registered on the app) and needs the LLM.
+    """
+    intent = detect_intent(user_input)
+    engines = current_app.extensions.get('engines')
+    if intent is None or not engines:
+        return None
+
+    lines = [f"Feeling {MOOD_LABELS.get(intent.emotion, intent.emotion)}? Here are some picks from our catalog:"]
+    recommendations = {}
+    for kind in intent.kinds:
+        engine, format_item = engines[kind]
+        records = [format_item(r) for r in engine.get_recommendations(intent.emotion, top_n=LOCAL_PICKS)]
+        if not records:
+            continue
+        recommendations[kind] = records
+        lines.append(KIND_LABELS[kind])
+        lines.extend(f"{i}. {r['title']} (⭐ {r['rating']:.1f})" for i, r in enumerate(records, 1))
+    if not recommendations:
+        return None
+
+    return {
+        "reply": '\n'.join(lines),
+        "source": "catalog",
+        "emotion": intent.emotion,
+        "recommendations": recommendations
+    }
+
+
+class UpstreamError(Exception):
+    """The completions API answered with an error status"""
+
+
+def fetch_reply(user_input):
+    """Formatted reply to one message from a (non-streamed) completion"""
+    response = post_completion(user_input)
+    if response.status_code != 200:
+        raise UpstreamError(response.status_code)
+    return format_reply(response.json()["choices"][0]["message"]["content"])
+
+
+def normalize_message(text):
+    """Message as a cache key: case, punctuation, symbols (incl. emoji) and extra whitespace removed"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    normalized = ' '.join(''.join(ch for ch in text if unicodedata.category(ch)[0] not in 'PS').split())
+    # A message of only emoji/punctuation keys on itself rather than on ''
+    return normalized or ' '.join(text.split())
+
+
+def cache_key(user_input):
+    """Key of a reply: the normalized message plus everything else sent upstream"""
+    parts = [normalize_message(user_input), SYSTEM_PROMPT, MODEL, MAX_TOKENS, TEMPERATURE]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+class ReplyCache:
+    """LRU cache of replies with a TTL that coalesces concurrent misses.
+
+    While a reply is being computed, other requests for the same key wait for
+    that call instead of starting their own, so a burst of identical messages
+    costs a single upstream round-trip. Failures are shared but not cached.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _lookup(self, key):
+        """Cached reply or None; caller holds the lock"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, reply = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return reply
+
+    def get(self, key):
+        with self.lock:
+            reply = self._lookup(key)
+            if reply is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return reply
+
+    def put(self, key, reply):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            reply = self._lookup(key)
+            if reply is not None:
+                self.hits += 1
+                return reply
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                self.misses += 1
+                call = self.inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            reply = compute()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
         else:
-            return jsonify({"reply": "MoodConexus Bot is temporarily unavailable. Please try again."}), 500
+            self.put(key, reply)
+            call.set_result(reply)
+            return reply
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl
+            }
+
+
+reply_cache = ReplyCache()
+
+
+@register_collector
+def reply_cache_metrics():
+    """Reply cache counters in the Prometheus text format"""
+    stats = reply_cache.stats()
+    lines = []
+    for name in ('hits', 'misses', 'coalesced'):
+        lines += [
+            f'# HELP moodconexus_chat_cache_{name}_total Chat reply cache {name}.',
+            f'# TYPE moodconexus_chat_cache_{name}_total counter',
+            f'moodconexus_chat_cache_{name}_total {stats[name]}',
+        ]
+    lines += [
+        '# HELP moodconexus_chat_cache_entries Replies held in the chat cache.',
+        '# TYPE moodconexus_chat_cache_entries gauge',
+        f'moodconexus_chat_cache_entries {stats["size"]}',
+    ]
+    return lines
+
+
+def stream_reply(user_input, use_cache=True):
+    """Server-sent events for one message: 'delta' pieces of the formatted reply, then 'done' with all of it"""
+    key = cache_key(user_input)
+    if use_cache:
+        reply = reply_cache.get(key)
+        if reply is not None:
+            yield sse_event('done', {"reply": reply})
+            return
+    try:
+        with post_completion(user_input, stream=True) as response:
+            if response.status_code != 200:
+                yield sse_event('error', {"reply": UNAVAILABLE})
+                return
+            formatter = ReplyFormatter()
+            for token in iter_tokens(response):
+                delta = formatter.feed(token)
+                if delta:
+                    yield sse_event('delta', {"text": delta})
+            reply = formatter.reply()
+            if use_cache:
+                reply_cache.put(key, reply)
+            yield sse_event('done', {"reply": reply})
+    except requests.RequestException:
+        yield sse_event('error', {"reply": UNAVAILABLE})
+    except Exception:
+        logger.exception("Chat completion failed")
+        yield sse_event('error', {"reply": FAILED})
+
+
+@chat_bp.route('/chat', methods=['POST'])
+def chat():
+    data = request.get_json()
+    user_input = data.get('message', '').strip()
+
+    if not user_input:
+        return jsonify({"reply": GREETING})
+
+    # Recommendation requests are answered from our own catalog, no LLM round-trip
+    local = local_reply(user_input)
+    if local is not None:
+        return jsonify(local)
+
+    try:
+        # "cache": false asks for a fresh completion (e.g. for more variety)
+        if data.get('cache', True):
+            reply = reply_cache.get_or_compute(cache_key(user_input), lambda: fetch_reply(user_input))
+        else:
+            reply = fetch_reply(user_input)
+        return jsonify({"reply": reply})
+
+    except UpstreamError:
+        return jsonify({"reply": UNAVAILABLE}), 500
+    except requests.Timeout:
+        return jsonify({"reply": UNAVAILABLE}), 504
+    except requests.RequestException:
+        return jsonify({"reply": UNAVAILABLE}), 503
+    except Exception:
+        logger.exception("Chat completion failed")
+        return jsonify({"reply": FAILED}), 500
+
+
+@chat_bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Like /chat, but relays the reply as server-sent events while it is generated"""
+    data = request.get_json(silent=True) or {}
+    user_input = data.get('message', '').strip()
+
+    local = local_reply(user_input) if user_input else None
+    if not user_input:
+        events = iter([sse_event('done', {"reply": GREETING})])
+    elif local is not None:
+        events = iter([sse_event('done', local)])
+    else:
+        events = stream_reply(user_input, use_cache=data.get('cache', True))
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 
-    except Exception as e:
-        print("❌ Error:", e)
-        return jsonify({"reply": "Something went wrong while generating response."}), 500
+@chat_bp.route('/chat/cache', methods=['GET'])
+def chat_cache_stats():
+    """Hit/miss counters of the reply cache"""
+    return jsonify(reply_cache.stats())
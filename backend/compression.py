@@ -0,0 +1,57 @@
+import gzip
+from flask import request
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it responses are only gzip-compressed
+    brotli = None
+
+# Bodies smaller than this gain too little to be worth compressing
+MIN_SIZE = 512
+# Levels tuned for per-request compression (speed over the last few percent)
+GZIP_LEVEL = 3
+BROTLI_QUALITY = 4
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/html', 'text/csv')
+
+
+def choose_encoding(accept_encodings):
+    """The best encoding the client accepts ('br' or 'gzip'), or None"""
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """after_request hook compressing buffered JSON and text bodies for clients that accept it.
+
+    Streams (server-sent events) and already encoded responses are left
+    alone. The ETag is weakened, since the bytes now depend on the encoding;
+    If-None-Match still matches it.
+    """
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    body = response.get_data()
+    if len(body) < MIN_SIZE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    with timed('compress'):
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
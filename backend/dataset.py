@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+ANIME_SOURCE = 'anime_with_emotions.xlsx'
+BOOK_SOURCE = 'book_dataset.xlsx'
+SNAPSHOT_DIR = os.path.join('models', 'dataset')
+
+# Bump when the cleaning below changes so old snapshots are rebuilt
+SNAPSHOT_VERSION = 1
+
+EMOTION_MAP = {
+    'surprised': 'surprise',
+    'fearful': 'fear',
+    'angry': 'anger',
+    'disgust': 'disgust'
+    # Add other mappings as needed
+}
+
+
+def read_datasets(anime_path=ANIME_SOURCE, book_path=BOOK_SOURCE):
+    """Parse the XLSX sources and clean them (the slow path)"""
+    # Load datasets
+    anime_df = pd.read_excel(anime_path)
+    book_df = pd.read_excel(book_path)
+    return clean_datasets(anime_df, book_df)
+
+
+# Column holding the genres that go into each kind's text features
+GENRE_COLUMNS = {'anime': 'genre', 'book': 'emotion_based_genre'}
+
+
+def clean_frame(df, kind):
+    """Standardize one raw anime or book frame and add its combined text features"""
+    df = df.dropna()
+
+    # Some cells parse as numbers (e.g. a book titled "1984"); keep text columns as strings
+    text_columns = df.select_dtypes(include=['object', 'string']).columns
+    df[text_columns] = df[text_columns].astype(str)
+
+    # Clean and standardize data
+    df['emotion'] = df['emotion'].str.lower().str.strip()
+    df['emotion'] = df['emotion'].map(EMOTION_MAP).fillna(df['emotion'])
+
+    # Create combined features for better recommendations
+    df['features'] = combine_features(df, kind)
+    return df
+
+
+def combine_features(df, kind):
+    """Text features of cleaned rows: title, description and genre"""
+    return (
+        df['title'].astype(str) + " " +
+        df['description'].astype(str) + " " +
+        df[GENRE_COLUMNS[kind]].astype(str)
+    )
+
+
+def clean_datasets(anime_df, book_df):
+    """Standardize raw anime/book frames and add the combined text features"""
+    return clean_frame(anime_df, 'anime'), clean_frame(book_df, 'book')
+
+
+def source_hash(*paths):
+    """Hash of the source files' contents (plus the snapshot version)"""
+    digest = hashlib.sha256(f"v{SNAPSHOT_VERSION}".encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _manifest_path(snapshot_dir):
+    return os.path.join(snapshot_dir, 'manifest.json')
+
+
+def build_snapshot(anime_df, book_df, key, snapshot_dir=SNAPSHOT_DIR):
+    """Write the cleaned frames as Parquet files, keyed by the source hash"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for name, df in (('anime', anime_df), ('book', book_df)):
+        tmp_path = os.path.join(snapshot_dir, f'{name}.parquet.tmp')
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, os.path.join(snapshot_dir, f'{name}.parquet'))
+
+    # Manifest goes last so a half-written snapshot never looks valid
+    tmp_path = _manifest_path(snapshot_dir) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'source_hash': key, 'rows': {'anime': len(anime_df), 'book': len(book_df)}}, f)
+    os.replace(tmp_path, _manifest_path(snapshot_dir))
+
+
+def load_snapshot(key, snapshot_dir=SNAPSHOT_DIR):
+    """Return the snapshot frames, or None if it is missing or was built from other sources"""
+    try:
+        with open(_manifest_path(snapshot_dir)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('source_hash') != key:
+        return None
+
+    anime_df = pd.read_parquet(os.path.join(snapshot_dir, 'anime.parquet'))
+    book_df = pd.read_parquet(os.path.join(snapshot_dir, 'book.parquet'))
+    return anime_df, book_df
+
+
+# Load and preprocess datasets
+def load_data(anime_path=ANIME_SOURCE, book_path=BOOK_SOURCE, snapshot_dir=SNAPSHOT_DIR):
+    start = time.perf_counter()
+    key = source_hash(anime_path, book_path)
+
+    try:
+        frames = load_snapshot(key, snapshot_dir)
+    except ImportError:
+        # No Parquet engine (pyarrow) installed; always parse the XLSX
+        logger.warning("Parquet support unavailable, loading datasets from XLSX")
+        return read_datasets(anime_path, book_path)
+
+    if frames is not None:
+        logger.info("Loaded dataset snapshot in %.3fs", time.perf_counter() - start)
+        return frames
+
+    # Sources changed (or first boot): parse the XLSX and refresh the snapshot
+    anime_df, book_df = read_datasets(anime_path, book_path)
+    try:
+        build_snapshot(anime_df, book_df, key, snapshot_dir)
+    except ImportError:
+        logger.warning("Parquet support unavailable, dataset snapshot not written")
+        return anime_df, book_df
+    logger.info("Rebuilt dataset snapshot from XLSX in %.3fs", time.perf_counter() - start)
+    return anime_df, book_df
+
+
+if __name__ == '__main__':
+    # One-time build step: python dataset.py
+    logging.basicConfig(level=logging.INFO)
+    key = source_hash(ANIME_SOURCE, BOOK_SOURCE)
+    if load_snapshot(key) is not None and '--force' not in sys.argv:
+        print(f"Snapshot in {SNAPSHOT_DIR} is up to date ({key[:12]})")
+    else:
+        build_snapshot(*read_datasets(), key)
+        print(f"Wrote snapshot to {SNAPSHOT_DIR} ({key[:12]})")
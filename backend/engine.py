@@ -0,0 +1,515 @@
+import copy
+import json
+import logging
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from neighbors import build_neighbors, blend_neighbors
+from lsa import embed
+from search import SearchIndex
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# (positions, scores) of an empty recommendation list
+EMPTY_SELECTION = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+# Keys of a formatted response record, in response order
+RESPONSE_FIELDS = ('title', 'rating', 'description', 'thumbnail', 'previewlink', 'emotion', 'genre', 'similarity_score')
+
+# Share of a personalized query taken from the user's favorites; the rest is the emotion centroid
+PROFILE_WEIGHT = 0.3
+# A personalized sample is drawn from this share of the candidates (at least PROFILE_POOL_MIN)
+# that best match the blended query
+PROFILE_POOL_SHARE = 0.25
+PROFILE_POOL_MIN = 60
+
+# A user's taste in one catalog: the unit-length mean TF-IDF vector of their
+# favorites (as sparse terms and weights) and the canonical positions they saved
+UserProfile = namedtuple('UserProfile', ['terms', 'weights', 'saved'])
+
+
+def sample_order(rng, n, stop):
+    """The first ``stop`` indices of a random permutation of ``range(n)`` (partial Fisher-Yates).
+
+    Costs O(stop), not O(n), and for a given seed the result for a smaller
+    ``stop`` is a prefix of the result for a larger one, so pages of a
+    seeded sample never overlap.
+    """
+    stop = min(stop, n)
+    steps = np.arange(stop)
+    draws = steps + (rng.random(stop) * (n - steps)).astype(np.int64)
+    # Only the swapped slots of the virtual permutation are stored
+    swapped = {}
+    order = np.empty(stop, dtype=np.int64)
+    for i, j in enumerate(draws.tolist()):
+        order[i] = swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+    return order
+
+
+# Recommendation Engine
+class RecommendationEngine:
+    def __init__(self, df, vectorizer, tfidf_matrix, min_similarity=0.2, neighbors=None, format_item=None, lsa=None,
+                 postings=None):
+        self.df = df
+        self.vectorizer = vectorizer
+        self.tfidf_matrix = tfidf_matrix
+        self.min_similarity = min_similarity
+        self.format_item = format_item
+        # (indices, scores) of each item's top-k neighbours; built on first use if not given
+        self.neighbors = neighbors
+        # Low-rank mode (see lsa.py): (projection, embedding) to score items in instead of the
+        # TF-IDF matrix; None scores exactly
+        self.projection, self.embedding = lsa if lsa is not None else (None, None)
+        if self.projection is not None and self.embedding is None:
+            self.embedding = embed(tfidf_matrix, self.projection)
+        # Lowercased title -> row position, first occurrence wins
+        self.title_positions = {}
+        canonical = []
+        for position, title in enumerate(df['title'].astype(str).str.lower().str.strip()):
+            canonical.append(self.title_positions.setdefault(title, position))
+        # Row position of the first item with the same title (the catalog has duplicates)
+        self.canonical_positions = np.asarray(canonical, dtype=np.int64)
+        self._index_emotions(df['emotion'].unique())
+        self.emotion_map = {
+            'surprised': 'surprise',
+            'fearful': 'fear',
+            'angry': 'anger',
+            'disgusted': 'disgust'
+        }
+        # Mean TF-IDF vector of each emotion, one dense row per emotion, so any
+        # blend of emotions is just a weighted sum of rows. The per-emotion sums
+        # are kept so catalog updates can patch them.
+        with timed('centroids'):
+            self.emotion_sums = np.vstack([
+                np.asarray(tfidf_matrix[indices].sum(axis=0), dtype=np.float64)
+                for indices in self.emotion_indices.values()
+            ])
+            self.centroids = self._centroids()
+        # Item norms for cosine scoring
+        self.item_norms = self._norms(tfidf_matrix)
+        # Inverted index (``postings``, the stored term-major matrix, or built here) and title
+        # autocomplete for /api/search
+        with timed('search_index'):
+            self.search_index = SearchIndex(df, tfidf_matrix, vectorizer, self.canonical_positions, postings)
+        # Pre-encoded response record of every item, so requests only join strings
+        self.fragments = self._encode_records(format_item) if format_item else None
+        # Ranked candidates per emotion, built once so requests only sample
+        self.candidates = self._rank_all(min_similarity)
+
+    def _index_emotions(self, names):
+        """Row positions (not index labels) of the items tagged with each of ``names``"""
+        emotions = self.df['emotion'].to_numpy()
+        self.emotion_names = list(names)
+        self.emotion_rows = {emotion: row for row, emotion in enumerate(self.emotion_names)}
+        self.emotion_indices = {
+            emotion: np.flatnonzero(emotions == emotion)
+            for emotion in self.emotion_names
+        }
+        # Centroid row of each item's own emotion
+        self.item_emotion_rows = pd.Categorical(emotions, categories=self.emotion_names).codes
+
+    def _centroids(self):
+        counts = np.asarray([len(indices) for indices in self.emotion_indices.values()], dtype=np.float64)
+        return (self.emotion_sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+    @staticmethod
+    def _norms(rows):
+        norms = np.sqrt(np.asarray(rows.multiply(rows).sum(axis=1))).ravel()
+        norms[norms == 0] = 1
+        return norms
+
+    def _rank_all(self, min_similarity):
+        """Ranked candidates of every emotion, scored with one batched product"""
+        similarities = self.score_queries(np.eye(len(self.emotion_names), dtype=np.float32))
+        return {
+            emotion: self._rank_candidates(emotion, min_similarity, similarities[:, row])
+            for emotion, row in self.emotion_rows.items()
+        }
+
+    def _rank_candidates(self, emotion, min_similarity, similarities=None):
+        """Score every item against the emotion centroid and keep the ranked survivors.
+
+        Returns ``(positions, scores)`` sorted by descending similarity, with
+        items already tagged with ``emotion`` and items below
+        ``min_similarity`` removed.
+        """
+        emotion_indices = self.emotion_indices[emotion]
+
+        # Similarity of every item to the emotion centroid
+        if similarities is None:
+            weights = np.zeros((1, len(self.emotion_names)), dtype=np.float32)
+            weights[0, self.emotion_rows[emotion]] = 1
+            similarities = self.score_queries(weights)[:, 0]
+        similarities = similarities.copy()
+
+        # Exclude items that already have this emotion
+        similarities[emotion_indices] = -np.inf
+        positions = np.flatnonzero(similarities >= min_similarity)
+
+        # Sort by similarity score descending
+        order = np.argsort(-similarities[positions], kind='stable')
+        positions = positions[order]
+        return positions, similarities[positions]
+
+    def score_queries(self, weights):
+        """Cosine similarity of every item to a batch of blended emotion queries.
+
+        ``weights`` is ``(n_queries, n_emotions)``; the queries are
+        ``weights @ centroids`` and all of them are scored with a single
+        sparse-dense product, or a dense one over the LSA embedding in
+        low-rank mode. Returns a dense ``(n_items, n_queries)`` array.
+        """
+        with timed('score'):
+            queries = np.asarray(weights, dtype=np.float32) @ self.centroids
+            query_norms = np.linalg.norm(queries, axis=1)
+            query_norms[query_norms == 0] = 1
+            queries = queries / query_norms[:, None]
+            if self.embedding is not None:
+                scores = self.embedding @ (queries @ self.projection.T).T
+            else:
+                scores = np.asarray(self.tfidf_matrix @ queries.T)
+            return scores / self.item_norms[:, None]
+
+    def emotion_weights(self, mix):
+        """Turn an {emotion: confidence} mix into normalized weights over this engine's emotions"""
+        weights = np.zeros(len(self.emotion_names), dtype=np.float32)
+        for emotion, confidence in mix.items():
+            emotion = str(emotion).lower().strip()
+            emotion = self.emotion_map.get(emotion, emotion)
+            if emotion in self.emotion_rows and confidence > 0:
+                weights[self.emotion_rows[emotion]] += confidence
+        total = weights.sum()
+        return weights / total if total > 0 else weights
+
+    def _sample(self, positions, scores, top_n, seed, offset=0):
+        """Draw a seeded random sample of the ranked candidates; returns (positions, scores).
+
+        ``offset`` skips that many items of the sample, for paging.
+        """
+        with timed('sample'):
+            rng = np.random.default_rng(seed)
+            picked = sample_order(rng, len(positions), offset + top_n)[offset:]
+            return positions[picked], scores[picked]
+
+    def _records(self, positions, scores):
+        """Dataset rows at ``positions`` as dicts, each with its similarity score"""
+        with timed('format'):
+            recommendations = self.df.iloc[positions].to_dict('records')
+            for record, score in zip(recommendations, scores):
+                record['similarity_score'] = score
+            return recommendations
+
+    def _encode_records(self, format_item):
+        """JSON of every item's formatted response record, left open for its similarity score"""
+        return [self._encode_record(row, format_item) for row in self.df.to_dict('records')]
+
+    def _encode_record(self, row, format_item=None):
+        record = (format_item or self.format_item)(row)
+        record.pop('similarity_score', None)
+        return json.dumps(record, separators=(',', ':'))[:-1] + ',"similarity_score":'
+
+    def to_json(self, positions, scores, fields=None):
+        """JSON array of the response records at ``positions``, joined from the pre-encoded fragments.
+
+        ``fields`` (a subset of RESPONSE_FIELDS) keeps only those keys of each record.
+        """
+        with timed('serialize'):
+            if fields is not None:
+                records = (
+                    json.loads(self.fragments[position] + json.dumps(score) + '}')
+                    for position, score in zip(positions.tolist(), scores.tolist())
+                )
+                return json.dumps([{f: r[f] for f in fields} for r in records], separators=(',', ':'))
+            return '[' + ','.join(
+                self.fragments[position] + json.dumps(score) + '}'
+                for position, score in zip(positions.tolist(), scores.tolist())
+            ) + ']'
+
+    def select_batch(self, mixes, top_n=15, min_similarity=None, seeds=None, exclude_share=0.2):
+        """Recommendations for many emotion mixes at once, as (positions, scores) pairs.
+
+        Each mix is an ``{emotion: confidence}`` dict. Items tagged with an
+        emotion holding at least ``exclude_share`` of a mix are excluded, the
+        blended counterpart of excluding same-emotion items. Single-emotion
+        mixes are served from the precomputed tables; all blended mixes are
+        scored together with one matrix product.
+        """
+        min_similarity = self.min_similarity if min_similarity is None else min_similarity
+        seeds = seeds or [None] * len(mixes)
+        weights = np.vstack([self.emotion_weights(mix) for mix in mixes]) if mixes else np.zeros((0, len(self.emotion_names)))
+
+        # One-hot mixes are exactly the per-emotion tables
+        blended = [i for i, row in enumerate(weights) if np.count_nonzero(row) > 1]
+        columns = {i: column for column, i in enumerate(blended)}
+        scores = self.score_queries(weights[blended]) if blended else None
+
+        results = []
+        for i, row in enumerate(weights):
+            if not row.any():
+                results.append(EMPTY_SELECTION)
+            elif i not in columns:
+                emotion = self.emotion_names[int(np.argmax(row))]
+                results.append(self.select(emotion, top_n, min_similarity, seeds[i]))
+            else:
+                with timed('filter'):
+                    similarities = scores[:, columns[i]]
+                    excluded = row[self.item_emotion_rows] >= exclude_share
+                    positions = np.flatnonzero((similarities >= min_similarity) & ~excluded)
+                    positions = positions[np.argsort(-similarities[positions], kind='stable')]
+                results.append(self._sample(positions, similarities[positions], top_n, seeds[i]))
+        return results
+
+    def get_batch_recommendations(self, mixes, top_n=15, min_similarity=None, seeds=None, exclude_share=0.2):
+        """Recommendation records for many emotion mixes at once (see select_batch)"""
+        return [
+            self._records(positions, scores)
+            for positions, scores in self.select_batch(mixes, top_n, min_similarity, seeds, exclude_share)
+        ]
+
+    def select(self, emotion, top_n=15, min_similarity=None, seed=None, offset=0):
+        """Sampled recommendations for one emotion as (positions, scores), from ``offset`` in the sample"""
+        try:
+            # Standardize emotion input
+            emotion = emotion.lower().strip()
+            emotion = self.emotion_map.get(emotion, emotion)
+
+            if emotion not in self.candidates:
+                logger.info("No items found for emotion: %s", emotion)
+                return EMPTY_SELECTION
+
+            positions, scores = self.candidates[emotion]
+            if min_similarity is not None and min_similarity < self.min_similarity:
+                # Looser than the precomputed table; rank on the slow path
+                positions, scores = self._rank_candidates(emotion, min_similarity)
+            elif min_similarity is not None:
+                # Scores are descending, so a stricter threshold is a prefix
+                positions = positions[:np.searchsorted(-scores, -min_similarity, side='right')]
+
+            # Draw a seeded random sample from the ranked candidates
+            return self._sample(positions, scores, top_n, seed, offset)
+
+        except Exception:
+            logger.exception("Recommendation error for emotion %r", emotion)
+            return EMPTY_SELECTION
+
+    def get_recommendations(self, emotion, top_n=15, min_similarity=None, seed=None):
+        return self._records(*self.select(emotion, top_n, min_similarity, seed))
+
+    def apply_changes(self, df, tfidf_matrix, neighbors, changed):
+        """A new engine for ``df`` where only the rows at ``changed`` differ from this one.
+
+        Changed rows are either replaced in place or appended at the end.
+        Title maps, per-emotion sums, norms and pre-encoded records are patched
+        for those rows only, and the candidate tables are re-ranked in one
+        batched scoring pass. This engine is left untouched, so requests can
+        keep using it until the new one is swapped in.
+        """
+        changed = np.asarray(changed, dtype=np.int64)
+        if not set(df['emotion'].iloc[changed]) <= set(self.emotion_names):
+            # A brand-new emotion needs a new centroid row: rebuild
+            lsa = (self.projection, None) if self.projection is not None else None
+            return RecommendationEngine(df, self.vectorizer, tfidf_matrix, self.min_similarity, neighbors,
+                                        self.format_item, lsa)
+
+        n_old = len(self.df)
+        updated, added = changed[changed < n_old], changed[changed >= n_old]
+        engine = copy.copy(self)
+        engine.df, engine.tfidf_matrix, engine.neighbors = df, tfidf_matrix, neighbors
+
+        # Updates are matched by title, so only new items add titles
+        engine.title_positions = dict(self.title_positions)
+        new_titles = df['title'].iloc[added].astype(str).str.lower().str.strip()
+        engine.canonical_positions = np.concatenate([self.canonical_positions, np.asarray(
+            [engine.title_positions.setdefault(title, int(p)) for p, title in zip(added, new_titles)], dtype=np.int64
+        )])
+
+        engine._index_emotions(self.emotion_names)
+        with timed('centroids'):
+            # Take the old versions of updated rows out of their emotion's sum, add the new rows
+            n_emotions = len(self.emotion_names)
+            old_rows = sp.csr_matrix(
+                (np.ones(len(updated)), (self.item_emotion_rows[updated], np.arange(len(updated)))),
+                shape=(n_emotions, len(updated))
+            )
+            new_rows = sp.csr_matrix(
+                (np.ones(len(changed)), (engine.item_emotion_rows[changed], np.arange(len(changed)))),
+                shape=(n_emotions, len(changed))
+            )
+            engine.emotion_sums = (
+                self.emotion_sums
+                - (old_rows @ self.tfidf_matrix[updated]).toarray()
+                + (new_rows @ tfidf_matrix[changed]).toarray()
+            )
+            engine.centroids = engine._centroids()
+
+        engine.item_norms = np.concatenate([self.item_norms, np.ones(len(added))])
+        engine.item_norms[changed] = self._norms(tfidf_matrix[changed])
+        with timed('search_index'):
+            engine.search_index = self.search_index.apply_changes(df, tfidf_matrix, engine.canonical_positions, changed)
+        if self.embedding is not None:
+            # The projection is kept: changed rows are projected onto it like the rest
+            engine.embedding = np.empty((len(df), self.embedding.shape[1]), dtype=np.float32)
+            engine.embedding[:n_old] = self.embedding
+            engine.embedding[changed] = embed(tfidf_matrix[changed], self.projection)
+        if self.fragments is not None:
+            engine.fragments = list(self.fragments) + [None] * len(added)
+            for position, row in zip(changed.tolist(), df.iloc[changed].to_dict('records')):
+                engine.fragments[position] = self._encode_record(row)
+        engine.candidates = engine._rank_all(self.min_similarity)
+        return engine
+
+    def lookup_titles(self, titles):
+        """Map titles to row positions; returns (positions, titles not in the catalog)"""
+        positions, missing = [], []
+        for title in titles:
+            position = self.title_positions.get(str(title).lower().strip())
+            if position is None:
+                missing.append(title)
+            else:
+                positions.append(position)
+        return positions, missing
+
+    def build_profile(self, titles):
+        """The UserProfile of a user's favorite titles, or None if none of them are in the catalog"""
+        positions, _ = self.lookup_titles(titles)
+        if not positions:
+            return None
+        positions = np.unique(positions)
+        # Mean of the unit-length item vectors, so long descriptions don't dominate
+        rows = sp.diags(1 / self.item_norms[positions]) @ self.tfidf_matrix[positions]
+        mean = np.asarray(rows.mean(axis=0)).ravel()
+        terms = np.flatnonzero(mean)
+        weights = mean[terms] / max(np.linalg.norm(mean[terms]), 1e-12)
+        saved = np.unique(self.canonical_positions[positions])
+        return UserProfile(terms.astype(np.int32), weights.astype(np.float32), saved)
+
+    def select_personalized(self, emotion, profile, top_n=15, seed=None, offset=0, weight=PROFILE_WEIGHT):
+        """Like select, but ranked towards a user's favorites and without the titles they saved.
+
+        Cosine similarity is linear in the query, so blending the profile into
+        the emotion centroid only needs the profile scores of the emotion's
+        precomputed candidates, not another pass over the catalog.
+        """
+        if profile is None:
+            return self.select(emotion, top_n, seed=seed, offset=offset)
+        emotion = self.emotion_map.get(emotion.lower().strip(), emotion.lower().strip())
+        if emotion not in self.candidates:
+            return EMPTY_SELECTION
+
+        with timed('personalize'):
+            positions, scores = self.candidates[emotion]
+            keep = ~np.isin(self.canonical_positions[positions], profile.saved)
+            positions, scores = positions[keep], scores[keep]
+
+            query = np.zeros(self.tfidf_matrix.shape[1], dtype=np.float32)
+            query[profile.terms] = profile.weights
+            affinity = np.asarray(self.tfidf_matrix[positions] @ query).ravel() / self.item_norms[positions]
+            # Norm of (1 - w) * centroid + w * profile, both unit length, to report true cosines
+            centroid = self.centroids[self.emotion_rows[emotion]]
+            overlap = float(centroid[profile.terms] @ profile.weights) / max(float(np.linalg.norm(centroid)), 1e-12)
+            query_norm = np.sqrt((1 - weight) ** 2 + weight ** 2 + 2 * weight * (1 - weight) * overlap)
+            blended = ((1 - weight) * scores + weight * affinity) / query_norm
+
+            pool = max(int(len(positions) * PROFILE_POOL_SHARE), PROFILE_POOL_MIN)
+            order = np.argsort(-blended, kind='stable')
+            positions, blended = positions[order], blended[order]
+            # Keep the best-scored copy of duplicated titles
+            _, first = np.unique(self.canonical_positions[positions], return_index=True)
+            keep = np.sort(first)[:pool]
+            positions, blended = positions[keep], blended[keep].astype(np.float32)
+        return self._sample(positions, blended, top_n, seed, offset)
+
+    def search(self, query, emotion=None, top_n=15):
+        """Items matching a text query as (positions, scores), best first, one per title.
+
+        ``emotion`` keeps only the items tagged with it.
+        """
+        with timed('search'):
+            positions, scores = self.search_index.match(query)
+            if emotion is not None:
+                emotion = self.emotion_map.get(emotion.lower().strip(), emotion.lower().strip())
+                if emotion not in self.emotion_rows:
+                    return EMPTY_SELECTION
+                keep = self.item_emotion_rows[positions] == self.emotion_rows[emotion]
+                positions, scores = positions[keep], scores[keep]
+
+            order = np.argsort(-scores, kind='stable')
+            positions, scores = positions[order], scores[order]
+            # Keep the best-scored copy of duplicated titles
+            _, first = np.unique(self.canonical_positions[positions], return_index=True)
+            keep = np.sort(first)[:top_n]
+            return positions[keep], scores[keep]
+
+    def complete_title(self, prefix, top_n=10):
+        """Titles starting with ``prefix``, or with a word sequence starting with it; best rated first"""
+        with timed('autocomplete'):
+            return self.df['title'].iloc[self.search_index.titles.complete(prefix, top_n)].tolist()
+
+    def get_similar(self, positions, top_n=15):
+        """Items most similar to the given seed positions, from the precomputed neighbour lists"""
+        if not positions:
+            return []
+        if self.neighbors is None:
+            self.neighbors = build_neighbors(self.tfidf_matrix)
+
+        picked, scores = blend_neighbors(*self.neighbors, positions)
+
+        # Drop duplicates of the seeds and of each other, keeping the best-scored copy
+        canonical = self.canonical_positions[picked]
+        _, first = np.unique(canonical, return_index=True)
+        keep = np.sort(first)
+        keep = keep[~np.isin(canonical[keep], self.canonical_positions[positions])][:top_n]
+        picked, scores = picked[keep], scores[keep]
+
+        return self._records(picked, scores)
+
+# Response formatting
+def truncate_description(desc, max_lines=3, max_length=300):
+    """Clean and truncate description to specified number of lines and characters"""
+    if not desc:
+        return ""
+
+    # Clean the description first
+    clean_desc = desc.replace('_x000D_\n', '\n').strip()
+
+    # Truncate by lines
+    lines = [line.strip() for line in clean_desc.split('\n') if line.strip()]
+    truncated = '\n'.join(lines[:max_lines])
+
+    # Further truncate by character length if needed
+    if len(truncated) > max_length:
+        truncated = truncated[:max_length].rsplit(' ', 1)[0] + "..."
+    elif len(lines) > max_lines:
+        truncated += "..."
+
+    return truncated
+
+# Format responses
+def format_anime(anime):
+    return {
+        'title': anime.get('title', ''),
+        'rating': float(anime.get('rating', 0)),
+        'description': truncate_description(anime.get('description', '')),
+        'thumbnail': anime.get('thumbnail', ''),
+        'previewlink': anime.get('previewlink', ''),
+        'emotion': anime.get('emotion', ''),
+        'genre': anime.get('genre', ''),
+        'similarity_score': float(anime.get('similarity_score', 0))
+    }
+
+def format_book(book):
+    return {
+        'title': book.get('title', ''),
+        'rating': float(book.get('rating', 0)),
+        'description': truncate_description(book.get('description', '')),
+        'thumbnail': book.get('thumbnail', ''),
+        'previewlink': book.get('previewLink', ''),
+        'emotion': book.get('emotion', ''),
+        'genre': book.get('emotion_based_genre', book.get('genre', '')),
+        'similarity_score': float(book.get('similarity_score', 0))
+    }
+
+# Response formatter of each catalog kind
+FORMATTERS = {'anime': format_anime, 'book': format_book}
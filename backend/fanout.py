@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from metrics import register_collector
+
+# Threads shared by all requests for running engines side by side (their NumPy/SciPy work releases the GIL)
+ENGINE_WORKERS = int(os.getenv('ENGINE_WORKERS', min(32, 2 * (os.cpu_count() or 1))))
+# Seconds a request waits for its engines, set in milliseconds; lists not ready by then are
+# left out (ENGINE_DEADLINE_MS=0 waits for all)
+ENGINE_DEADLINE = float(os.getenv('ENGINE_DEADLINE_MS', 500)) / 1000 or None
+
+
+class EnginePool:
+    """Runs one call per engine concurrently on a bounded thread pool shared by all requests.
+
+    A request waits for its calls up to a deadline. Calls still queued then
+    are cancelled; calls already running finish in the background and their
+    results are dropped, so a slow engine costs the request at most the
+    deadline.
+    """
+
+    def __init__(self, workers=ENGINE_WORKERS):
+        self.workers = workers
+        self.runs = 0
+        # Engine name -> calls that missed their request's deadline
+        self.missed = {}
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Also run in forked children: the pool's threads stay with the parent, a child starts its own
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='engine')
+            return self.executor
+
+    @staticmethod
+    def _timed_call(call, submitted):
+        started = time.perf_counter()
+        result = call()
+        return result, started - submitted, time.perf_counter() - started
+
+    def run(self, calls, deadline=None):
+        """Run ``calls`` ({name: callable}) concurrently; returns ``(results, timings)``.
+
+        ``results`` holds the value of each call that finished within
+        ``deadline`` seconds (no limit if None); a call that raised re-raises
+        here. ``timings`` has ``{'ms', 'queued_ms'}`` per finished call and
+        ``{'missed': True}`` per late one.
+        """
+        executor = self._executor()
+        submitted = time.perf_counter()
+        futures = {name: executor.submit(self._timed_call, call, submitted) for name, call in calls.items()}
+        wait(futures.values(), timeout=deadline)
+
+        results, timings = {}, {}
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                timings[name] = {'missed': True}
+                continue
+            results[name], queued, elapsed = future.result()
+            timings[name] = {'ms': round(elapsed * 1000, 3), 'queued_ms': round(queued * 1000, 3)}
+        with self.lock:
+            self.runs += 1
+            for name in calls.keys() - results.keys():
+                self.missed[name] = self.missed.get(name, 0) + 1
+        return results, timings
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'runs': self.runs, 'missed': dict(self.missed)}
+
+
+engine_pool = EnginePool()
+
+
+@register_collector
+def engine_pool_metrics():
+    """Engine calls that missed their request's deadline, in the Prometheus text format"""
+    stats = engine_pool.stats()
+    lines = [
+        '# HELP moodconexus_engine_deadline_missed_total Engine calls left out of a response for missing its deadline.',
+        '# TYPE moodconexus_engine_deadline_missed_total counter',
+    ]
+    lines += [
+        f'moodconexus_engine_deadline_missed_total{{engine="{name}"}} {count}'
+        for name, count in sorted(stats['missed'].items())
+    ]
+    return lines
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Firestore collection of each catalog kind's favorites (written by the frontend)
+FAVORITE_COLLECTIONS = {'anime': 'favorite', 'book': 'favoriteBook'}
+
+# Users' profiles kept (LRU, one entry per user and kind) and how long one is
+# trusted without an invalidation, in seconds
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 2048))
+PROFILE_TTL = float(os.getenv('PROFILE_TTL', 600))
+# Seconds the favorites store is left alone after a failed read (e.g. Firebase not configured)
+STORE_RETRY_SECONDS = float(os.getenv('FAVORITES_RETRY_SECONDS', 300))
+
+
+class FirestoreFavorites:
+    """Favorite titles of a user (by email), read from the Firestore favorite collections"""
+
+    def __init__(self, db=None):
+        self._db = db
+
+    @property
+    def db(self):
+        if self._db is None:
+            # Imported on first use: it needs the Firebase SDK and the service account key
+            from firebase_config import db
+            self._db = db
+        return self._db
+
+    def titles(self, user, kind):
+        documents = self.db.collection(FAVORITE_COLLECTIONS[kind]).where('email', '==', user).stream()
+        return {document.to_dict().get('name') for document in documents} - {None}
+
+
+class MemoryFavorites:
+    """Favorites held in memory, with the interface of FirestoreFavorites (tests, runs without Firebase)"""
+
+    def __init__(self):
+        self.favorites = {}
+        self.lock = threading.Lock()
+
+    def add(self, user, kind, title):
+        with self.lock:
+            self.favorites.setdefault((user, kind), set()).add(title)
+
+    def remove(self, user, kind, title):
+        with self.lock:
+            self.favorites.get((user, kind), set()).discard(title)
+
+    def titles(self, user, kind):
+        with self.lock:
+            return set(self.favorites.get((user, kind), ()))
+
+
+def default_store():
+    """The favorites store named by FAVORITES_STORE: 'firestore' (default) or 'memory'"""
+    if os.getenv('FAVORITES_STORE', 'firestore') == 'memory':
+        return MemoryFavorites()
+    return FirestoreFavorites()
+
+
+class ProfileCache:
+    """Per-user UserProfiles, built from the favorites store on a miss.
+
+    Entries are evicted LRU, expire after ``ttl`` and are dropped by
+    ``invalidate`` when a user's favorites change. An entry built on an older
+    catalog version is rebuilt from its cached titles, without a store read.
+    A failed store read turns personalization off (profiles are None) for
+    ``retry_seconds``; the failure is logged once, not on every request.
+    """
+
+    def __init__(self, store, max_size=PROFILE_CACHE_SIZE, ttl=PROFILE_TTL, retry_seconds=STORE_RETRY_SECONDS):
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.retry_seconds = retry_seconds
+        # Why the store failed last, and until when it is not read again
+        self.store_error = None
+        self.unavailable_until = 0.0
+        # (user, kind) -> (expires, titles, catalog version, profile)
+        self.entries = OrderedDict()
+        # Bumped by every invalidation, so a profile read before one is not stored after it
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user, kind, engine, version):
+        """The profile of ``user`` in one catalog, or None if they saved nothing in it"""
+        key = (user, kind)
+        titles = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                expires, titles, built_version, profile = entry
+                if built_version == version:
+                    self.hits += 1
+                    return profile
+            else:
+                expires = None
+            self.misses += 1
+            invalidations = self.invalidations
+
+        if titles is None:
+            titles = self._read_titles(user, kind)
+            if titles is None:
+                return None
+            expires = time.monotonic() + self.ttl
+        profile = engine.build_profile(titles) if titles else None
+
+        with self.lock:
+            if self.invalidations != invalidations:
+                return profile
+            self.entries[key] = (expires, titles, version, profile)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return profile
+
+    def _read_titles(self, user, kind):
+        """The user's favorite titles from the store, or None while it is unavailable"""
+        if time.monotonic() < self.unavailable_until:
+            return None
+        try:
+            titles = frozenset(self.store.titles(user, kind))
+        except Exception as e:
+            with self.lock:
+                first_failure = self.store_error is None
+                self.store_error = f"{type(e).__name__}: {e}"
+                self.unavailable_until = time.monotonic() + self.retry_seconds
+            if first_failure:
+                logger.warning("Favorites store unavailable, not personalizing (retried every %.0fs)",
+                               self.retry_seconds, exc_info=True)
+            return None
+        if self.store_error is not None:
+            with self.lock:
+                self.store_error = None
+            logger.info("Favorites store available again")
+        return titles
+
+    def invalidate(self, user, kind=None):
+        """Forget a user's profile in one catalog (or all); returns the number of entries dropped"""
+        kinds = FAVORITE_COLLECTIONS if kind is None else (kind,)
+        with self.lock:
+            self.invalidations += 1
+            return sum(self.entries.pop((user, k), None) is not None for k in kinds)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'store_error': self.store_error}
@@ -0,0 +1,461 @@
+import os
+import copy
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from flask import Blueprint, current_app, request, jsonify
+from metrics import timed
+
+history_bp = Blueprint('history', __name__)
+logger = logging.getLogger(__name__)
+
+# Firestore collections: one document per captured emotion, one rollup document per user
+EVENTS_COLLECTION = 'emotions'
+ROLLUPS_COLLECTION = 'emotionRollups'
+# Firestore commits at most this many writes (event and rollup documents) per batch
+MAX_BATCH_WRITES = 500
+
+# Buffered events are committed once this many are waiting, or after this many seconds
+FLUSH_SIZE = int(os.getenv('HISTORY_FLUSH_SIZE', 200))
+FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 5))
+# Bytes of events held while the store is unreachable; the oldest are dropped beyond this
+MAX_BUFFER_BYTES = int(os.getenv('HISTORY_MAX_BUFFER_BYTES', 64 * 2**20))
+# Largest captured image (data URL) kept with an event; Firestore documents are at most 1 MiB
+MAX_IMAGE_BYTES = 900 * 1024
+# Users' rollups kept in memory, and how long one is trusted before it is read again
+# (other workers' writes show up after at most this long)
+ROLLUP_CACHE_SIZE = 4096
+ROLLUP_TTL = 30
+# Days of timeline an /api/history summary returns by default and at most
+DEFAULT_DAYS = 30
+MAX_DAYS = 366
+
+
+def empty_rollup():
+    return {'total': 0, 'counts': {}, 'days': {}, 'last_emotion': None, 'last_at': None}
+
+
+def rollup_events(events):
+    """Per-user rollup deltas of a list of events: {user: rollup}"""
+    deltas = {}
+    for event in events:
+        delta = deltas.setdefault(event['email'], empty_rollup())
+        add_to_rollup(delta, event)
+    return deltas
+
+
+def add_to_rollup(rollup, event):
+    """Count one event into a rollup (in place)"""
+    emotion, day = event['emotion'], event['timestamp'].strftime('%Y-%m-%d')
+    rollup['total'] += 1
+    rollup['counts'][emotion] = rollup['counts'].get(emotion, 0) + 1
+    day_counts = rollup['days'].setdefault(day, {})
+    day_counts[emotion] = day_counts.get(emotion, 0) + 1
+    if rollup['last_at'] is None or event['timestamp'] >= rollup['last_at']:
+        rollup['last_emotion'], rollup['last_at'] = emotion, event['timestamp']
+
+
+def merge_rollup(rollup, delta):
+    """Add a rollup delta into a rollup (in place)"""
+    rollup['total'] += delta['total']
+    for emotion, count in delta['counts'].items():
+        rollup['counts'][emotion] = rollup['counts'].get(emotion, 0) + count
+    for day, counts in delta['days'].items():
+        day_counts = rollup['days'].setdefault(day, {})
+        for emotion, count in counts.items():
+            day_counts[emotion] = day_counts.get(emotion, 0) + count
+    if delta['last_at'] is not None and (rollup['last_at'] is None or delta['last_at'] >= rollup['last_at']):
+        rollup['last_emotion'], rollup['last_at'] = delta['last_emotion'], delta['last_at']
+
+
+class FirestoreHistory:
+    """Emotion events and per-user rollups in Firestore, written with batched writes"""
+
+    def __init__(self, db=None):
+        self._db = db
+
+    @property
+    def db(self):
+        if self._db is None:
+            # Imported on first use: it needs the Firebase SDK and the service account key
+            from firebase_config import db
+            self._db = db
+        return self._db
+
+    def commit(self, events, deltas):
+        """Write the events and increment their users' rollups, all in one batch"""
+        from firebase_admin import firestore
+
+        batch = self.db.batch()
+        events_collection = self.db.collection(EVENTS_COLLECTION)
+        for event in events:
+            batch.set(events_collection.document(), event)
+        for user, delta in deltas.items():
+            update = {
+                'email': user,
+                'total': firestore.Increment(delta['total']),
+                'counts': {emotion: firestore.Increment(n) for emotion, n in delta['counts'].items()},
+                'days': {
+                    day: {emotion: firestore.Increment(n) for emotion, n in counts.items()}
+                    for day, counts in delta['days'].items()
+                },
+                'last_emotion': delta['last_emotion'],
+                'last_at': delta['last_at'],
+            }
+            batch.set(self.db.collection(ROLLUPS_COLLECTION).document(user), update, merge=True)
+        batch.commit()
+
+    def load_rollup(self, user):
+        """The stored rollup of a user (one document read), or None"""
+        document = self.db.collection(ROLLUPS_COLLECTION).document(user).get()
+        if not document.exists:
+            return None
+        rollup = empty_rollup()
+        rollup.update({k: v for k, v in document.to_dict().items() if k in rollup})
+        return rollup
+
+
+class MemoryHistory:
+    """Events and rollups held in memory, with the interface of FirestoreHistory (tests, runs without Firebase)"""
+
+    def __init__(self):
+        self.events = []
+        self.rollups = {}
+        self.commits = 0
+        # Set to an exception to make commits fail, e.g. to test an outage
+        self.failure = None
+        self.lock = threading.Lock()
+
+    def commit(self, events, deltas):
+        with self.lock:
+            if self.failure is not None:
+                raise self.failure
+            self.events.extend(events)
+            for user, delta in deltas.items():
+                merge_rollup(self.rollups.setdefault(user, empty_rollup()), delta)
+            self.commits += 1
+
+    def load_rollup(self, user):
+        with self.lock:
+            rollup = self.rollups.get(user)
+            return copy.deepcopy(rollup) if rollup is not None else None
+
+
+def default_store():
+    """The history store named by HISTORY_STORE: 'firestore' (default) or 'memory'"""
+    if os.getenv('HISTORY_STORE', 'firestore') == 'memory':
+        return MemoryHistory()
+    return FirestoreHistory()
+
+
+def _event_size(event):
+    return 256 + len(event.get('imageUrl') or '')
+
+
+class EmotionHistory:
+    """Write-behind log of captured emotions.
+
+    ``record`` only appends to an in-memory buffer; a background thread
+    commits the buffer in batched writes when it holds ``flush_size`` events,
+    every ``flush_interval`` seconds and at exit. Each batch also increments
+    the users' rollup documents, so summaries read one document per user
+    (cached for ROLLUP_TTL) plus the events not committed yet, never the
+    event collection. Failed batches go back to the buffer and are retried.
+    """
+
+    def __init__(self, store, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffer_bytes=MAX_BUFFER_BYTES):
+        self.store = store
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.close)
+
+    def _reset(self):
+        # Also run in forked children: the parent's buffer and flusher thread stay with the parent
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.buffer = []
+        self.buffer_bytes = 0
+        # Rollup deltas of the buffered and in-flight events, per user
+        self.pending = {}
+        # user -> (expires, rollup) of recently read stored rollups
+        self.rollups = OrderedDict()
+        self.thread = None
+        self.closed = False
+        self.backoff = False
+        self.recorded = 0
+        self.committed = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def record(self, event):
+        """Queue one event ({'email', 'emotion', 'confidence', 'timestamp', optional 'imageUrl'})"""
+        with self.condition:
+            self.buffer.append(event)
+            self.buffer_bytes += _event_size(event)
+            add_to_rollup(self.pending.setdefault(event['email'], empty_rollup()), event)
+            self.recorded += 1
+            self._drop_overflow()
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, name='history-flush', daemon=True)
+                self.thread.start()
+            if len(self.buffer) >= self.flush_size and not self.backoff:
+                self.condition.notify()
+
+    def _drop_overflow(self):
+        # Caller holds the condition. Oldest first: recent history matters most.
+        while self.buffer_bytes > self.max_buffer_bytes and self.buffer:
+            event = self.buffer.pop(0)
+            self.buffer_bytes -= _event_size(event)
+            self._unpend([event])
+            self.dropped += 1
+
+    def _unpend(self, events):
+        # Caller holds the condition
+        for user, delta in rollup_events(events).items():
+            pending = self.pending.get(user)
+            if pending is None:
+                continue
+            pending['total'] -= delta['total']
+            for emotion, count in delta['counts'].items():
+                pending['counts'][emotion] -= count
+            for day, counts in delta['days'].items():
+                for emotion, count in counts.items():
+                    pending['days'][day][emotion] -= count
+            if pending['total'] <= 0:
+                del self.pending[user]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.closed and (self.backoff or len(self.buffer) < self.flush_size):
+                    self.condition.wait(self.flush_interval)
+                if self.closed:
+                    return
+            failures = self.failures
+            self.flush()
+            # After a failed commit, wait out the interval even if the buffer is full
+            self.backoff = self.failures != failures
+
+    def flush(self):
+        """Commit everything buffered now; returns the number of events committed"""
+        with self.flush_lock:
+            with self.condition:
+                events, self.buffer, self.buffer_bytes = self.buffer, [], 0
+            committed = 0
+            with timed('history_flush'):
+                for chunk in self._chunks(events):
+                    deltas = rollup_events(chunk)
+                    try:
+                        self.store.commit(chunk, deltas)
+                    except Exception:
+                        self._requeue(events[committed:])
+                        self.failures += 1
+                        logger.warning("Emotion history commit failed, %d events kept for retry",
+                                       len(events) - committed, exc_info=True)
+                        break
+                    committed += len(chunk)
+                    with self.condition:
+                        self._unpend(chunk)
+                        self.committed += len(chunk)
+                        self._apply_to_cached(deltas)
+            return committed
+
+    @staticmethod
+    def _chunks(events):
+        """Runs of events whose event and rollup writes fit in one batch"""
+        chunk, users = [], set()
+        for event in events:
+            # Writes of the chunk with this event: one per event plus one per user's rollup
+            writes = len(chunk) + 1 + len(users) + (event['email'] not in users)
+            if chunk and writes > MAX_BATCH_WRITES:
+                yield chunk
+                chunk, users = [], set()
+            chunk.append(event)
+            users.add(event['email'])
+        if chunk:
+            yield chunk
+
+    def _requeue(self, events):
+        with self.condition:
+            self.buffer[:0] = events
+            self.buffer_bytes += sum(_event_size(event) for event in events)
+            self._drop_overflow()
+
+    def _apply_to_cached(self, deltas):
+        # Caller holds the condition. Keeps cached stored rollups in step with our own commits.
+        for user, delta in deltas.items():
+            entry = self.rollups.get(user)
+            if entry is not None:
+                merge_rollup(entry[1], delta)
+
+    def rollup(self, user):
+        """A user's rollup: the stored one (cached) plus the events not committed yet"""
+        with self.condition:
+            entry = self.rollups.get(user)
+            fresh = entry is not None and entry[0] >= time.monotonic()
+            if fresh:
+                self.rollups.move_to_end(user)
+                stored = copy.deepcopy(entry[1])
+        if not fresh:
+            stored = self.store.load_rollup(user) or empty_rollup()
+            with self.condition:
+                self.rollups[user] = (time.monotonic() + ROLLUP_TTL, copy.deepcopy(stored))
+                self.rollups.move_to_end(user)
+                while len(self.rollups) > ROLLUP_CACHE_SIZE:
+                    self.rollups.popitem(last=False)
+        with self.condition:
+            pending = self.pending.get(user)
+            if pending is not None:
+                merge_rollup(stored, pending)
+        return stored
+
+    def stats(self):
+        with self.condition:
+            return {
+                'buffered': len(self.buffer),
+                'buffered_bytes': self.buffer_bytes,
+                'recorded': self.recorded,
+                'committed': self.committed,
+                'dropped': self.dropped,
+                'failed_commits': self.failures,
+            }
+
+    def close(self):
+        """Stop the flusher and commit what is left (called at exit)"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        if self.buffer:
+            self.flush()
+
+
+def verify_firebase_token(token):
+    """Email of the Firebase user an ID token was issued to.
+
+    Raises ``ValueError`` if the token is malformed, expired or has no
+    email; other errors mean the token could not be checked.
+    """
+    # Imported on first use: it needs the Firebase SDK and the service account key
+    from firebase_config import firebase_admin
+    from firebase_admin import auth
+    try:
+        claims = auth.verify_id_token(token, app=firebase_admin.get_app())
+    except (ValueError, auth.InvalidIdTokenError) as e:
+        raise ValueError(f"Invalid ID token: {e}")
+    if not claims.get('email'):
+        raise ValueError("The ID token has no email")
+    return claims['email']
+
+
+def authenticate():
+    """``(email, None)`` of the caller, from its ``Authorization: Bearer <Firebase ID token>`` header.
+
+    ``(None, response)`` with a 401 (or 503 if tokens cannot be checked
+    now) when it is missing or not valid.
+    """
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer ') or not header[len('Bearer '):].strip():
+        return None, (jsonify({'status': 'error', 'message': 'Sign in first: a Firebase ID token is required'}), 401)
+    try:
+        return current_app.extensions['verify_token'](header[len('Bearer '):].strip()), None
+    except ValueError as e:
+        return None, (jsonify({'status': 'error', 'message': str(e)}), 401)
+    except Exception as e:
+        logger.warning("Could not verify an ID token: %s: %s", type(e).__name__, e)
+        return None, (jsonify({'status': 'error', 'message': 'Sign-in cannot be checked right now'}), 503)
+
+
+def read_event(data, user):
+    """A history event of ``user`` (the authenticated email) from a request body; raises ``ValueError`` if malformed"""
+    emotion = data.get('emotion')
+    if not isinstance(emotion, str) or not emotion.strip():
+        raise ValueError("emotion is required")
+    confidence = data.get('confidence', 1.0)
+    if not isinstance(confidence, (int, float)) or isinstance(confidence, bool) or not 0 <= confidence <= 1:
+        raise ValueError("confidence must be a number between 0 and 1")
+    event = {
+        'email': user.strip(),
+        'emotion': emotion.lower().strip(),
+        'confidence': float(confidence),
+        'timestamp': datetime.now(timezone.utc),
+    }
+    image = data.get('imageUrl')
+    if image:
+        if not isinstance(image, str) or len(image) > MAX_IMAGE_BYTES:
+            raise ValueError(f"imageUrl must be a string of at most {MAX_IMAGE_BYTES} bytes")
+        event['imageUrl'] = image
+    return event
+
+
+@history_bp.route('/api/history', methods=['POST'])
+def record_history():
+    """Log a captured emotion of the signed-in user: {"emotion": ..., "confidence": 0-1, "imageUrl": optional}.
+
+    Answers 202 at once; the event is committed to the store in the background.
+    The user is the one the ID token names; a "user" in the body is ignored.
+    """
+    user, error = authenticate()
+    if error is not None:
+        return error
+    try:
+        event = read_event(request.get_json(silent=True) or {}, user)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    current_app.extensions['history'].record(event)
+    return jsonify({'status': 'accepted'}), 202
+
+
+@history_bp.route('/api/history/<path:user>', methods=['GET'])
+def history_summary(user):
+    """Emotion counts of a user and their per-day timeline over the last ``days`` days (their own only)"""
+    email, error = authenticate()
+    if error is not None:
+        return error
+    if user.strip().lower() != email.lower():
+        return jsonify({'status': 'error', 'message': 'You can only read your own emotion history'}), 403
+    user = email
+    days = request.args.get('days', DEFAULT_DAYS, type=int)
+    if not 1 <= days <= MAX_DAYS:
+        return jsonify({'status': 'error', 'message': f'days must be between 1 and {MAX_DAYS}'}), 400
+    try:
+        rollup = current_app.extensions['history'].rollup(user)
+    except Exception:
+        logger.warning("Could not read the emotion history of %s", user, exc_info=True)
+        return jsonify({'status': 'error', 'message': 'Emotion history is unavailable'}), 503
+
+    today = datetime.now(timezone.utc).date()
+    timeline = []
+    for offset in range(days - 1, -1, -1):
+        day = (today - timedelta(days=offset)).isoformat()
+        counts = {emotion: n for emotion, n in rollup['days'].get(day, {}).items() if n}
+        if counts:
+            timeline.append({'date': day, 'counts': counts})
+    counts = {emotion: n for emotion, n in rollup['counts'].items() if n}
+    return jsonify({
+        'status': 'success',
+        'user': user,
+        'total': rollup['total'],
+        'counts': counts,
+        'dominant_emotion': max(counts, key=counts.get) if counts else None,
+        'last_emotion': rollup['last_emotion'],
+        'last_at': rollup['last_at'].isoformat() if rollup['last_at'] else None,
+        'timeline': timeline,
+    })
+
+
+@history_bp.route('/api/history/stats', methods=['GET'])
+def history_stats():
+    """Write-behind buffer counters (signed-in users only)"""
+    _, error = authenticate()
+    if error is not None:
+        return error
+    return jsonify(current_app.extensions['history'].stats())
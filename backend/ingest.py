@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from dataset import GENRE_COLUMNS, clean_frame, combine_features
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows: the catalog lock is then a no-op, so serve catalog updates from one process
+    fcntl = None
+
+# Items added or updated through the ingestion API, applied on top of the XLSX catalog
+OVERLAY_DIR = os.path.join('models', 'ingested')
+
+# Columns an ingested item must have, and defaults for the optional ones (used for new items;
+# an update leaves the optional fields it does not send as they were)
+REQUIRED_COLUMNS = {
+    'anime': ('title', 'description', 'genre', 'emotion'),
+    'book': ('title', 'description', 'emotion_based_genre', 'emotion'),
+}
+OPTIONAL_COLUMNS = {
+    'anime': {'episodes': 0, 'rating': 0.0, 'thumbnail': '', 'previewlink': ''},
+    'book': {'rating': 0.0, 'thumbnail': '', 'previewLink': ''},
+}
+
+
+def prepare_items(kind, records):
+    """Validate raw item dicts and clean them like the catalog (emotion mapping, features).
+
+    Optional fields an item does not send stay missing (NaN), so
+    ``merge_items`` can tell them from values to write.
+    Raises ``ValueError`` if a required field is missing or empty.
+    """
+    if kind not in REQUIRED_COLUMNS:
+        raise ValueError(f"Unknown kind '{kind}', expected one of {sorted(REQUIRED_COLUMNS)}")
+    if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+        raise ValueError("items must be a non-empty list of objects")
+
+    for i, record in enumerate(records):
+        missing = [c for c in REQUIRED_COLUMNS[kind] if not str(record.get(c) or '').strip()]
+        if missing:
+            raise ValueError(f"Item {i} is missing {', '.join(missing)}")
+
+    required, optional = list(REQUIRED_COLUMNS[kind]), list(OPTIONAL_COLUMNS[kind])
+    items = pd.DataFrame(records).reindex(columns=required + optional)
+    try:
+        items['rating'] = items['rating'].astype(float)
+    except (TypeError, ValueError):
+        raise ValueError("rating must be a number")
+    items = pd.concat([clean_frame(items[required].copy(), kind), items[optional]], axis=1)
+
+    # Later duplicates of a title win
+    keys = items['title'].str.lower().str.strip()
+    return items[~keys.duplicated(keep='last')].reset_index(drop=True)
+
+
+def merge_items(df, items, kind, fill_defaults=True):
+    """Upsert items into a catalog frame by (case-insensitive) title.
+
+    An existing title is updated in place, in every row that holds it: the
+    fields the item sent are written, the others and the title's casing are
+    kept. New titles are appended, with OPTIONAL_COLUMNS defaults for the
+    fields they lack unless ``fill_defaults`` is False (the overlay keeps
+    them missing, as sent). Row positions of untouched items do not move.
+    Returns ``(df, positions)`` with the sorted positions of the changed rows.
+    """
+    rows_of = {}
+    for position, title in enumerate(df['title'].astype(str).str.lower().str.strip()):
+        rows_of.setdefault(title, []).append(position)
+
+    items = items.reindex(columns=df.columns)
+    rows, item_rows, new_rows = [], [], []
+    for item_row, title in enumerate(items['title'].str.lower().str.strip()):
+        if title in rows_of:
+            rows += rows_of[title]
+            item_rows += [item_row] * len(rows_of[title])
+        else:
+            new_rows.append(item_row)
+
+    added = items.iloc[new_rows]
+    if fill_defaults:
+        added = added.fillna(OPTIONAL_COLUMNS[kind])
+    merged = pd.concat([df, added], ignore_index=True)
+    for column in merged.columns.drop(['title', 'features']):
+        values = items[column].to_numpy()[item_rows]
+        sent = pd.notna(values)
+        merged.iloc[np.asarray(rows)[sent], merged.columns.get_loc(column)] = values[sent]
+
+    positions = np.unique(np.concatenate([rows, np.arange(len(df), len(merged))])).astype(np.int64)
+    # Titles keep their casing and descriptions may have changed: rebuild the features
+    merged.iloc[positions, merged.columns.get_loc('features')] = combine_features(merged.iloc[positions], kind).to_numpy()
+    # concat can widen dtypes (e.g. int episodes); keep the catalog's where possible
+    merged = merged.astype(df.dtypes.to_dict(), errors='ignore')
+    return merged, positions
+
+
+def transform_rows(tfidf_matrix, vectorizer, features, positions):
+    """Matrix with the rows at ``positions`` replaced or appended, using the fitted vocabulary.
+
+    The vectorizer is not refitted: new items are projected onto the existing
+    vocabulary and IDF weights, so no other row changes.
+    """
+    rows = vectorizer.transform(features).astype(np.float32).tocsr()
+    n_old = tfidf_matrix.shape[0]
+    n_new = max(n_old, int(positions.max()) + 1)
+
+    # Row i of the result is row source[i] of [old matrix; new rows]
+    source = np.arange(n_new)
+    source[positions] = n_old + np.arange(len(positions))
+    stacked = sp.vstack([tfidf_matrix, rows], format='csr')
+    if np.array_equal(source[:n_old], np.arange(n_old)):
+        # Appends only: the new rows are already in order at the end
+        return stacked
+    return stacked[source].tocsr()
+
+
+def _overlay_path(kind, overlay_dir):
+    return os.path.join(overlay_dir, f'{kind}.parquet')
+
+
+def load_overlay(kind, overlay_dir=OVERLAY_DIR):
+    """Items ingested so far for ``kind``, or None"""
+    path = _overlay_path(kind, overlay_dir)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_overlay(kind, items, overlay_dir=OVERLAY_DIR):
+    """Upsert items into the persisted overlay (written atomically)"""
+    existing = load_overlay(kind, overlay_dir)
+    if existing is not None:
+        # Same upsert as on the catalog, so replaying the overlay gives the same row order
+        items = merge_items(existing, items, kind, fill_defaults=False)[0]
+    os.makedirs(overlay_dir, exist_ok=True)
+    tmp_path = _overlay_path(kind, overlay_dir) + '.tmp'
+    items.to_parquet(tmp_path)
+    os.replace(tmp_path, _overlay_path(kind, overlay_dir))
+
+
+def read_generation(overlay_dir=OVERLAY_DIR):
+    """Number of catalog updates persisted so far (0 before the first)"""
+    try:
+        with open(os.path.join(overlay_dir, 'generation')) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_generation(generation, overlay_dir=OVERLAY_DIR):
+    """Record a persisted catalog update (written atomically, after its overlay and bundle)"""
+    os.makedirs(overlay_dir, exist_ok=True)
+    path = os.path.join(overlay_dir, 'generation')
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(generation))
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def catalog_lock(shared=False, overlay_dir=OVERLAY_DIR):
+    """Cross-process lock on the persisted catalog (overlay, model bundles and generation).
+
+    Updates hold it exclusively; loads hold it shared so they never read a
+    half-written update. Blocks until it is granted.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(overlay_dir, exist_ok=True)
+    with open(os.path.join(overlay_dir, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def apply_overlay(kind, df, overlay_dir=OVERLAY_DIR):
+    """The catalog frame with the persisted ingested items upserted"""
+    items = load_overlay(kind, overlay_dir)
+    if items is None:
+        return df
+    return merge_items(df, items, kind)[0]
+
+
+if __name__ == '__main__':
+    # CATALOG_TOKEN=... python ingest.py anime new_items.json [http://localhost:5000]
+    # The file holds a list of items (or one item); they are sent to the running
+    # server, which swaps in the updated catalog without a restart.
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in GENRE_COLUMNS:
+        print("usage: CATALOG_TOKEN=<token> python ingest.py anime|book <items.json> [server url]")
+        sys.exit(1)
+    token = os.getenv('CATALOG_TOKEN')
+    if not token:
+        print("CATALOG_TOKEN must be set to the server's catalog token")
+        sys.exit(1)
+    import requests
+    with open(sys.argv[2]) as f:
+        items = json.load(f)
+    if isinstance(items, dict):
+        items = [items]
+    url = (sys.argv[3] if len(sys.argv) == 4 else 'http://localhost:5000').rstrip('/')
+    response = requests.post(f'{url}/api/catalog/{sys.argv[1]}', json={'items': items},
+                             headers={'Authorization': f'Bearer {token}'}, timeout=60)
+    print(json.dumps(response.json(), indent=2))
+    sys.exit(0 if response.ok else 1)
@@ -0,0 +1,108 @@
+import re
+import sys
+from collections import namedtuple
+
+# A "recommend <kinds> for <emotion>" chat message
+RecommendIntent = namedtuple('RecommendIntent', ['emotion', 'kinds'])
+
+# Words that mark a message as asking for suggestions
+REQUEST_WORDS = (
+    'recommend', 'recommendation', 'recommendations', 'suggest', 'suggestion', 'suggestions',
+    'give me', 'show me', 'any good', 'something to', 'what should i', 'what can i', 'recs',
+)
+
+# Catalog kind of each phrase that names one; verbs only count with "to" ("to watch", not
+# "a watch"), and "show" only as a noun ("a show", not "show me")
+KIND_WORDS = {
+    'anime': ('anime', 'animes', 'manga', 'tv show', 'tv shows', 'a show', 'shows', 'series', 'to watch'),
+    'book': ('book', 'books', 'novel', 'novels', 'to read'),
+}
+
+# Words that name catalog items without picking a kind
+CATALOG_WORDS = ('recommendation', 'recommendations', 'suggestion', 'suggestions', 'recs', 'title', 'titles')
+
+# Catalog emotion of each word that expresses one
+EMOTION_WORDS = {
+    'happy': ('happy', 'happiness', 'joy', 'joyful', 'cheerful', 'cheer me up', 'excited', 'glad', 'good mood'),
+    'sad': ('sad', 'sadness', 'down', 'depressed', 'unhappy', 'lonely', 'heartbroken', 'gloomy', 'crying', 'upset'),
+    'anger': ('angry', 'anger', 'mad', 'furious', 'annoyed', 'frustrated', 'irritated'),
+    'fear': ('scared', 'afraid', 'fear', 'fearful', 'anxious', 'nervous', 'worried', 'terrified', 'stressed'),
+    'surprise': ('surprised', 'surprise', 'shocked', 'amazed', 'astonished'),
+    'disgust': ('disgusted', 'disgust', 'grossed out'),
+    'neutral': ('neutral', 'bored', 'meh', 'calm'),
+}
+
+NEGATIONS = {'not', 'no', 'never', "don't", 'dont', "isn't", "aren't", "wasn't", "ain't", "nothing"}
+
+
+def _pattern(words):
+    alternatives = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})\b")
+
+
+REQUEST_PATTERN = _pattern(REQUEST_WORDS)
+CATALOG_PATTERN = _pattern(CATALOG_WORDS)
+KIND_PATTERNS = {kind: _pattern(words) for kind, words in KIND_WORDS.items()}
+EMOTION_PATTERNS = {emotion: _pattern(words) for emotion, words in EMOTION_WORDS.items()}
+
+
+def _negated(text, start, window=3):
+    """Whether one of the ``window`` words before ``start`` negates what follows"""
+    return any(word in NEGATIONS for word in text[:start].split()[-window:])
+
+
+def detect_intent(message):
+    """Classify a chat message as a recommendation request, or return None for open-ended chat.
+
+    A message is routed only if it asks for suggestions, names catalog items
+    ("give me a hug" does not) and names exactly one emotion (not negated,
+    so "I'm not sad" goes to the LLM). The kinds are the catalogs it
+    mentions, or both if it names neither.
+    """
+    text = message.lower().replace('’', "'")
+    if not REQUEST_PATTERN.search(text):
+        return None
+    kinds = tuple(kind for kind, pattern in KIND_PATTERNS.items() if pattern.search(text))
+    if not kinds and not CATALOG_PATTERN.search(text):
+        return None
+
+    emotions = {
+        emotion
+        for emotion, pattern in EMOTION_PATTERNS.items()
+        for match in pattern.finditer(text)
+        if not _negated(text, match.start())
+    }
+    if len(emotions) != 1:
+        return None
+    return RecommendIntent(emotions.pop(), kinds or tuple(KIND_WORDS))
+
+
+# Messages and the intent they must get; run ``python intents.py`` after editing the word lists
+EXAMPLES = (
+    ("Recommend an anime for when I'm sad", RecommendIntent('sad', ('anime',))),
+    ("Any good books? I'm so stressed", RecommendIntent('fear', ('book',))),
+    ("I'm bored, give me something to watch", RecommendIntent('neutral', ('anime',))),
+    ("Suggest a tv show or a novel, I'm happy", RecommendIntent('happy', ('anime', 'book'))),
+    ("Any recommendations? I feel lonely", RecommendIntent('sad', ('anime', 'book'))),
+    ("Show me a book for when I'm sad", RecommendIntent('sad', ('book',))),
+    ("I have a watch. Suggest a novel, I'm upset", RecommendIntent('sad', ('book',))),
+    ("Give me a hug, I'm down", None),
+    ("Show me how to breathe, I'm anxious", None),
+    ("I'm not sad, recommend an anime", None),
+    ("Recommend a book, I'm happy but also scared", None),
+    ("What is your favourite anime?", None),
+)
+
+
+def check_examples():
+    """Detect the intent of every EXAMPLES message; returns the ones that got another intent"""
+    return [(message, expected, detect_intent(message))
+            for message, expected in EXAMPLES if detect_intent(message) != expected]
+
+
+if __name__ == '__main__':
+    failures = check_examples()
+    for message, expected, got in failures:
+        print(f"{message!r}: expected {expected}, got {got}")
+    print(f"{len(EXAMPLES) - len(failures)}/{len(EXAMPLES)} examples routed as expected")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,134 @@
+"""Low-rank (LSA) scoring mode: compare it against the exact TF-IDF path.
+
+    ENGINE_MODE=lsa LSA_COMPONENTS=128 python app.py
+    python lsa.py compare --components 64,128,256 --k 10,50,200
+
+Items are projected once onto the top singular vectors of their TF-IDF
+matrix (TruncatedSVD), and queries are scored with one dense product over
+that ``(n_items, n_components)`` float32 embedding instead of a
+sparse-dense product over the vocabulary. Scores stay cosines in the
+TF-IDF space: each item's projection is divided by its exact TF-IDF norm,
+so the thresholds of the exact path still apply.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+
+logger = logging.getLogger(__name__)
+
+# Dimensions of the embedding when ENGINE_MODE=lsa (64-256 trades recall for speed)
+LSA_COMPONENTS = int(os.getenv('LSA_COMPONENTS', 128))
+
+
+def fit_lsa(tfidf_matrix, n_components=LSA_COMPONENTS, seed=0):
+    """Fit the projection of a TF-IDF matrix; returns ``(projection, embedding)``.
+
+    ``projection`` is ``(n_components, vocabulary)`` and ``embedding`` the
+    projected rows, ``(n_items, n_components)``, both float32.
+    """
+    start = time.perf_counter()
+    n_components = min(n_components, min(tfidf_matrix.shape) - 1)
+    svd = TruncatedSVD(n_components, random_state=seed).fit(tfidf_matrix)
+    projection = np.ascontiguousarray(svd.components_, dtype=np.float32)
+    logger.info("Fitted %d-component LSA (%.1f%% of the variance) in %.2fs", n_components,
+                svd.explained_variance_ratio_.sum() * 100, time.perf_counter() - start)
+    return projection, embed(tfidf_matrix, projection)
+
+
+def embed(rows, projection):
+    """TF-IDF rows projected onto the LSA components, as a contiguous float32 array"""
+    return np.ascontiguousarray(rows @ projection.T, dtype=np.float32)
+
+
+def recall_at_k(exact, approx, k):
+    """Mean share of each query's exact top-k items that the approximate scores also rank in their top k"""
+    k = min(k, exact.shape[0])
+    exact_top = np.argpartition(-exact, k - 1, axis=0)[:k]
+    approx_top = np.argpartition(-approx, k - 1, axis=0)[:k]
+    return float(np.mean([
+        len(np.intersect1d(exact_top[:, q], approx_top[:, q])) / k
+        for q in range(exact.shape[1])
+    ]))
+
+
+def _median_ms(call, repeat):
+    call()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def compare(components, ks, n_mixes=64, repeat=50, seed=0):
+    """Print scoring latency, scoring-matrix size and recall@k of each LSA size against exact TF-IDF.
+
+    Queries are the emotion centroids (the precomputed candidate tables)
+    and ``n_mixes`` random blends of them (the blended path), on the
+    catalog the app would load.
+    """
+    from catalog import load_or_build_model
+    from dataset import load_data
+    from engine import RecommendationEngine
+    from ingest import apply_overlay
+
+    rng = np.random.default_rng(seed)
+    print(f"{'catalog':<7} {'mode':<9} {'fit s':>6} {'MB':>7} {'1 query ms':>11} "
+          f"{f'{n_mixes} mixes ms':>14} {'candidates':>11} " + ' '.join(f"{f'recall@{k}':>10}" for k in ks))
+    for kind, df in zip(('anime', 'book'), load_data()):
+        df = apply_overlay(kind, df)
+        vectorizer, tfidf, neighbors, _, postings = load_or_build_model(kind, df)
+        exact_engine = RecommendationEngine(df, vectorizer, tfidf, neighbors=neighbors, postings=postings)
+        n_emotions = len(exact_engine.emotion_names)
+        one_hot = np.eye(n_emotions, dtype=np.float32)
+        mixes = rng.dirichlet(np.ones(n_emotions), n_mixes).astype(np.float32)
+        queries = np.vstack([one_hot, mixes])
+        exact = exact_engine.score_queries(queries)
+
+        size_mb = (tfidf.data.nbytes + tfidf.indices.nbytes + tfidf.indptr.nbytes) / 2**20
+        print(f"{kind:<7} {'tfidf':<9} {'-':>6} {size_mb:>7.2f} "
+              f"{_median_ms(lambda: exact_engine.score_queries(one_hot[:1]), repeat):>11.3f} "
+              f"{_median_ms(lambda: exact_engine.score_queries(mixes), repeat):>14.3f} "
+              f"{sum(len(p) for p, _ in exact_engine.candidates.values()):>11} " + ' '.join(f"{1:>10.3f}" for _ in ks))
+
+        for n_components in components:
+            start = time.perf_counter()
+            lsa = fit_lsa(tfidf, n_components, seed)
+            fit_seconds = time.perf_counter() - start
+            engine = RecommendationEngine(df, vectorizer, tfidf, neighbors=neighbors, lsa=lsa, postings=postings)
+            approx = engine.score_queries(queries)
+            # Share of the exact candidate tables (above min_similarity) kept by the LSA ones
+            kept = sum(len(np.intersect1d(p, engine.candidates[emotion][0]))
+                       for emotion, (p, _) in exact_engine.candidates.items())
+            total = sum(len(p) for p, _ in exact_engine.candidates.values())
+            print(f"{kind:<7} {f'lsa-{lsa[0].shape[0]}':<9} {fit_seconds:>6.2f} {lsa[1].nbytes / 2**20:>7.2f} "
+                  f"{_median_ms(lambda: engine.score_queries(one_hot[:1]), repeat):>11.3f} "
+                  f"{_median_ms(lambda: engine.score_queries(mixes), repeat):>14.3f} "
+                  f"{f'{kept / max(total, 1):.0%} kept':>11} "
+                  + ' '.join(f"{recall_at_k(exact, approx, k):>10.3f}" for k in ks))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    compare_parser = commands.add_parser('compare', help='benchmark LSA sizes against exact TF-IDF scoring')
+    compare_parser.add_argument('--components', default='64,128,256',
+                                help='comma-separated embedding sizes (default: %(default)s)')
+    compare_parser.add_argument('--k', default='10,50,200', help='comma-separated recall cut-offs (default: %(default)s)')
+    compare_parser.add_argument('--mixes', type=int, default=64, help='random blended queries scored together')
+    compare_parser.add_argument('--repeat', type=int, default=50, help='timed runs per measurement')
+    compare_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    compare([int(n) for n in args.components.split(',')], [int(k) for k in args.k.split(',')],
+            args.mixes, args.repeat, args.seed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
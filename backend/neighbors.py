@@ -0,0 +1,195 @@
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+# Upper bound on the dense similarity block held in memory at once (float32 cells)
+BLOCK_CELLS = 1 << 25
+# Catalogs up to this many items get the exact all-pairs index; larger ones are built from
+# pruned candidates, at a cost linear in the catalog size
+EXACT_MAX_ITEMS = 20000
+# Per term, only its heaviest postings propose candidates in a pruned build
+POSTINGS_PER_TERM = 128
+# Candidates per item rescored exactly in a pruned build, as a multiple of k
+CANDIDATE_FACTOR = 5
+# Approximate bytes per (item, candidate) pair while a pruned build ranks them
+PAIR_BYTES = 48
+
+
+def build_neighbors(tfidf_matrix, k=20, block_cells=BLOCK_CELLS, exact_max_items=EXACT_MAX_ITEMS):
+    """Top-k cosine neighbours of every item, excluding the item itself.
+
+    Catalogs of up to ``exact_max_items`` items are compared all-pairs, a
+    block of rows at a time (``block @ X.T``) so memory stays bounded by
+    ``block_cells``. Larger ones go through ``_pruned_neighbors``, whose
+    cost grows linearly rather than quadratically with the catalog.
+    Returns ``(indices, scores)``, both shaped ``(n_items, k)`` and sorted by
+    descending score; lists with fewer than k similar items are padded with
+    the item itself at score 0.
+    """
+    matrix = normalize(tfidf_matrix.astype(np.float32), copy=True).tocsr()
+    n_items = matrix.shape[0]
+    k = min(k, max(n_items - 1, 0))
+    if n_items > exact_max_items and k > 0:
+        return _pruned_neighbors(matrix, k, block_cells=block_cells)
+
+    indices = np.zeros((n_items, k), dtype=np.int32)
+    scores = np.zeros((n_items, k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+
+    transposed = matrix.T.tocsc()
+    block_rows = max(1, block_cells // max(n_items, 1))
+    for start in range(0, n_items, block_rows):
+        stop = min(start + block_rows, n_items)
+        block = (matrix[start:stop] @ transposed).toarray()
+
+        # An item is not its own neighbour
+        rows = np.arange(stop - start)
+        block[rows, rows + start] = -np.inf
+
+        # Partial selection of the k best, then sort just those
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        indices[start:stop] = np.take_along_axis(top, order, axis=1)
+        scores[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+
+    return indices, scores
+
+
+def _top_per_row(rows, values, limit):
+    """Entries holding the ``limit`` largest ``values`` of each row, as ``(entries, ranks)`` sorted by row then value.
+
+    ``values`` are cosines (0 to 1), so one sort of ``2 * row - value`` orders by both.
+    """
+    order = np.argsort(2.0 * rows - values)
+    counts = np.bincount(rows)
+    ranks = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = ranks < limit
+    return order[keep], ranks[keep]
+
+
+def _pruned_neighbors(matrix, k, postings_per_term=POSTINGS_PER_TERM,
+                      candidates=None, block_cells=BLOCK_CELLS):
+    """Approximate top-k neighbours of the unit rows of ``matrix``: pruned candidates, exact scores.
+
+    The term-major (inverted) index keeps only the ``postings_per_term``
+    heaviest postings of each term, so an item is only compared against
+    items that weigh heavily on at least one of its terms, and a term shared
+    by much of the catalog costs a bounded amount. Each item's best
+    ``candidates`` by that partial score are rescored exactly and the top k
+    kept, so every listed score is the true cosine; a neighbour is missed
+    only when none of the shared terms ranks it among their heaviest items.
+    """
+    n_items = matrix.shape[0]
+    candidates = candidates or CANDIDATE_FACTOR * k
+    indices = np.repeat(np.arange(n_items, dtype=np.int32)[:, None], k, axis=1)
+    scores = np.zeros((n_items, k), dtype=np.float32)
+
+    postings = matrix.T.tocsr()
+    terms = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+    kept, _ = _top_per_row(terms, postings.data, postings_per_term)
+    pruned = sp.csr_matrix(
+        (postings.data[kept], postings.indices[kept],
+         np.concatenate([[0], np.cumsum(np.bincount(terms[kept], minlength=postings.shape[0]))])),
+        shape=postings.shape,
+    )
+
+    # A row's partial scores touch at most postings_per_term items per term; each such pair
+    # takes about PAIR_BYTES while it is ranked, against 4 bytes per dense float32 cell
+    row_pairs = postings_per_term * max(matrix.nnz // max(n_items, 1), 1)
+    block_rows = max(1, 4 * block_cells // (PAIR_BYTES * row_pairs))
+    for start in range(0, n_items, block_rows):
+        stop = min(start + block_rows, n_items)
+        partial = (matrix[start:stop] @ pruned).tocoo()
+        rows, columns = partial.row.astype(np.int64), partial.col.astype(np.int64)
+        # An item is not its own neighbour
+        other = columns != rows + start
+        rows, columns, values = rows[other], columns[other], partial.data[other]
+
+        best, _ = _top_per_row(rows, values, candidates)
+        rows, columns = rows[best], columns[best]
+        exact = np.asarray(matrix[rows + start].multiply(matrix[columns]).sum(axis=1), dtype=np.float32).ravel()
+
+        best, slots = _top_per_row(rows, exact, k)
+        indices[rows[best] + start, slots] = columns[best]
+        scores[rows[best] + start, slots] = exact[best]
+
+    return indices, scores
+
+
+def blend_neighbors(indices, scores, seeds, top_n=None):
+    """Combine the neighbour lists of several seed items.
+
+    Each candidate's score is its mean similarity over all seeds (0 for seeds
+    it is not a top-k neighbour of), so items close to several seeds rank
+    first. Seeds themselves are excluded.
+    Returns ``(positions, scores)`` sorted by descending blended score.
+    """
+    seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+    candidates = indices[seeds].ravel()
+    weights = scores[seeds].ravel()
+
+    # Average each candidate's scores over the seeds it neighbours
+    positions, inverse = np.unique(candidates, return_inverse=True)
+    blended = (np.bincount(inverse, weights=weights) / len(seeds)).astype(np.float32)
+
+    keep = ~np.isin(positions, seeds) & (blended > 0)
+    positions, blended = positions[keep], blended[keep]
+    order = np.argsort(-blended, kind='stable')[:top_n]
+    return positions[order], blended[order]
+
+
+def patch_neighbors(tfidf_matrix, indices, scores, changed):
+    """Update a top-k neighbour index after the rows at ``changed`` were added or replaced.
+
+    ``indices`` and ``scores`` cover the rows that existed before; rows
+    appended since are past their end. Changed rows get fresh neighbour
+    lists, and in every other list a changed item's score is refreshed, or
+    the item is inserted if it beats the current k-th neighbour. Other lists
+    are not recomputed, so an item that falls out of one is not replaced by
+    the true next-best neighbour until the next full build.
+    Returns new ``(indices, scores)`` arrays covering every row.
+    """
+    matrix = normalize(tfidf_matrix.astype(np.float32), copy=True).tocsr()
+    n_items = matrix.shape[0]
+    k = min(indices.shape[1], max(n_items - 1, 0))
+    new_indices = np.zeros((n_items, k), dtype=np.int32)
+    new_scores = np.zeros((n_items, k), dtype=np.float32)
+    new_indices[:len(indices)] = indices[:, :k]
+    new_scores[:len(scores)] = scores[:, :k]
+    changed = np.unique(np.asarray(changed, dtype=np.int64))
+    if k == 0 or len(changed) == 0:
+        return new_indices, new_scores
+
+    # Similarity of every item to each changed item, (n_items, n_changed)
+    similarities = (matrix @ matrix[changed].T).toarray()
+    similarities[changed, np.arange(len(changed))] = -np.inf
+
+    # Fresh lists for the changed items
+    columns = similarities.T
+    top = np.argpartition(-columns, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(columns, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    new_indices[changed] = np.take_along_axis(top, order, axis=1)
+    new_scores[changed] = np.take_along_axis(top_scores, order, axis=1)
+
+    # Patch the other items' lists, one changed item at a time
+    others = np.setdiff1d(np.arange(n_items), changed)
+    for column, item in enumerate(changed):
+        item_scores = similarities[others, column]
+        rows, slots = np.nonzero(new_indices[others] == item)
+        new_scores[others[rows], slots] = item_scores[rows]
+        listed = np.zeros(len(others), dtype=bool)
+        listed[rows] = True
+        better = ~listed & (item_scores > new_scores[others, -1])
+        new_indices[others[better], -1] = item
+        new_scores[others[better], -1] = item_scores[better]
+
+        # Restore the descending order of the touched lists
+        touched = others[listed | better]
+        order = np.argsort(-new_scores[touched], axis=1, kind='stable')
+        new_indices[touched] = np.take_along_axis(new_indices[touched], order, axis=1)
+        new_scores[touched] = np.take_along_axis(new_scores[touched], order, axis=1)
+
+    return new_indices, new_scores
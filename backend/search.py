@@ -0,0 +1,235 @@
+import re
+import copy
+import unicodedata
+import numpy as np
+import scipy.sparse as sp
+
+# Title keys of the autocomplete index are cut to this many bytes; longer prefixes are
+# checked against the full titles of the candidates
+KEY_BYTES = 32
+# Completions are precomputed for every prefix up to this many bytes (the widest ranges)
+PRECOMPUTED_PREFIX = 2
+# Most completions a prefix lookup returns
+MAX_COMPLETIONS = 20
+# Added to the text score of items whose title contains the query as a word prefix
+TITLE_BOOST = 0.5
+# Most title matches boosted per query (a short query can prefix a large share of the catalog)
+MAX_TITLE_MATCHES = 1000
+# Rows changed by catalog updates are searched in a small delta index instead of the stored
+# postings; once they are more than this share of the catalog the postings are rebuilt
+DELTA_SHARE = 0.05
+
+_NON_ALPHANUMERIC = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Lowercase ASCII words of a title or query, accents dropped, separated by single spaces"""
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode()
+    return _NON_ALPHANUMERIC.sub(' ', text.lower()).strip()
+
+
+def _prefix_range(prefix):
+    """The key range [low, high) holding every key that starts with ``prefix`` (bytes)"""
+    prefix = prefix[:KEY_BYTES]
+    # Normalized keys are ASCII, so the last byte can always be incremented
+    return prefix, prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def _title_keys(titles, positions):
+    """Unsorted ``(keys, owners, starts)`` of the titles at ``positions``: one key per word, to the title's end"""
+    keys, owners, starts = [], [], []
+    for position in positions:
+        title = normalize(titles[position]).encode()
+        offset = 0
+        while offset < len(title):
+            keys.append(title[offset:offset + KEY_BYTES])
+            owners.append(position)
+            starts.append(offset == 0)
+            offset = title.find(b' ', offset) + 1 or len(title)
+    return (np.asarray(keys, dtype=f'S{KEY_BYTES}'), np.asarray(owners, dtype=np.int64),
+            np.asarray(starts, dtype=bool))
+
+
+def build_postings(tfidf_matrix):
+    """Term-major (inverted) copy of a TF-IDF matrix: row t holds the items containing term t"""
+    return sp.csr_matrix(tfidf_matrix, dtype=np.float32).T.tocsr()
+
+
+class TitleIndex:
+    """Prefix index of titles for autocomplete: a sorted array of title suffixes.
+
+    Every title is keyed once per word, from that word to the end ("attack
+    on titan", "on titan", "titan"), so a prefix matches titles starting with
+    it as well as titles with a word sequence starting with it. A lookup is
+    two binary searches for the range of keys with the prefix, then a
+    partial sort of that range by rank (title starts first, then rating);
+    the widest ranges, of the shortest prefixes, are ranked at build time.
+    """
+
+    def __init__(self, titles, ratings, canonical_positions):
+        self.titles = np.asarray(titles, dtype=object)
+        self.canonical_positions = canonical_positions
+        keys, owners, starts = _title_keys(self.titles, range(len(self.titles)))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.owners = owners[order]
+        # Title starts rank above word matches, then by rating
+        ratings = np.nan_to_num(np.asarray(ratings, dtype=np.float64))
+        self.start_bonus = ratings.max(initial=0) + 1
+        self.ranks = self._ranks(ratings, self.owners, starts[order])
+
+        self.precomputed = {}
+        for length in range(1, PRECOMPUTED_PREFIX + 1):
+            prefixes, first = np.unique(self.keys.astype(f'S{length}'), return_index=True)
+            bounds = np.append(first, len(self.keys))
+            for prefix, low, high in zip(prefixes.tolist(), bounds[:-1], bounds[1:]):
+                if len(prefix) == length:
+                    self.precomputed[prefix] = self._best(low, high, MAX_COMPLETIONS)
+
+    def _ranks(self, ratings, owners, starts):
+        # Ratings above those of the first build are capped, so starts still rank first
+        return (np.minimum(ratings[owners], self.start_bonus - 1) + starts * self.start_bonus).astype(np.float32)
+
+    def apply_changes(self, titles, ratings, canonical_positions, changed):
+        """A new index where the titles at ``changed`` (replaced or appended) are re-keyed.
+
+        The keys of those rows are dropped and their new keys merged into the
+        sorted arrays, so an update costs a pass over the arrays instead of
+        keying and sorting every title again; only the precomputed prefixes
+        of the changed keys are re-ranked. This index is left untouched.
+        """
+        index = copy.copy(self)
+        index.titles = np.asarray(titles, dtype=object)
+        index.canonical_positions = canonical_positions
+        ratings = np.nan_to_num(np.asarray(ratings, dtype=np.float64))
+
+        keep = ~np.isin(self.owners, changed)
+        removed = self.keys[~keep]
+        keys, owners, starts = _title_keys(index.titles, changed)
+        order = np.argsort(keys, kind='stable')
+        keys, owners, starts = keys[order], owners[order], starts[order]
+        at = np.searchsorted(self.keys[keep], keys, 'right')
+        index.keys = np.insert(self.keys[keep], at, keys)
+        index.owners = np.insert(self.owners[keep], at, owners)
+        index.ranks = np.insert(self.ranks[keep], at, index._ranks(ratings, owners, starts))
+
+        index.precomputed = dict(self.precomputed)
+        prefixes = {key[:length] for key in removed.tolist() + keys.tolist()
+                    for length in range(1, PRECOMPUTED_PREFIX + 1) if len(key) >= length}
+        for prefix in prefixes:
+            low, high = index._range(prefix)
+            if low < high:
+                index.precomputed[prefix] = index._best(low, high, MAX_COMPLETIONS)
+            else:
+                index.precomputed.pop(prefix, None)
+        return index
+
+    def _range(self, prefix):
+        low, high = _prefix_range(prefix)
+        return np.searchsorted(self.keys, low, 'left'), np.searchsorted(self.keys, high, 'left')
+
+    def _best(self, low, high, limit):
+        """Positions of the best-ranked distinct titles among keys[low:high], best first"""
+        ranks = self.ranks[low:high]
+        want = limit
+        while True:
+            if want < len(ranks):
+                top = np.argpartition(-ranks, want)[:want]
+            else:
+                top = np.arange(len(ranks))
+            top = top[np.argsort(-ranks[top], kind='stable')]
+            owners = self.owners[low + top]
+            # One entry per item and per duplicated title, at its best rank
+            _, first = np.unique(self.canonical_positions[owners], return_index=True)
+            owners = owners[np.sort(first)]
+            if len(owners) >= limit or want >= len(ranks):
+                return owners[:limit]
+            want *= 4
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """Positions of up to ``limit`` titles matching ``prefix`` (a title or word prefix), best first"""
+        prefix = normalize(prefix).encode()
+        if not prefix:
+            return np.empty(0, dtype=np.int64)
+        limit = min(limit, MAX_COMPLETIONS)
+        if len(prefix) <= PRECOMPUTED_PREFIX:
+            return self.precomputed.get(prefix, np.empty(0, dtype=np.int64))[:limit]
+        if len(prefix) <= KEY_BYTES:
+            return self._best(*self._range(prefix), limit)
+        # Keys only hold the first KEY_BYTES of each suffix: check the candidates' full titles
+        matches = self.matches(prefix.decode())
+        return matches[:limit]
+
+    def matches(self, prefix, limit=MAX_TITLE_MATCHES):
+        """Positions of up to ``limit`` titles with ``prefix`` as a title or word prefix, best first"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return np.empty(0, dtype=np.int64)
+        positions = self._best(*self._range(prefix.encode()), limit)
+        if len(prefix) > KEY_BYTES:
+            needle = ' ' + prefix
+            positions = positions[[needle in ' ' + normalize(title) for title in self.titles[positions]]]
+        return positions
+
+
+class SearchIndex:
+    """Text search over one catalog: an inverted index of its TF-IDF matrix plus a TitleIndex.
+
+    The postings of a term are a row of the transposed (term-major) matrix,
+    so a query only reads the postings of its own terms. Queries are
+    weighted with the fitted vectorizer; item rows are unit length, so the
+    summed weights are the cosine similarity of item and query.
+
+    ``postings`` is that matrix as stored in the model bundle (memory-mapped
+    and shared by the worker processes), built here if not given. Catalog
+    updates leave it as is: changed rows are scored from a small delta index
+    of their own, until they outgrow DELTA_SHARE of the catalog.
+    """
+
+    def __init__(self, df, tfidf_matrix, vectorizer, canonical_positions, postings=None):
+        self.vectorizer = vectorizer
+        self.postings = build_postings(tfidf_matrix) if postings is None else postings
+        self.titles = TitleIndex(df['title'].to_numpy(), df['rating'].to_numpy(), canonical_positions)
+        # Rows scored from delta_postings (column j is row delta_positions[j]) instead of self.postings
+        self.delta_positions = np.empty(0, dtype=np.int64)
+        self.delta_postings = None
+
+    def apply_changes(self, df, tfidf_matrix, canonical_positions, changed):
+        """A new index after the rows at ``changed`` were replaced or appended; this one is left untouched"""
+        index = copy.copy(self)
+        index.titles = self.titles.apply_changes(df['title'].to_numpy(), df['rating'].to_numpy(),
+                                                 canonical_positions, changed)
+        delta = np.union1d(self.delta_positions, changed).astype(np.int64)
+        if len(delta) > DELTA_SHARE * len(df):
+            index.postings = build_postings(tfidf_matrix)
+            index.delta_positions, index.delta_postings = np.empty(0, dtype=np.int64), None
+        else:
+            index.delta_positions, index.delta_postings = delta, build_postings(tfidf_matrix[delta])
+        return index
+
+    def full_postings(self, tfidf_matrix):
+        """The term-major matrix of every row (``tfidf_matrix``), for the model bundle"""
+        return self.postings if self.delta_postings is None else build_postings(tfidf_matrix)
+
+    def match(self, query):
+        """Every item matching ``query`` as (positions, scores), unsorted.
+
+        Scores are the TF-IDF cosine, plus TITLE_BOOST for titles containing
+        the query as a word prefix (which also finds titles made of words
+        outside the vocabulary).
+        """
+        weights = self.vectorizer.transform([query])
+        query_row = sp.csr_matrix(weights.data[None, :].astype(np.float32))
+        text = query_row @ self.postings[weights.indices]
+        positions, scores = text.indices.astype(np.int64), text.data
+        if self.delta_postings is not None:
+            # Rows changed since the postings were built score from the delta only
+            current = ~np.isin(positions, self.delta_positions)
+            delta = query_row @ self.delta_postings[weights.indices]
+            positions = np.concatenate([positions[current], self.delta_positions[delta.indices]])
+            scores = np.concatenate([scores[current], delta.data])
+        titled = self.titles.matches(query)
+        positions = np.concatenate([positions, titled])
+        scores = np.concatenate([scores, np.full(len(titled), TITLE_BOOST, dtype=np.float32)])
+        positions, inverse = np.unique(positions, return_inverse=True)
+        return positions, np.bincount(inverse, weights=scores).astype(np.float32)
@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import time
+import uuid
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows: sessions are then locked per process, so serve them from one process
+    fcntl = None
+
+# Weight of the newest reading in the moving average of the expression distribution
+SMOOTHING = 0.4
+# Lead the smoothed challenger needs over the current emotion before it takes over
+HYSTERESIS = 0.15
+# Consecutive readings the challenger must lead for (the debounce)
+MIN_FRAMES = 3
+# Sessions idle for longer than this are dropped
+SESSION_TTL = 15 * 60
+# Where session state lives (one file per session), so every worker process on the node serves every session
+SESSION_DIR = os.getenv('SESSION_DIR', os.path.join('models', 'sessions'))
+# How often a stream checks its session for changes, in seconds
+POLL_SECONDS = 0.25
+
+_SESSION_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class EmotionFilter:
+    """Smooths a stream of expression readings and reports when the mood really changes.
+
+    Each reading is an ``{emotion: confidence}`` dict (a single detected
+    emotion is ``{emotion: 1.0}``). Readings are blended into an exponential
+    moving average; a different emotion only replaces the current one once
+    it leads it by ``hysteresis`` for ``min_frames`` readings in a row, so a
+    flicker between two close expressions does not trigger new results.
+    """
+
+    def __init__(self, smoothing=SMOOTHING, hysteresis=HYSTERESIS, min_frames=MIN_FRAMES):
+        self.smoothing = smoothing
+        self.hysteresis = hysteresis
+        self.min_frames = min_frames
+        self.scores = {}
+        self.emotion = None
+        self.challenger = None
+        self.streak = 0
+
+    def update(self, reading):
+        """Add a reading; returns True if the smoothed emotion changed"""
+        total = sum(v for v in reading.values() if v > 0)
+        if total <= 0:
+            return False
+
+        # Decay the old average and blend in the normalized reading
+        for emotion in self.scores:
+            self.scores[emotion] *= 1 - self.smoothing
+        for emotion, confidence in reading.items():
+            if confidence > 0:
+                self.scores[emotion] = self.scores.get(emotion, 0.0) + self.smoothing * confidence / total
+
+        leader = max(self.scores, key=self.scores.get)
+        if self.emotion is None:
+            # First reading sets the mood straight away
+            self.emotion = leader
+            return True
+        if leader == self.emotion or self.scores[leader] - self.scores.get(self.emotion, 0.0) < self.hysteresis:
+            self.challenger, self.streak = None, 0
+            return False
+
+        if leader != self.challenger:
+            self.challenger, self.streak = leader, 0
+        self.streak += 1
+        if self.streak < self.min_frames:
+            return False
+
+        self.emotion = leader
+        self.challenger, self.streak = None, 0
+        return True
+
+    def state(self):
+        """The filter as a JSON-able dict, for from_state"""
+        return dict(vars(self))
+
+    @classmethod
+    def from_state(cls, state):
+        emotion_filter = cls(state['smoothing'], state['hysteresis'], state['min_frames'])
+        emotion_filter.scores, emotion_filter.emotion = state['scores'], state['emotion']
+        emotion_filter.challenger, emotion_filter.streak = state['challenger'], state['streak']
+        return emotion_filter
+
+
+class Session:
+    """Per-client state: the emotion filter, the last pushed (encoded) payload and a change counter.
+
+    ``user`` is the signed-in caller whose favorites personalize the payloads
+    (None if anonymous).
+    """
+
+    def __init__(self, session_id, seed=None, user=None, **filter_options):
+        self.id = session_id
+        self.seed = seed
+        self.user = user
+        self.filter = EmotionFilter(**filter_options)
+        self.version = 0
+        self.payload = None
+
+    def publish(self, payload):
+        """Store a new payload; streams pick it up once the session is saved"""
+        self.payload = payload
+        self.version += 1
+
+    def state(self):
+        return {'seed': self.seed, 'user': self.user, 'filter': self.filter.state(),
+                'version': self.version, 'payload': self.payload}
+
+    @classmethod
+    def from_state(cls, session_id, state):
+        session = cls(session_id, state['seed'], state['user'])
+        session.filter = EmotionFilter.from_state(state['filter'])
+        session.version, session.payload = state['version'], state['payload']
+        return session
+
+
+class SessionStore:
+    """Live sessions, one JSON file each in ``directory``, expiring the idle ones.
+
+    Every worker process sharing the directory serves every session: a
+    reading may be posted to one worker while another streams the session.
+    Changes are read-modify-write under a per-session file lock, and files
+    are replaced atomically, so readers never see a half-written session.
+    A session's last use is its file's mtime.
+    """
+
+    def __init__(self, directory=SESSION_DIR, ttl=SESSION_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        # Stands in for the file locks where fcntl is missing
+        self.lock = threading.Lock()
+
+    def _path(self, session_id, suffix='.json'):
+        # Ids come from URLs: anything but our own hex ids is unknown
+        if not isinstance(session_id, str) or not _SESSION_ID.fullmatch(session_id):
+            return None
+        return os.path.join(self.directory, session_id + suffix)
+
+    def create(self, seed=None, user=None, **filter_options):
+        self._expire()
+        session = Session(uuid.uuid4().hex, seed=seed, user=user, **filter_options)
+        os.makedirs(self.directory, exist_ok=True)
+        open(self._path(session.id, '.lock'), 'a').close()
+        self.save(session)
+        return session
+
+    def save(self, session):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session.state(), f)
+            os.replace(tmp_path, self._path(session.id))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _load(self, session_id):
+        path = self._path(session_id)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                    return None
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return Session.from_state(session_id, state)
+
+    def get(self, session_id):
+        """The live session with this id, or None; touching it keeps it alive"""
+        session = self._load(session_id)
+        if session is not None:
+            self.touch(session_id)
+        return session
+
+    def touch(self, session_id):
+        try:
+            os.utime(self._path(session_id))
+        except (OSError, TypeError):
+            pass
+
+    def stamp(self, session_id):
+        """Changes with every save of the session (its file's inode); None once it is gone"""
+        path = self._path(session_id)
+        try:
+            return path and os.stat(path).st_ino
+        except OSError:
+            return None
+
+    @contextmanager
+    def _locked(self, session_id):
+        """Hold the session's lock; yields False if there is no such session"""
+        path = self._path(session_id, '.lock')
+        try:
+            fd = os.open(path, os.O_RDWR) if path else None
+        except OSError:
+            fd = None
+        if fd is None:
+            yield False
+            return
+        try:
+            if fcntl is None:
+                with self.lock:
+                    yield True
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield True
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def update(self, session_id):
+        """Yield the session (None if unknown or expired) and save it afterwards, holding its lock throughout"""
+        with self._locked(session_id) as exists:
+            session = self._load(session_id) if exists else None
+            yield session
+            if session is not None:
+                self.save(session)
+
+    def remove(self, session_id):
+        with self._locked(session_id) as exists:
+            if not exists:
+                return False
+            found = self._load(session_id) is not None
+            for suffix in ('.json', '.lock'):
+                try:
+                    os.unlink(self._path(session_id, suffix))
+                except OSError:
+                    pass
+            return found
+
+    def _expire(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        now = time.time()
+        for name in names:
+            session_id, suffix = os.path.splitext(name)
+            if suffix != '.json':
+                continue
+            try:
+                expired = now - os.stat(os.path.join(self.directory, name)).st_mtime > self.ttl
+            except OSError:
+                continue
+            if expired:
+                self.remove(session_id)
+
+
+def sse_event(event, data):
+    """Encode one server-sent event; ``data`` is a JSON-able value or an already encoded string"""
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def stream_events(store, session_id, keepalive=15, poll=POLL_SECONDS):
+    """Yield server-sent events for a session: its current payload, then every change.
+
+    The session file is checked every ``poll`` seconds, so readings posted
+    to any worker process reach the stream. A comment line is sent every
+    ``keepalive`` seconds so proxies keep the connection open while the
+    mood is steady; it also keeps the session alive.
+    """
+    stamp, version, sent = None, 0, time.monotonic()
+    while True:
+        latest = store.stamp(session_id)
+        if latest is None:
+            break
+        if latest != stamp:
+            stamp = latest
+            session = store.get(session_id)
+            if session is None:
+                break
+            if session.version != version:
+                version, sent = session.version, time.monotonic()
+                yield sse_event('recommendations', session.payload)
+        if time.monotonic() - sent >= keepalive:
+            store.touch(session_id)
+            sent = time.monotonic()
+            yield ": keepalive\n\n"
+        time.sleep(poll)
+    yield sse_event('closed', {'session_id': session_id})
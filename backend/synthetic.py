@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from dataset import clean_datasets
+
+EMOTIONS = ('happy', 'sad', 'anger', 'fear', 'surprise', 'disgust', 'neutral')
+
+ANIME_GENRES = (
+    'Action', 'Adventure', 'Comedy', 'Drama', 'Fantasy', 'Horror', 'Mystery', 'Romance', 'Sci-Fi',
+    'Slice of Life', 'Sports', 'Music', 'School', 'Shounen', 'Kids', 'Psychological', 'Supernatural',
+)
+
+# The book catalog's genre string for each emotion
+BOOK_GENRES = {
+    'happy': 'Romance, Humor, Adventure, Fantasy, Comedy',
+    'sad': 'Literary Fiction, Memoirs, Drama, Historical Fiction, Poetry',
+    'anger': 'Crime, Thriller, Mystery, Detective Fiction, Action',
+    'fear': 'Horror, Suspense, Psychological Thriller, Gothic Fiction, Dark Fantasy',
+    'surprise': 'Mystery, Science Fiction, Fantasy, Adventure, Suspense',
+    'disgust': 'Dystopian, Horror, Apocalyptic Fiction, Dark Fiction, Crime',
+    'neutral': 'Non-Fiction, Biography, Self-Help, Philosophy, Adventure',
+}
+
+SYLLABLES = ('ka', 'ri', 'to', 'mi', 'su', 'ne', 'ha', 'lo', 'ven', 'dar', 'el', 'yu', 'sho', 'ra', 'gen', 'tia')
+
+# Rows generated at a time, to bound the memory of the word-index arrays
+CHUNK_ROWS = 50_000
+
+
+def make_vocabulary(size=20_000):
+    """Distinct pseudo-words built from syllables (deterministic)"""
+    words = []
+    n = len(SYLLABLES)
+    for i in range(size):
+        word, value = '', i + n
+        while value:
+            value, digit = divmod(value, n)
+            word += SYLLABLES[digit]
+        words.append(word)
+    return np.asarray(words, dtype=object)
+
+
+def _texts(rng, vocabulary, emotion_codes, mean_words, topic_share=0.3):
+    """Random descriptions: Zipf-distributed common words plus words from each row's emotion topic"""
+    n_words = len(vocabulary)
+    topic_size = n_words // (2 * len(EMOTIONS))
+    common = np.arange(len(EMOTIONS) * topic_size, n_words)
+    weights = 1 / np.arange(1, len(common) + 1) ** 1.1
+    weights /= weights.sum()
+
+    texts = []
+    for start in range(0, len(emotion_codes), CHUNK_ROWS):
+        codes = emotion_codes[start:start + CHUNK_ROWS]
+        lengths = np.maximum(rng.poisson(mean_words, len(codes)), 3)
+        total = int(lengths.sum())
+        words = rng.choice(common, size=total, p=weights)
+        # Swap a share of the words for words of the row's emotion topic
+        row_codes = np.repeat(codes, lengths)
+        topical = rng.random(total) < topic_share
+        words[topical] = row_codes[topical] * topic_size + rng.integers(0, topic_size, int(topical.sum()))
+        for chunk in np.split(vocabulary[words], np.cumsum(lengths)[:-1]):
+            texts.append(' '.join(chunk))
+    return texts
+
+
+def make_anime(n, rng, vocabulary):
+    """Raw anime frame with the schema of anime_with_emotions.xlsx"""
+    codes = rng.integers(0, len(EMOTIONS), n)
+    titles = vocabulary[rng.integers(0, len(vocabulary), (n, 2))]
+    genre_picks = rng.random((n, len(ANIME_GENRES))) < 0.2
+    ids = np.arange(n)
+    return pd.DataFrame({
+        'title': [f"{a.title()} {b.title()} {i}" for (a, b), i in zip(titles, ids)],
+        'description': _texts(rng, vocabulary, codes, mean_words=60),
+        'genre': [str([g for g, picked in zip(ANIME_GENRES, row) if picked] or ['Drama']) for row in genre_picks],
+        'episodes': rng.integers(1, 100, n),
+        'rating': np.round(rng.normal(6.8, 0.95, n).clip(1, 10), 2),
+        'thumbnail': [f"https://cdn.myanimelist.net/images/anime/{i % 20}/{i}.jpg" for i in ids],
+        'previewlink': [f"https://myanimelist.net/anime/{i}" for i in ids],
+        'emotion': np.asarray(EMOTIONS)[codes],
+    })
+
+
+def make_books(n, rng, vocabulary):
+    """Raw book frame with the schema of book_dataset.xlsx"""
+    codes = rng.integers(0, len(EMOTIONS), n)
+    titles = vocabulary[rng.integers(0, len(vocabulary), (n, 2))]
+    ids = np.arange(n)
+    emotions = np.asarray(EMOTIONS)[codes]
+    return pd.DataFrame({
+        'title': [f"The {a.title()} of {b.title()} {i}" for (a, b), i in zip(titles, ids)],
+        'rating': np.round(rng.normal(3.7, 0.87, n).clip(1, 5), 2),
+        'description': _texts(rng, vocabulary, codes, mean_words=100),
+        'thumbnail': [f"http://books.google.com/books/content?id=syn{i}&printsec=frontcover&img=1&zoom=1" for i in ids],
+        'previewLink': [f"http://books.google.com/books?id=syn{i}&hl=&source=gbs_api" for i in ids],
+        'emotion': emotions,
+        'emotion_based_genre': [BOOK_GENRES[emotion] for emotion in emotions],
+    })
+
+
+def make_catalog(n_anime, n_books=None, seed=0, vocabulary_size=20_000):
+    """Cleaned synthetic (anime_df, book_df), as load_data would return them"""
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size)
+    anime_df = make_anime(n_anime, rng, vocabulary)
+    book_df = make_books(n_anime if n_books is None else n_books, rng, vocabulary)
+    return clean_datasets(anime_df, book_df)
@@ -0,0 +1,408 @@
+import io
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from functools import lru_cache
+from concurrent.futures import Future
+from flask import Blueprint, Response, current_app, request, jsonify
+from metrics import timed
+
+thumbnails_bp = Blueprint('thumbnails', __name__)
+logger = logging.getLogger(__name__)
+
+# Where the card-sized copies are kept (shared by every worker on the node) and its size bound
+THUMBNAIL_DIR = os.getenv('THUMBNAIL_DIR', os.path.join('models', 'thumbnails'))
+THUMBNAIL_CACHE_BYTES = int(os.getenv('THUMBNAIL_CACHE_BYTES', 512 * 2**20))
+# Eviction removes the least recently used files until the cache is back under this share of the bound
+LOW_WATER = 0.9
+# A hit refreshes its file's mtime (the LRU order) at most this often, in seconds
+TOUCH_INTERVAL = 3600
+
+# Recommendation cards are 208x240 CSS pixels; twice that for high-density screens
+THUMBNAIL_SIZE = (416, 480)
+WEBP_QUALITY = 80
+
+# Seconds to connect to / wait on an image host, and the largest original accepted
+FETCH_TIMEOUT = (3.05, float(os.getenv('THUMBNAIL_FETCH_TIMEOUT', 10)))
+MAX_ORIGIN_BYTES = 8 * 2**20
+# A URL whose fetch failed is not tried again for this many seconds (its requests get a 502)
+FAILURE_TTL = 300
+MAX_FAILURES = 4096
+
+# Thumbnails of the best-ranked candidates of each emotion fetched once the catalog has loaded;
+# off by default (0), since it sends a burst of requests to the image hosts on every start
+PREFETCH_TOP_N = int(os.getenv('THUMBNAIL_PREFETCH', 0))
+PREFETCH_WORKERS = 4
+
+# Browsers and proxies may keep a served thumbnail this long (seconds)
+CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Leading bytes of the image formats the catalogs use
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+)
+
+
+class OriginError(Exception):
+    """An origin image that could not be fetched or decoded"""
+
+
+def image_type(data):
+    """MIME type of encoded image bytes, or None if they are not an image"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return None
+
+
+class OriginFetcher:
+    """Fetches images from their hosts over one keep-alive session, with timeouts and a size cap.
+
+    Any callable taking a URL and returning the image bytes can stand in for
+    it (e.g. reading from a local fixture server or directory in tests).
+    """
+
+    def __init__(self, session=None, timeout=FETCH_TIMEOUT, max_bytes=MAX_ORIGIN_BYTES):
+        self._session = session
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+    @property
+    def session(self):
+        if self._session is None:
+            # Imported on first fetch, so importing the app stays cheap
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def __call__(self, url):
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            chunks, size = [], 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise OriginError(f"image larger than {self.max_bytes} bytes")
+                chunks.append(chunk)
+        return b''.join(chunks)
+
+
+@lru_cache(maxsize=None)
+def pillow():
+    """Pillow's Image module, imported on first use (it is slow to import); None if not installed"""
+    try:
+        from PIL import Image
+    except ImportError:
+        # Optional: without it thumbnails are cached and served as fetched, at full size
+        return None
+    return Image
+
+
+def render_thumbnail(data, size=THUMBNAIL_SIZE):
+    """Card-sized WebP copy of an image (aspect ratio kept, never enlarged); the bytes as given without Pillow"""
+    if image_type(data) is None:
+        raise OriginError("not an image")
+    Image = pillow()
+    if Image is None:
+        return data
+    with timed('thumbnail'):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                # JPEGs are decoded at the smallest scale still covering the size
+                image.draft('RGB', size)
+                image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                image.thumbnail(size, Image.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, 'WEBP', quality=WEBP_QUALITY)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise OriginError(f"undecodable image: {e}") from e
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Card-sized copies of remote thumbnails in a size-bounded disk cache.
+
+    Files are named by the hash of the source URL and rendition, so every
+    worker on the node shares them and a URL is fetched once. Concurrent
+    misses for one URL share a single origin fetch, and failed URLs are
+    not retried for FAILURE_TTL, so a slow host holds few requests. When the
+    files outgrow ``max_bytes`` the least recently used ones are removed.
+    """
+
+    def __init__(self, directory=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES, fetch=None, size=THUMBNAIL_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetch = fetch or OriginFetcher()
+        self.size = size
+        # Bytes on disk as far as this process knows; recounted by each eviction pass
+        self.bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Also run in forked children: a fetch in flight in the parent is not theirs to wait for
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.inflight = {}
+        # URL -> (retry after, error message)
+        self.failures = {}
+
+    @property
+    def rendition(self):
+        # Checked on first use rather than at start-up, like the Pillow import itself
+        return f"{self.size[0]}x{self.size[1]}.webp" if pillow() is not None else 'original'
+
+    def key(self, url):
+        return hashlib.sha256(f"{self.rendition}\n{url}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url):
+        """The cached copy of ``url`` as ``(key, bytes)``, fetched and stored on a miss.
+
+        Raises OriginError if the image could not be fetched or decoded.
+        """
+        key = self.key(url)
+        path = self.path(key)
+        data = self._read(path)
+        if data is not None:
+            with self.lock:
+                self.hits += 1
+            return key, data
+
+        with self.lock:
+            failure = self.failures.get(url)
+            if failure is not None and failure[0] > time.monotonic():
+                raise OriginError(failure[1])
+            call = self.inflight.get(url)
+            leader = call is None
+            if leader:
+                self.misses += 1
+                call = self.inflight[url] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return key, call.result()
+
+        try:
+            data = render_thumbnail(self.fetch(url), self.size)
+            self._write(path, data)
+        except Exception as e:
+            error = e if isinstance(e, OriginError) else OriginError(f"{type(e).__name__}: {e}")
+            with self.lock:
+                self.errors += 1
+                if len(self.failures) >= MAX_FAILURES:
+                    now = time.monotonic()
+                    self.failures = {u: f for u, f in self.failures.items() if f[0] > now}
+                self.failures[url] = (time.monotonic() + FAILURE_TTL, str(error))
+            call.set_exception(error)
+            raise error
+        else:
+            call.set_result(data)
+            return key, data
+        finally:
+            with self.lock:
+                del self.inflight[url]
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The mtime is the LRU order; refreshed sparingly so hits stay read-only
+            if os.stat(path).st_mtime < time.time() - TOUCH_INTERVAL:
+                os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        """Write a file atomically (readers see all of it or none), then evict if over the bound"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.bytes = None if self.bytes is None else self.bytes + len(data)
+            over = self.bytes is None or self.bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _files(self):
+        """(mtime, size, path) of every cached file"""
+        files = []
+        if not os.path.isdir(self.directory):
+            return files
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # evicted by another worker meanwhile
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def evict(self):
+        """Recount the cache and remove the least recently used files if it is over the bound"""
+        if not self.evict_lock.acquire(blocking=False):
+            return  # another thread is already at it
+        try:
+            files = self._files()
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            if total > self.max_bytes:
+                files.sort()
+                for _, size, path in files:
+                    if total <= self.max_bytes * LOW_WATER:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    removed += 1
+                logger.info("Evicted %d thumbnails, %.1f MB left", removed, total / 2**20)
+            with self.lock:
+                self.bytes = total
+                self.evictions += removed
+        finally:
+            self.evict_lock.release()
+
+    def _prefetch_one(self, url):
+        if os.path.exists(self.path(self.key(url))):
+            return False
+        try:
+            self.get(url)
+            return True
+        except OriginError as e:
+            logger.debug("Could not prefetch thumbnail %s: %s", url, e)
+            return False
+
+    def prefetch(self, urls, workers=PREFETCH_WORKERS):
+        """Fetch the uncached ones of ``urls`` with a few threads; returns how many were fetched.
+
+        The threads are daemons, so a process shutting down doesn't wait for
+        the rest of the list (files are renamed into place, so a cut-off fetch
+        never leaves a partial thumbnail).
+        """
+        pending = iter(dict.fromkeys(urls))
+        lock = threading.Lock()
+        fetched = []
+
+        def work():
+            while True:
+                with lock:
+                    url = next(pending, None)
+                if url is None:
+                    return
+                if self._prefetch_one(url):
+                    fetched.append(url)
+
+        threads = [threading.Thread(target=work, name='thumbnail-prefetch', daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(fetched)
+
+    def prefetch_when_ready(self, catalog, top_n=PREFETCH_TOP_N):
+        """Start a daemon thread that warms the top candidates' thumbnails once ``catalog`` has loaded"""
+        def run():
+            catalog.loaded.wait()
+            start = time.perf_counter()
+            urls = candidate_thumbnails(catalog.engines, top_n)
+            fetched = self.prefetch(urls)
+            logger.info("Prefetched %d of %d candidate thumbnails in %.1fs", fetched, len(urls),
+                        time.perf_counter() - start)
+
+        threading.Thread(target=run, name='thumbnail-prefetch', daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'evictions': self.evictions,
+                'failing_urls': len(self.failures),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'rendition': self.rendition,
+            }
+
+
+def candidate_thumbnails(engines, top_n=PREFETCH_TOP_N):
+    """Thumbnail URLs of the ``top_n`` best-ranked candidates of every emotion in every catalog"""
+    urls = []
+    for engine, _ in engines.values():
+        thumbnails = engine.df['thumbnail'].to_numpy()
+        for positions, _ in engine.candidates.values():
+            urls.extend(thumbnails[positions[:top_n]])
+    return [url for url in dict.fromkeys(urls) if is_remote_url(url)]
+
+
+def is_remote_url(url):
+    return isinstance(url, str) and url.startswith(('http://', 'https://'))
+
+
+@lru_cache(maxsize=4)
+def catalog_thumbnails(catalog, version):
+    """Every thumbnail URL of the catalog at ``version``; only those are proxied"""
+    return frozenset(
+        url for engine, _ in catalog.engines.values()
+        for url in engine.df['thumbnail'].to_numpy() if is_remote_url(url)
+    )
+
+
+@thumbnails_bp.route('/api/thumbnail', methods=['GET'])
+def thumbnail():
+    """Card-sized copy of a catalog item's thumbnail: ?url=<the item's thumbnail URL>"""
+    catalog = current_app.extensions['catalog']
+    if not catalog.ready:
+        response = jsonify({'status': 'error', 'message': 'Catalog is still loading, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    url = request.args.get('url', '')
+    if url not in catalog_thumbnails(catalog, catalog.version):
+        return jsonify({'status': 'error', 'message': 'url is not the thumbnail of a catalog item'}), 404
+
+    try:
+        key, data = current_app.extensions['thumbnails'].get(url)
+    except OriginError as e:
+        return jsonify({'status': 'error', 'message': f'Could not fetch the thumbnail: {e}'}), 502
+    response = Response(data, mimetype=image_type(data))
+    # The copy at a key never changes, so the key is its ETag
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@thumbnails_bp.route('/api/thumbnail/stats', methods=['GET'])
+def thumbnail_stats():
+    """Thumbnail cache counters"""
+    return jsonify(current_app.extensions['thumbnails'].stats())
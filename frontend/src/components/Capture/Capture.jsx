@@ -2,12 +2,17 @@ import { useState, useRef, useEffect } from "react";
 import Navigation from "../navigation/Navigation";
 import Footer from "../footer/Footer";
 import * as faceapi from 'face-api.js';
-import { db } from "../firebase";
-import { collection, addDoc } from "firebase/firestore";
-import { serverTimestamp } from "firebase/firestore";
 import { getAuth } from "firebase/auth";
 import Recommendations from "../Recommendation/Recommendations";
 
+const API_URL = 'http://localhost:5000';
+
+// The ID token of the signed-in user, if any: the backend personalizes with their favorites
+const authHeaders = async () => {
+  const user = getAuth().currentUser;
+  return user ? { 'Authorization': `Bearer ${await user.getIdToken()}` } : {};
+};
+
 const Capture = () => {
   // State management
   const [cameraActive, setCameraActive] = useState(false);
@@ -23,6 +28,9 @@ const Capture = () => {
   // Refs
   const videoRef = useRef(null);
   const detectionIntervalRef = useRef(null);
+  // Live emotion session ({ id, events }) fed by the continuous detection, and its latest recommendations
+  const sessionRef = useRef(null);
+  const liveRecommendationsRef = useRef(null);
 
   // Load face-api.js models
   useEffect(() => {
@@ -84,6 +92,7 @@ const Capture = () => {
       clearInterval(detectionIntervalRef.current);
       detectionIntervalRef.current = null;
     }
+    endSession();
     
     if (stream) {
       stream.getTracks().forEach((track) => track.stop());
@@ -116,6 +125,7 @@ const Capture = () => {
       if (stream) {
         stream.getTracks().forEach((track) => track.stop());
       }
+      endSession();
       
       if (detectionIntervalRef.current) {
         clearInterval(detectionIntervalRef.current);
@@ -123,6 +133,73 @@ const Capture = () => {
     };
   }, [stream]);
 
+  // Live emotion session: the backend smooths the readings and pushes new recommendations
+  // (server-sent events) only when the mood really changes
+  const startSession = async () => {
+    if (sessionRef.current) return;
+    const pending = { id: null, events: null };
+    sessionRef.current = pending;
+    try {
+      const response = await fetch(`${API_URL}/api/session`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', ...(await authHeaders()) },
+        body: JSON.stringify({}),
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      const { session_id: id, stream } = await response.json();
+      if (sessionRef.current !== pending) {
+        // The camera was closed meanwhile
+        fetch(`${API_URL}/api/session/${id}`, { method: 'DELETE' }).catch(() => {});
+        return;
+      }
+      const events = new EventSource(`${API_URL}${stream}`);
+      events.addEventListener('recommendations', (event) => {
+        const data = JSON.parse(event.data);
+        liveRecommendationsRef.current = data;
+        // Open recommendations follow the mood as it changes
+        setRecommendations((current) => (current ? data : current));
+      });
+      events.addEventListener('closed', () => events.close());
+      sessionRef.current = { id, events };
+    } catch (error) {
+      console.error('Error starting emotion session:', error);
+      if (sessionRef.current === pending) {
+        sessionRef.current = null;
+      }
+    }
+  };
+
+  const endSession = () => {
+    const session = sessionRef.current;
+    sessionRef.current = null;
+    liveRecommendationsRef.current = null;
+    if (!session || !session.id) return;
+    session.events.close();
+    fetch(`${API_URL}/api/session/${session.id}`, { method: 'DELETE' })
+      .catch((error) => console.error('Error ending emotion session:', error));
+  };
+
+  const sendReading = async (expressions) => {
+    const session = sessionRef.current;
+    if (!session || !session.id) return;
+    try {
+      const response = await fetch(`${API_URL}/api/session/${session.id}/emotion`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ emotions: Object.fromEntries(Object.entries(expressions)) }),
+      });
+      if (response.status === 404) {
+        // Expired while the tab was idle: start over
+        endSession();
+        startSession();
+      }
+    } catch (error) {
+      console.error('Error sending emotion reading:', error);
+    }
+  };
+
   // Face detection
   const detectFace = async () => {
     if (!videoRef.current || !modelsLoaded || videoRef.current.paused || 
@@ -153,6 +230,7 @@ const Capture = () => {
     if (detectionIntervalRef.current) {
       clearInterval(detectionIntervalRef.current);
     }
+    startSession();
     
     detectionIntervalRef.current = setInterval(async () => {
       const detection = await detectFace();
@@ -163,6 +241,7 @@ const Capture = () => {
         const confidenceScore = sorted[0][1].toFixed(2);
         
         setEmotion(`${dominantEmotion} (${confidenceScore})`);
+        sendReading(detection.expressions);
       } else {
         setEmotion("No face detected. Please sit facing the light.");
       }
@@ -172,11 +251,9 @@ const Capture = () => {
   // Backend communication
   const sendToBackend = async (emotionData) => {
     try {
-      const response = await fetch('http://localhost:5000/api/emotion', {
+      const response = await fetch(`${API_URL}/api/emotion`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
+        headers: { 'Content-Type': 'application/json', ...(await authHeaders()) },
         body: JSON.stringify(emotionData),
       });
 
@@ -260,24 +337,35 @@ const Capture = () => {
           imageUrl: imageUrl
         };
 
-        // Send to backend and get recommendations
-        const backendResponse = await sendToBackend(emotionData);
+        // The live session's recommendations for the smoothed mood; a one-off request
+        // until it has any
+        const backendResponse = liveRecommendationsRef.current || await sendToBackend(emotionData);
         setRecommendations(backendResponse);
         setShowRecommendations(true);
         
-        // Save to Firestore if authenticated
+        // Log to the emotion history if authenticated (the backend batches the Firestore writes)
         const auth = getAuth();
         const user = auth.currentUser;
         if (user) {
           try {
-            await addDoc(collection(db, "emotions"), {
-              emotion: dominantEmotion,
-              confidence: parseFloat(confidenceScore),
-              timestamp: serverTimestamp(),
-              email: user.email,
-              imageUrl: imageUrl
+            // The backend takes the user from the ID token, not from the body
+            const idToken = await user.getIdToken();
+            const historyResponse = await fetch(`${API_URL}/api/history`, {
+              method: 'POST',
+              headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${idToken}`,
+              },
+              body: JSON.stringify({
+                emotion: dominantEmotion,
+                confidence: parseFloat(confidenceScore),
+                imageUrl: imageUrl
+              }),
             });
-            console.log("Emotion saved to Firestore");
+            if (!historyResponse.ok) {
+              throw new Error(`HTTP error! status: ${historyResponse.status}`);
+            }
+            console.log("Emotion queued for history");
           } catch (dbError) {
             console.error("Error saving emotion:", dbError);
             setError("Emotion detected but failed to save to database.");
@@ -29,15 +29,44 @@ useEffect(() => {
     setMessages(newMessages);
     setInput('');
 
+    // Stream the reply so it appears as it is generated
+    const showReply = (content) =>
+      setMessages([...newMessages, { role: 'assistant', content: formatMessage(content) }]);
+
     try {
-      const res = await fetch('http://localhost:5000/chat', {
+      const res = await fetch('http://localhost:5000/chat/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ message: input })
       });
-      const data = await res.json();
-      const formattedReply = formatMessage(data.reply);
-      setMessages([...newMessages, { role: 'assistant', content: formattedReply }]);
+      if (!res.ok || !res.body) throw new Error(`HTTP error! status: ${res.status}`);
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let reply = '';
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-sent events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const data = raw.match(/^data: (.*)$/m)?.[1];
+          if (!event || !data) continue;
+          const payload = JSON.parse(data);
+          if (event === 'delta') {
+            reply += payload.text;
+            showReply(reply);
+          } else {
+            // 'done' and 'error' carry the whole final reply
+            showReply(payload.reply);
+          }
+        }
+      }
     } catch {
       setMessages([...newMessages, { role: 'assistant', content: 'Sorry, something went wrong.' }]);
     }
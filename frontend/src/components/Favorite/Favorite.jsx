@@ -5,6 +5,7 @@ import { useSelector } from "react-redux";
 import { FaHeart } from "react-icons/fa";
 import { Link } from "react-router-dom";
 import { db } from "../firebase";
+import { invalidateProfile } from "../favorites";
 import { getDocs, query, where, deleteDoc, doc, collection } from "firebase/firestore";
 
 const Favorites = () => {
@@ -46,6 +47,7 @@ const Favorites = () => {
       setRemovingId(id);
       const collectionName = type === "anime" ? "favorite" : "favoriteBook";
       await deleteDoc(doc(db, collectionName, id));
+      invalidateProfile(type);
 
       if (type === "anime") {
         setFavoriteAnimes((prev) => prev.filter((item) => item.id !== id));
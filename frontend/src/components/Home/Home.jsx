@@ -9,6 +9,7 @@ import { useSelector } from "react-redux";
 import { db , auth } from "../firebase";
 import { collection, addDoc, getDocs, query, where, deleteDoc, doc } from "firebase/firestore"; // Import Firestore functions
 import { onAuthStateChanged } from "firebase/auth"; // Import auth state tracking
+import { invalidateProfile } from "../favorites";
 
 const Home = () => {
   const [animeList, setAnimeList] = useState([]);
@@ -176,6 +177,7 @@ const Home = () => {
         try {
           // Delete from Firestore
           await deleteDoc(doc(db, "favorite", favoriteToDelete.id));
+          invalidateProfile("anime");
           
           // Update local state
           setFavorites(prevFavorites => 
@@ -206,6 +208,7 @@ const Home = () => {
       try {
         // Save to Firestore
         const docRef = await addDoc(collection(db, "favorite"), favoriteData);
+        invalidateProfile("anime");
         
         // Update local state with the new document ID
         setFavorites(prevFavorites => [
@@ -240,6 +243,7 @@ const Home = () => {
         try {
           // Delete from Firestore
           await deleteDoc(doc(db, "favoriteBook", bookToDelete.id));
+          invalidateProfile("book");
           
           // Update local state
           setFavoriteBooks(prevFavorites => 
@@ -270,6 +274,7 @@ const Home = () => {
       try {
         // Save to Firestore
         const docRef = await addDoc(collection(db, "favoriteBook"), favoriteData);
+        invalidateProfile("book");
         
         // Update local state with the new document ID
         setFavoriteBooks(prevFavorites => [
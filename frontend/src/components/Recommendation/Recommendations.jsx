@@ -4,6 +4,8 @@ import { FaHeart, FaRegHeart, FaChevronLeft, FaChevronRight } from 'react-icons/
 import { Link } from 'react-router-dom';
 import { collection, addDoc, serverTimestamp, query, where, getDocs, deleteDoc } from 'firebase/firestore';
 import { db } from '../firebase';
+import { invalidateProfile } from '../favorites';
+import { thumbnailUrl } from '../thumbnails';
 import { useSelector } from 'react-redux';
 
 const Recommendations = ({ 
@@ -100,11 +102,11 @@ const Recommendations = ({
         });
         setFavorites(prev => [...prev, itemKey]);
       } else {
-        querySnapshot.forEach(async (doc) => {
-          await deleteDoc(doc.ref);
-        });
+        // Awaited, so the profile below is rebuilt without them
+        await Promise.all(querySnapshot.docs.map((doc) => deleteDoc(doc.ref)));
         setFavorites(prev => prev.filter(fav => fav !== itemKey));
       }
+      invalidateProfile(type === 'anime' ? 'anime' : 'book');
     } catch (error) {
       console.error("Error toggling favorite:", error);
     } finally {
@@ -167,10 +169,17 @@ const Recommendations = ({
                   <div key={itemKey} className="bg-purple-900 rounded-lg p-4 flex flex-col items-center">
                     <div className="h-60 mb-4 flex justify-center">
                       <img
-                        src={item.thumbnail}
+                        src={thumbnailUrl(item.thumbnail)}
                         alt={item.title}
+                        loading="lazy"
                         className="w-52 h-60 object-cover rounded-lg"
                         onError={(e) => {
+                          // Backend copy unavailable: try the original host once, then the placeholder
+                          if (item.thumbnail && !e.target.dataset.origin) {
+                            e.target.dataset.origin = 'true';
+                            e.target.src = item.thumbnail;
+                            return;
+                          }
                           e.target.onerror = null;
                           e.target.src = '/placeholder-image.jpg';
                         }}
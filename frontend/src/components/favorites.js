@@ -0,0 +1,21 @@
+import { getAuth } from "firebase/auth";
+
+// Tell the backend the signed-in user's favorites changed, so it rebuilds their cached
+// recommendation profile (the backend takes the user from the ID token)
+export const invalidateProfile = async (kind) => {
+  const user = getAuth().currentUser;
+  if (!user) return;
+  try {
+    const idToken = await user.getIdToken();
+    await fetch("http://localhost:5000/api/favorites/invalidate", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "Authorization": `Bearer ${idToken}`,
+      },
+      body: JSON.stringify({ kind }),
+    });
+  } catch (error) {
+    console.error("Error invalidating favorites profile:", error);
+  }
+};
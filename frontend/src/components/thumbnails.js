@@ -0,0 +1,3 @@
+// Card-sized copy of a catalog thumbnail, fetched once and cached by the backend
+export const thumbnailUrl = (url) =>
+  url ? `http://localhost:5000/api/thumbnail?url=${encodeURIComponent(url)}` : url;